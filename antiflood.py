@@ -0,0 +1,161 @@
+# antiflood.py
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+from metrics import Counter
+from outbox import outbox
+from ratelimit import BucketMap
+
+# "операция=в минуту:запас,..." — лимит на пользователя; на чат — в FLOOD_CHAT_FACTOR раз больше
+FLOOD_LIMITS = getattr(config, "FLOOD_LIMITS", "generate=6:3,edit=6:3,check=6:2,pay=3:2,other=30:10")
+FLOOD_CHAT_FACTOR = float(getattr(config, "FLOOD_CHAT_FACTOR", 3))
+FLOOD_DEDUP_WINDOW = float(getattr(config, "FLOOD_DEDUP_WINDOW", 3))  # сек; повтор того же сообщения — молча
+FLOOD_NOTICE_INTERVAL = 30.0  # не чаще одного «слишком часто» на пользователя
+
+flood_total = Counter("bot_flood_rejected_total", "Апдейты, отброшенные анти-флудом", ("op", "reason"))
+
+# операции, у которых свой bucket; всё прочее (справка, баланс, /quality, маски) — "other"
+_COMMANDS = {
+    "variants": "generate",
+    "edit": "edit",
+    "check": "check",
+}
+_CALLBACKS = {
+    "regen": "generate",
+    "variants": "generate",
+    "check_payment": "check",
+    "pay_now": "pay",
+}
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for part in spec.split(","):
+        name, _, value = part.strip().partition("=")
+        if not name:
+            continue
+        per_min, _, burst = value.partition(":")
+        limits[name] = (float(per_min) / 60.0, float(burst or per_min))
+    limits.setdefault("other", (0.5, 10))
+    return limits
+
+
+def _message_op(message: types.Message) -> str:
+    if message.photo:
+        return "edit" if message.caption else "other"
+    text = message.text or ""
+    if text.startswith("/"):
+        command = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+        return _COMMANDS.get(command, "other")
+    return "generate" if message.content_type == types.ContentType.TEXT and text.strip() else "other"
+
+
+def _callback_op(data: str) -> str:
+    if data.startswith("buy_"):
+        return "pay"
+    return _CALLBACKS.get(data, "other")
+
+
+class AntiFlood(BaseMiddleware):
+    """
+    Лимиты до хендлеров: только память процесса, отклонённый апдейт не доходит
+    ни до SQLite, ни до CryptoPay, ни до OpenAI.
+    - token bucket на (пользователь, операция) и на (чат, операция);
+    - одинаковое сообщение от того же пользователя в пределах FLOOD_DEDUP_WINDOW — молча отбрасывается;
+    - о превышении лимита пользователь узнаёт одним коротким ответом раз в FLOOD_NOTICE_INTERVAL.
+    """
+
+    def __init__(self, limits: str = FLOOD_LIMITS, chat_factor: float = FLOOD_CHAT_FACTOR,
+                 dedup_window: float = FLOOD_DEDUP_WINDOW, max_keys: int = 100_000):
+        super().__init__()
+        self.limits = _parse_limits(limits)
+        self.dedup_window = dedup_window
+        self.max_keys = max_keys
+        self._users = {op: BucketMap(rate, burst, max_keys) for op, (rate, burst) in self.limits.items()}
+        self._chats = {
+            op: BucketMap(rate * chat_factor, burst * chat_factor, max_keys)
+            for op, (rate, burst) in self.limits.items()
+        }
+        self._last: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()  # user_id → (отпечаток, время)
+        self._noticed: "OrderedDict[int, float]" = OrderedDict()
+
+    # ── проверки
+    def _duplicate(self, user_id: int, fingerprint: int) -> bool:
+        now = time.monotonic()
+        prev = self._last.get(user_id)
+        self._last[user_id] = (fingerprint, now)
+        self._last.move_to_end(user_id)
+        if len(self._last) > self.max_keys:
+            self._last.popitem(last=False)
+        return prev is not None and prev[0] == fingerprint and now - prev[1] < self.dedup_window
+
+    def _allow(self, op: str, user_id: int, chat_id: int) -> Optional[float]:
+        """None — можно; иначе через сколько секунд появится токен."""
+        op = op if op in self._users else "other"
+        user = self._users[op].get(user_id)
+        chat = self._chats[op].get(chat_id) if chat_id != user_id else None
+        wait = max(user.delay(), chat.delay() if chat else 0.0)
+        if wait > 0:
+            return wait
+        user.try_take()
+        if chat:
+            chat.try_take()
+        return None
+
+    def _should_notice(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if self._noticed.get(user_id, 0.0) > now:
+            return False
+        self._noticed[user_id] = now + FLOOD_NOTICE_INTERVAL
+        self._noticed.move_to_end(user_id)
+        if len(self._noticed) > self.max_keys:
+            self._noticed.popitem(last=False)
+        return True
+
+    @staticmethod
+    def _is_admin(user_id: int) -> bool:
+        return user_id in (getattr(config, "ADMIN_IDS", None) or [])
+
+    # ── хуки aiogram
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        user = message.from_user
+        if user is None or self._is_admin(user.id):
+            return
+        op = _message_op(message)
+        photo = message.photo[-1].file_unique_id if message.photo else ""
+        content = message.text or message.caption
+        if content and self._duplicate(user.id, hash((content, photo))):
+            flood_total.inc(op, "duplicate")
+            raise CancelHandler()
+        wait = self._allow(op, user.id, message.chat.id)
+        if wait is None:
+            return
+        flood_total.inc(op, "rate")
+        if self._should_notice(user.id):
+            await outbox.answer(message, f"⏳ Слишком много запросов подряд. Попробуй через {max(1, round(wait))} с.",
+                                low=True)
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        user = query.from_user
+        if self._is_admin(user.id):
+            return
+        op = _callback_op(query.data or "")
+        chat_id = query.message.chat.id if query.message else user.id
+        if self._duplicate(user.id, hash(("cb", query.data))) and op != "other":
+            flood_total.inc(op, "duplicate")
+            await query.answer()
+            raise CancelHandler()
+        wait = self._allow(op, user.id, chat_id)
+        if wait is None:
+            return
+        flood_total.inc(op, "rate")
+        # на callback отвечать нужно в любом случае — иначе кнопка «крутится»; это и есть короткий ответ
+        await query.answer(f"⏳ Слишком часто. Попробуй через {max(1, round(wait))} с.")
+        raise CancelHandler()
@@ -0,0 +1 @@
+# bench — нагрузочный стенд: локальные заглушки Telegram/OpenAI/CryptoPay и прогон хендлеров
@@ -0,0 +1,464 @@
+# bench/run.py
+"""
+Нагрузочный прогон бота без реальных денег и сети.
+
+    python -m bench.run --scripts 300 --rate 20 --users 50
+    python -m bench.run --mix text=1 --openai-latency 0.5 --error-rate 0.1
+
+Поднимает bench.stubs отдельным процессом, направляет туда Telegram/OpenAI/CryptoPay
+(TELEGRAM_API_URL, OPENAI_BASE_URL, CRYPTOPAY_API_URL), запускает main.on_startup и гонит через
+Dispatcher синтетические апдейты: текстовые промпты, фото с подписью, фото+маска+/edit,
+/pay и серии /check. Меряет пропускную способность, p50/p95/p99 по типам апдейтов,
+лаг event loop, время обращений к БД и пиковый RSS.
+
+Результат — JSON в bench/results/; с предыдущим прогоном сравнивается автоматически
+(или с --baseline). Неизвестные аргументы уходят в bench.stubs (--openai-latency и т.п.).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS_DIR = os.path.join(HERE, "results")
+
+WORDS = (
+    "кот собака робот замок дракон город лес море космос корабль закат горы "
+    "акварель неон киберпанк пиксель-арт масло набросок фото портрет пейзаж"
+).split()
+
+# метрика → больше = лучше?
+COMPARE = (
+    ("throughput_updates_s", True),
+    ("latency.all.p50", False),
+    ("latency.all.p95", False),
+    ("latency.all.p99", False),
+    ("loop_lag_ms.p99", False),
+    ("loop_lag_ms.max", False),
+    ("db.write_ms.p95", False),
+    ("db.read_ms.p95", False),
+    ("peak_rss_mb", False),
+)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон хендлеров на заглушках")
+    ap.add_argument("--scripts", type=int, default=200, help="сколько пользовательских сценариев запустить")
+    ap.add_argument("--rate", type=float, default=10.0, help="сценариев в секунду (открытая модель)")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--credits", type=int, default=1000, help="генераций на пользователя перед прогоном")
+    ap.add_argument("--mix", default="text=6,photo=2,mask_edit=1,check=1")
+    ap.add_argument("--repeat", type=float, default=0.2, help="доля повторяющихся промптов (кеш/singleflight)")
+    ap.add_argument("--check-burst", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--port", type=int, default=0, help="порт заглушек (0 — свободный)")
+    ap.add_argument("--out", help="куда сохранить JSON (по умолчанию bench/results/<время>.json)")
+    ap.add_argument("--baseline", help="JSON прошлого прогона (по умолчанию — последний в bench/results/)")
+    ap.add_argument("--threshold", type=float, default=0.10, help="порог регрессии, доля")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    return ap.parse_known_args()
+
+
+# ───── статистика
+def percentiles(values: List[float], scale: float = 1.0) -> dict:
+    if not values:
+        return {"count": 0}
+    v = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(v[min(len(v) - 1, int(q * len(v)))] * scale, 3)
+
+    return {
+        "count": len(v),
+        "mean": round(sum(v) / len(v) * scale, 3),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(v[-1] * scale, 3),
+    }
+
+
+class LoopLag:
+    """Фоновая задача: насколько позже запланированного просыпается sleep(interval)."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - t - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def instrument_db(storage, reads: List[float], writes: List[float]) -> None:
+    """Время ожидания read/write (очередь писателя + выполнение) на экземпляре _Storage."""
+    def timed(fn, bucket):
+        async def wrapper(op):
+            t = time.perf_counter()
+            try:
+                return await fn(op)
+            finally:
+                bucket.append(time.perf_counter() - t)
+        return wrapper
+
+    storage.read = timed(storage.read, reads)
+    storage.write = timed(storage.write, writes)
+
+
+# ───── синтетические апдейты
+class UpdateFactory:
+    def __init__(self, rnd: random.Random):
+        self.rnd = rnd
+        self.update_id = 0
+        self.message_id = 0
+        self.hot = [self.prompt() for _ in range(5)]
+
+    def prompt(self, repeat: float = 0.0) -> str:
+        if repeat and self.rnd.random() < repeat:
+            return self.rnd.choice(self.hot)
+        return " ".join(self.rnd.sample(WORDS, 4))
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        msg = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        }
+        msg.update(fields)
+        return {"update_id": self.update_id, "message": msg}
+
+    def text(self, user_id: int, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._message(user_id, **fields)
+
+    def photo(self, user_id: int, caption: Optional[str] = None, shared: Optional[str] = None) -> dict:
+        n = self.message_id + 1
+        # shared — пересылка одной и той же картинки: file_id у каждой свой, file_unique_id общий
+        file_id, unique_id = (f"photo_{n}~{shared}", f"u{shared}") if shared else (f"photo_{n}", f"uphoto_{n}")
+        sizes = [{"file_id": file_id, "file_unique_id": unique_id, "width": 1024, "height": 1024}]
+        fields = {"photo": sizes}
+        if caption:
+            fields["caption"] = caption
+        return self._message(user_id, **fields)
+
+    def callback(self, user_id: int, data: str) -> dict:
+        self.update_id += 1
+        msg = self._message(user_id, text="…")["message"]
+        msg["from"] = {"id": 1, "is_bot": True, "first_name": "bench"}
+        return {"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "chat_instance": str(user_id),
+            "message": msg,
+            "data": data,
+        }}
+
+    def mask(self, user_id: int) -> dict:
+        n = self.message_id + 1
+        doc = {"file_id": f"mask_{n}", "file_unique_id": f"umask_{n}", "file_name": "mask.png", "mime_type": "image/png"}
+        return self._message(user_id, document=doc)
+
+
+def build_script(kind: str, user_id: int, f: UpdateFactory, args) -> List[tuple]:
+    """Сценарий пользователя: [(метка, update)] — апдейты одного сценария идут последовательно."""
+    if kind == "text":
+        return [("text", f.text(user_id, f.prompt(args.repeat)))]
+    if kind == "variants":
+        return [("variants", f.text(user_id, "/variants 4 " + f.prompt(args.repeat)))]
+    if kind == "photo":
+        return [("photo_caption", f.photo(user_id, f.prompt(args.repeat)))]
+    if kind == "forward":
+        # «вирусная» картинка: все пересылают одно фото — скачаться оно должно один раз
+        return [("photo_caption", f.photo(user_id, f.prompt(args.repeat), shared="viral"))]
+    if kind == "mask_edit":
+        return [
+            ("photo", f.photo(user_id)),
+            ("mask", f.mask(user_id)),
+            ("edit", f.text(user_id, "/edit " + f.prompt(args.repeat))),
+        ]
+    if kind == "chain":
+        # цепочка правок: каждая следующая /edit берёт результат предыдущей, /undo откатывает
+        return [
+            ("photo", f.photo(user_id)),
+            ("edit", f.text(user_id, "/edit " + f.prompt(args.repeat))),
+            ("edit", f.text(user_id, "/edit " + f.prompt(args.repeat))),
+            ("undo", f.text(user_id, "/undo")),
+            ("edit", f.text(user_id, "/edit " + f.prompt(args.repeat))),
+        ]
+    if kind == "check":
+        return [("pay", f.text(user_id, "/pay")), ("buy", f.callback(user_id, "buy_10"))] + [
+            ("check", f.text(user_id, "/check")) for _ in range(args.check_burst)
+        ]
+    raise ValueError(f"неизвестный сценарий: {kind}")
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+# ───── инфраструктура
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"заглушки не поднялись на :{port}")
+            await asyncio.sleep(0.1)
+
+
+def configure_env(base: str, workdir: str) -> None:
+    """До импорта main/config: все внешние адреса — на заглушки, данные — во временный каталог."""
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{base}/v1",
+        "CRYPTOBOT_TOKEN": "bench",
+        "CRYPTOPAY_API_URL": base,
+        "TELEGRAM_API_URL": base,
+        "BOT_MODE": "polling",
+        "ADMIN_IDS": "",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "CACHE_DIR": os.path.join(workdir, "results"),
+        "SESSION_DIR": os.path.join(workdir, "sessions"),
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "WORK_DB_PATH": os.path.join(workdir, "work.db"),
+        "JOBS_JOURNAL": os.path.join(workdir, "jobs_journal.jsonl"),
+    })
+    # стенд меряет бэкенд: синтетические пользователи шлют чаще живых, анти-флуд по умолчанию не мешает
+    os.environ.setdefault("FLOOD_LIMITS", "generate=60000:1000,edit=60000:1000,check=60000:1000,pay=60000:1000,other=60000:1000")
+    os.environ.pop("OPENAI_API_KEYS", None)
+    os.environ.pop("TELEGRAM_PROXY_URL", None)
+    os.environ.pop("CRYPTOPAY_WEBHOOK_PORT", None)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+# ───── прогон
+async def drive(args, base: str) -> dict:
+    import logging
+    sys.path.insert(0, ROOT)
+    import main as app  # noqa: E402  — только после configure_env
+    import database
+    from aiogram import Bot, Dispatcher, types
+
+    logging.getLogger().setLevel(logging.WARNING)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+
+    reads: List[float] = []
+    writes: List[float] = []
+    instrument_db(database._storage, reads, writes)
+
+    await app.on_startup(app.dp)
+    users = list(range(100_000, 100_000 + args.users))
+    for uid in users:
+        await database.add_uses(uid, args.credits, "bench")
+    reads.clear()
+    writes.clear()
+
+    rnd = random.Random(args.seed)
+    factory = UpdateFactory(rnd)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+
+    async def run_script(script: List[tuple]) -> None:
+        for label, data in script:
+            t = time.perf_counter()
+            try:
+                await app.dp.process_update(types.Update(**data))
+            except Exception:
+                errors[label] += 1
+            latencies[label].append(time.perf_counter() - t)
+
+    lag = LoopLag()
+    lag.start()
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.scripts):
+        kind = rnd.choices(kinds, weights)[0]
+        script = build_script(kind, rnd.choice(users), factory, args)
+        tasks.append(asyncio.create_task(run_script(script)))
+        # открытая модель: сценарии приходят с заданной частотой независимо от ответов
+        delay = started + (i + 1) / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await lag.stop()
+
+    await app.on_shutdown(app.dp)
+    session = await app.bot.get_session()
+    if session:
+        await session.close()
+
+    all_lat = [x for v in latencies.values() for x in v]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "updates": len(all_lat),
+        "errors": dict(errors),
+        "throughput_updates_s": round(len(all_lat) / elapsed, 3) if elapsed else 0.0,
+        "latency": {"all": percentiles(all_lat), **{k: percentiles(v) for k, v in sorted(latencies.items())}},
+        "loop_lag_ms": percentiles(lag.samples, 1000),
+        "db": {
+            "read_ms": percentiles(reads, 1000),
+            "write_ms": percentiles(writes, 1000),
+            "total_s": round(sum(reads) + sum(writes), 3),
+        },
+        # ru_maxrss в Linux — килобайты
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+async def fetch_stub_stats(base: str) -> dict:
+    import aiohttp
+    try:
+        async with aiohttp.ClientSession() as s:
+            async with s.get(f"{base}/__stats") as r:
+                return await r.json()
+    except Exception:
+        return {}
+
+
+def dig(d: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(d, dict) or part not in d:
+            return None
+        d = d[part]
+    return d
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Печатает сравнение ключевых метрик; возвращает список регрессий."""
+    regressions = []
+    print(f"\n{'метрика':<24}{'было':>12}{'стало':>12}{'Δ':>9}")
+    for path, higher_better in COMPARE:
+        old, new = dig(baseline, path), dig(current, path)
+        if old is None or new is None:
+            continue
+        delta = (new - old) / old if old else 0.0
+        worse = -delta if higher_better else delta
+        mark = ""
+        if worse > threshold:
+            mark = "  ⚠️"
+            regressions.append(path)
+        print(f"{path:<24}{old:>12}{new:>12}{delta * 100:>8.1f}%{mark}")
+    return regressions
+
+
+def latest_result() -> Optional[str]:
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith(".json"))
+    return os.path.join(RESULTS_DIR, files[-1]) if files else None
+
+
+def main() -> int:
+    args, stub_args = parse_args()
+    port = args.port or free_port()
+    base = f"http://127.0.0.1:{port}"
+    baseline_path = args.baseline or latest_result()
+
+    stubs = subprocess.Popen(
+        [sys.executable, "-m", "bench.stubs", "--port", str(port), "--seed", str(args.seed), *stub_args],
+        cwd=ROOT,
+    )
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+            configure_env(base, workdir)
+
+            async def go():
+                await wait_port(port)
+                metrics = await drive(args, base)
+                metrics["stubs"] = await fetch_stub_stats(base)
+                return metrics
+
+            metrics = asyncio.run(go())
+    finally:
+        stubs.terminate()
+        stubs.wait(10)
+
+    result = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": sys.version.split()[0],
+            "args": vars(args),
+            "stub_args": stub_args,
+        },
+        **metrics,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    lat = metrics["latency"]["all"]
+    print(f"updates={metrics['updates']} errors={sum(metrics['errors'].values())} "
+          f"throughput={metrics['throughput_updates_s']}/s p50={lat.get('p50')}s p95={lat.get('p95')}s "
+          f"p99={lat.get('p99')}s loop_lag_p99={metrics['loop_lag_ms'].get('p99')}ms "
+          f"rss={metrics['peak_rss_mb']}MB")
+    print(f"→ {out}")
+
+    if baseline_path and os.path.abspath(baseline_path) != os.path.abspath(out):
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"сравнение с {baseline_path}")
+        regressions = compare(result, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
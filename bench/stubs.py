@@ -0,0 +1,277 @@
+# bench/stubs.py
+"""
+Локальные заглушки внешних API в одном aiohttp-приложении:
+- Telegram Bot API:  /bot<token>/<method>, /file/bot<token>/<path>
+- OpenAI Images:     /v1/images/generations, /v1/images/edits
+- CryptoPay:         /api/createInvoice, /api/getInvoices
+- счётчики вызовов:  GET /__stats
+
+Запускается отдельным процессом (python -m bench.stubs --port 8099), чтобы не мешать
+замерам лага event loop и памяти бота.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+
+def make_png(px: int, seed: int = 0) -> bytes:
+    """Градиент с шумом — PNG реалистичного размера, но без тяжёлой генерации."""
+    rnd = random.Random(seed)
+    img = Image.linear_gradient("L").resize((px, px)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(200):
+        x, y = rnd.randrange(px), rnd.randrange(px)
+        r = rnd.randrange(4, max(5, px // 8))
+        draw.ellipse((x, y, x + r, y + r), fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    # «зерно», как у фотореалистичных результатов: без него PNG сжимается на порядок лучше настоящего
+    img = Image.blend(img, Image.effect_noise((px, px), 24).convert("RGB"), 0.15)
+    out = BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def make_jpeg(px: int, seed: int = 1) -> bytes:
+    out = BytesIO()
+    Image.open(BytesIO(make_png(px, seed))).save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def make_mask(px: int) -> bytes:
+    """RGBA-маска: прозрачный квадрат в центре."""
+    img = Image.new("RGBA", (px, px), (0, 0, 0, 255))
+    ImageDraw.Draw(img).rectangle((px // 4, px // 4, px * 3 // 4, px * 3 // 4), fill=(0, 0, 0, 0))
+    out = BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+class Stubs:
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.stats: Counter = Counter()
+        self.message_id = 0
+        self.invoice_id = 0
+        self.invoices: dict = {}  # invoice_id → (created, оплатится ли)
+        self.result_b64 = base64.b64encode(make_png(args.result_px, args.seed)).decode()
+        self.photo = make_jpeg(args.photo_px, args.seed + 1)
+        self.mask = make_mask(args.photo_px)
+
+    # ── общие ответы
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def params(self, request: web.Request) -> dict:
+        data = dict(request.query)
+        if request.method == "POST":
+            if request.content_type == "application/json":
+                data.update(await request.json())
+            else:
+                post = await request.post()
+                data.update({k: v for k, v in post.items()})
+        return data
+
+    # ── Telegram
+    def _message(self, chat_id, **extra) -> dict:
+        self.message_id += 1
+        msg = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+        }
+        msg.update(extra)
+        return msg
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.stats[f"tg.{method}"] += 1
+        if request.content_length:
+            self.stats["tg.upload_bytes"] += request.content_length
+        p = await self.params(request)
+        await asyncio.sleep(self.args.tg_latency)
+        if method == "getme":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if method in ("sendmessage", "editmessagetext"):
+            return self.ok(self._message(p.get("chat_id", 0), text=p.get("text", "")))
+        if method in ("sendphoto", "senddocument"):
+            n = self.message_id + 1
+            photo = [{"file_id": f"res_{n}", "file_unique_id": f"ures_{n}", "width": 1024, "height": 1024}]
+            return self.ok(self._message(p.get("chat_id", 0), photo=photo, caption=p.get("caption")))
+        if method == "sendmediagroup":
+            media = json.loads(p.get("media", "[]"))
+            out = []
+            for _ in media:
+                n = self.message_id + 1
+                photo = [{"file_id": f"res_{n}", "file_unique_id": f"ures_{n}", "width": 1024, "height": 1024}]
+                out.append(self._message(p.get("chat_id", 0), photo=photo))
+            return self.ok(out)
+        if method == "getfile":
+            file_id = p.get("file_id", "")
+            size = len(self.mask if file_id.startswith("mask") else self.photo)
+            return self.ok({"file_id": file_id, "file_unique_id": "u" + file_id.rsplit("~", 1)[-1],
+                            "file_size": size, "file_path": f"files/{file_id}"})
+        # deleteMessage, answerCallbackQuery, setMyCommands, setWebhook, ...
+        return self.ok(True)
+
+    async def telegram_file(self, request: web.Request) -> web.Response:
+        self.stats["tg.download"] += 1
+        path = request.match_info["path"]
+        body = self.mask if path.rsplit("/", 1)[-1].startswith("mask") else self.photo
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    # ── OpenAI
+    async def openai_images(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        self.stats[f"openai.{kind}"] += 1
+        p = await self.params(request)
+        a = self.args
+        latency = max(0.0, self.rnd.gauss(a.openai_latency, a.openai_jitter))
+        stream = str(p.get("stream", "")).lower() == "true"
+        if not stream:
+            await asyncio.sleep(latency)
+        roll = self.rnd.random()
+        prompt = str(p.get("prompt", ""))
+        headers = {
+            "x-ratelimit-remaining-requests": str(self.rnd.randint(5, 50)),
+            "x-ratelimit-reset-requests": "1s",
+        }
+        if "nsfw" in prompt or roll < a.moderation_rate:
+            self.stats["openai.moderation"] += 1
+            return web.json_response({"error": {
+                "message": "Your request was rejected by the safety system. safety_violations=[sexual].",
+                "type": "image_generation_user_error", "param": None, "code": "moderation_blocked",
+            }}, status=400, headers=headers)
+        roll -= a.moderation_rate
+        if roll < a.ratelimit_rate:
+            self.stats["openai.429"] += 1
+            headers.update({"retry-after": "1", "x-ratelimit-remaining-requests": "0"})
+            return web.json_response({"error": {
+                "message": "Rate limit reached", "type": "requests", "param": None, "code": "rate_limit_exceeded",
+            }}, status=429, headers=headers)
+        roll -= a.ratelimit_rate
+        if roll < a.error_rate:
+            self.stats["openai.500"] += 1
+            return web.json_response({"error": {
+                "message": "The server had an error", "type": "server_error", "param": None, "code": None,
+            }}, status=500, headers=headers)
+        if stream:
+            if a.no_stream:
+                self.stats["openai.stream_rejected"] += 1
+                return web.json_response({"error": {
+                    "message": "Your organization must be verified to stream this model.",
+                    "type": "invalid_request_error", "param": "stream", "code": "unsupported_value",
+                }}, status=400, headers=headers)
+            return await self._stream(request, kind, int(p.get("partial_images") or 0), latency, headers)
+        n = int(p.get("n") or 1)
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"b64_json": self.result_b64} for _ in range(n)],
+        }, headers=headers)
+
+    async def _stream(self, request, kind: str, partials: int, latency: float, headers: dict):
+        """SSE как у images API: partial_image × N, затем completed."""
+        self.stats["openai.stream"] += 1
+        prefix = "image_generation" if kind == "generations" else "image_edit"
+        resp = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        common = {"background": "opaque", "created_at": int(time.time()), "output_format": "png",
+                  "quality": "medium", "size": "1024x1024", "b64_json": self.result_b64}
+        for i in range(partials):
+            await asyncio.sleep(latency / (partials + 1))
+            event = dict(common, type=f"{prefix}.partial_image", partial_image_index=i)
+            await resp.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        await asyncio.sleep(latency / (partials + 1))
+        usage = {"input_tokens": 10, "output_tokens": 100, "total_tokens": 110,
+                 "input_tokens_details": {"image_tokens": 0, "text_tokens": 10}}
+        event = dict(common, type=f"{prefix}.completed", usage=usage)
+        await resp.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        await resp.write_eof()
+        return resp
+
+    # ── CryptoPay
+    def _invoice(self, invoice_id: int, status: str, amount="1", description=None) -> dict:
+        return {
+            "invoice_id": invoice_id,
+            "hash": f"IV{invoice_id}",
+            "status": status,
+            "asset": "TON",
+            "amount": amount,
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            "description": description,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "allow_comments": True,
+            "allow_anonymous": True,
+            "currency_type": "crypto",
+        }
+
+    async def cryptopay(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.stats[f"cryptopay.{method}"] += 1
+        p = await self.params(request)
+        await asyncio.sleep(self.args.cryptopay_latency)
+        if method == "createInvoice":
+            self.invoice_id += 1
+            self.invoices[self.invoice_id] = (time.monotonic(), self.rnd.random() < self.args.pay_rate)
+            return self.ok(self._invoice(self.invoice_id, "active", p.get("amount", "1"), p.get("description")))
+        if method == "getInvoices":
+            ids = [int(x) for x in str(p.get("invoice_ids", "")).split(",") if x]
+            now = time.monotonic()
+            items = []
+            for i in ids:
+                created, pays = self.invoices.get(i, (now, False))
+                paid = pays and now - created >= self.args.pay_after
+                items.append(self._invoice(i, "paid" if paid else "active"))
+            return self.ok({"items": items})
+        return web.json_response({"ok": False, "error": {"code": 400, "name": "METHOD_NOT_FOUND"}})
+
+    async def stats_handler(self, _request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.telegram)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.telegram_file)
+        app.router.add_post("/v1/images/{kind}", self.openai_images)
+        app.router.add_route("*", "/api/{method}", self.cryptopay)
+        app.router.add_get("/__stats", self.stats_handler)
+        return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="Заглушки Telegram/OpenAI/CryptoPay для bench/")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--tg-latency", type=float, default=0.02, help="сек на вызов Bot API")
+    ap.add_argument("--openai-latency", type=float, default=2.0, help="среднее время генерации, сек")
+    ap.add_argument("--openai-jitter", type=float, default=0.5)
+    ap.add_argument("--error-rate", type=float, default=0.02, help="доля ответов 500")
+    ap.add_argument("--ratelimit-rate", type=float, default=0.02, help="доля ответов 429")
+    ap.add_argument("--moderation-rate", type=float, default=0.03, help="доля блокировок модерацией")
+    ap.add_argument("--no-stream", action="store_true", help="отклонять stream=true (проверка фолбэка)")
+    ap.add_argument("--cryptopay-latency", type=float, default=0.05)
+    ap.add_argument("--pay-rate", type=float, default=0.5, help="доля счетов, которые будут оплачены")
+    ap.add_argument("--pay-after", type=float, default=2.0, help="через сколько сек счёт становится paid")
+    ap.add_argument("--result-px", type=int, default=512)
+    ap.add_argument("--photo-px", type=int, default=1024)
+    return ap
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    web.run_app(Stubs(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
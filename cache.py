@@ -0,0 +1,257 @@
+# cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import config
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = getattr(config, "CACHE_DIR", "cache/results")
+CACHE_MAX_BYTES = int(getattr(config, "CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+CACHE_TTL = float(getattr(config, "CACHE_TTL", 7 * 24 * 3600))
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Схлопываем пробелы и регистр: «Кот  в шляпе» == «кот в шляпе»."""
+    return " ".join((prompt or "").split()).casefold()
+
+
+def make_key(
+    model: str,
+    prompt: str,
+    size: str,
+    image: Optional[bytes] = None,
+    mask: Optional[bytes] = None,
+    **extra,
+) -> str:
+    """Ключ результата: sha256 от (модель, нормализованный промпт, размер, картинка, маска)."""
+    h = hashlib.sha256()
+    for part in (model, normalize_prompt(prompt), size):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    for blob in (image, mask):
+        h.update(hashlib.sha256(blob).digest() if blob else b"-")
+    for k in sorted(extra):
+        h.update(f"{k}={extra[k]}".encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ("key", "size", "created", "file_id", "doc_file_id")
+
+    def __init__(self, key: str, size: int, created: float, file_id: Optional[str] = None,
+                 doc_file_id: Optional[str] = None):
+        self.key = key
+        self.size = size
+        self.created = created
+        self.file_id = file_id  # сжатое фото: только для переотправки, не источник для правок
+        self.doc_file_id = doc_file_id  # оригинал документом (кнопка «без сжатия»), без потерь
+
+    def meta(self) -> dict:
+        return {"created": self.created, "file_id": self.file_id, "doc_file_id": self.doc_file_id}
+
+
+class ResultCache:
+    """
+    Дисковый content-addressed кеш готовых картинок.
+    <key> — сами байты как есть (PNG от API или уже JPEG/WebP — расширения нет, формат определяется
+    по содержимому), <key>.json — метаданные (время создания, Telegram file_id
+    отправленного фото и оригинала-документа).
+    Индекс держим в памяти в порядке LRU; вытеснение по TTL и по общему размеру.
+    Вся работа с диском — в потоках, event loop на stat/open не блокируется.
+    """
+
+    def __init__(self, root: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._index: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._total = 0
+
+    def _path(self, key: str, ext: str = "") -> str:
+        return os.path.join(self.root, f"{key}.{ext}" if ext else key)
+
+    def _entry(self, key: str) -> Optional[CacheEntry]:
+        try:
+            st = os.stat(self._path(key))
+        except OSError:
+            return None
+        meta = {}
+        try:
+            with open(self._path(key, "json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception:
+            pass
+        return CacheEntry(key, st.st_size, meta.get("created", st.st_mtime), meta.get("file_id"), meta.get("doc_file_id"))
+
+    # ── загрузка индекса при старте
+    def _scan(self) -> list:
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for name in os.listdir(self.root):
+            if name.endswith(".png"):
+                # старый формат имени: <key>.png, даже если внутри JPEG
+                try:
+                    os.replace(os.path.join(self.root, name), self._path(name[:-4]))
+                except OSError:
+                    continue
+                name = name[:-4]
+            elif name.endswith(".tmp"):
+                # недописанное прошлым процессом
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+                continue
+            elif "." in name:
+                continue
+            try:
+                atime = os.stat(self._path(name)).st_atime
+            except OSError:
+                continue
+            e = self._entry(name)
+            if e is not None:
+                found.append((atime, e))
+        found.sort(key=lambda x: x[0])
+        return [e for _, e in found]
+
+    async def load(self) -> None:
+        entries = await asyncio.to_thread(self._scan)
+        self._index.clear()
+        self._total = 0
+        for e in entries:
+            self._index[e.key] = e
+            self._total += e.size
+        await self._evict()
+        log.info("ResultCache: %d entries, %.1f MB", len(self._index), self._total / 1e6)
+
+    # ── чтение
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        e = self._index.get(key)
+        if e is None:
+            e = await self._probe(key)
+        if e is None:
+            return None
+        if self.ttl and time.time() - e.created > self.ttl:
+            await self._drop(key)
+            return None
+        self._index.move_to_end(key)
+        return e
+
+    async def _probe(self, key: str) -> Optional[CacheEntry]:
+        """Промах по индексу: запись могла появиться от другого инстанса на этом же диске."""
+        e = await asyncio.to_thread(self._entry, key)
+        if e is None:
+            return None
+        old = self._index.pop(key, None)  # пока были в потоке, запись мог добавить put
+        if old is not None:
+            self._total -= old.size
+        self._index[key] = e
+        self._total += e.size
+        return e
+
+    async def read(self, entry: CacheEntry) -> Optional[bytes]:
+        try:
+            return await asyncio.to_thread(self._read_file, self._path(entry.key))
+        except OSError:
+            await self._drop(entry.key)
+            return None
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    # ── запись
+    def _write(self, key: str, data: bytes, meta: dict) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self._path(key, "tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        self._write_meta(key, meta)
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        tmp = self._path(key, "json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path(key, "json"))
+
+    async def put(self, key: str, data: bytes) -> None:
+        created = time.time()
+        try:
+            await asyncio.to_thread(self._write, key, data, {"created": created})
+        except OSError as e:
+            log.warning("ResultCache: не удалось записать %s: %s", key, e)
+            return
+        old = self._index.pop(key, None)
+        if old:
+            self._total -= old.size
+        self._index[key] = CacheEntry(key, len(data), created)
+        self._total += len(data)
+        await self._evict()
+
+    async def set_file_id(self, key: str, file_id: str, document: bool = False) -> None:
+        """
+        Запоминаем Telegram file_id уже загруженного результата — повторная отправка без аплоада.
+        Фото (document=False) — сжатая копия: годится только чтобы показать результат ещё раз.
+        Всё, что результат дальше обрабатывает (цепочка правок), берёт байты по ключу или doc_file_id.
+        """
+        e = self._index.get(key)
+        if e is None or (e.doc_file_id if document else e.file_id) == file_id:
+            return
+        if document:
+            e.doc_file_id = file_id
+        else:
+            e.file_id = file_id
+        try:
+            await asyncio.to_thread(self._write_meta, key, e.meta())
+        except OSError:
+            pass
+
+    # ── вытеснение
+    def _forget(self, key: str) -> None:
+        e = self._index.pop(key, None)
+        if e is not None:
+            self._total -= e.size
+
+    def _unlink(self, keys: list) -> None:
+        for key in keys:
+            for ext in ("", "json"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+
+    async def _drop(self, key: str) -> None:
+        self._forget(key)
+        await asyncio.to_thread(self._unlink, [key])
+
+    async def _evict(self) -> None:
+        now = time.time()
+        victims = []
+        if self.ttl:
+            victims = [k for k, e in self._index.items() if now - e.created > self.ttl]
+        expired = set(victims)
+        total = self._total - sum(self._index[k].size for k in victims)
+        for k, e in self._index.items():  # от самых давно использованных
+            if total <= self.max_bytes:
+                break
+            if k in expired:
+                continue
+            victims.append(k)
+            total -= e.size
+        if victims:
+            for k in victims:
+                self._forget(k)
+            await asyncio.to_thread(self._unlink, victims)
+
+
+result_cache = ResultCache()
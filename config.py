@@ -17,4 +17,133 @@ ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
 TELEGRAM_PROXY_URL = os.getenv("TELEGRAM_PROXY_URL")
 
 # 📑 Режим парсинга сообщений (по умолчанию HTML)
-PARSE_MODE = os.getenv("PARSE_MODE", "HTML")
\ No newline at end of file
+PARSE_MODE = os.getenv("PARSE_MODE", "HTML")
+# 🤖 OpenAI: общий пул HTTP-соединений (один httpx.AsyncClient на процесс)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "16"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "180"))
+
+# 🧵 Очередь генераций
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", "4"))  # одновременных вызовов OpenAI на процесс
+GEN_PER_USER_INFLIGHT = int(os.getenv("GEN_PER_USER_INFLIGHT", "2"))  # параллельных генераций одного пользователя (у каждой свой резерв кредитов)
+GEN_MAX_PENDING = int(os.getenv("GEN_MAX_PENDING", "200"))
+GEN_MAX_PENDING_PER_USER = int(os.getenv("GEN_MAX_PENDING_PER_USER", "3"))
+# local — генерация в процессе бота; workers — в процессах worker.py через очередь в SQLite (WORK_DB_PATH)
+GEN_BACKEND = os.getenv("GEN_BACKEND", "local").strip().lower()
+GEN_PROCESSES = int(os.getenv("GEN_PROCESSES", "0"))  # сколько worker.py поднимает сам main.py (0 — запускаешь сам)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))  # задач одновременно в одном worker.py
+WORKER_DRAIN = float(os.getenv("WORKER_DRAIN", "30"))  # сек на доработку при остановке воркера
+WORK_DB_PATH = os.getenv("WORK_DB_PATH", "work.db")
+WORK_LEASE = float(os.getenv("WORK_LEASE", "60"))  # сек аренды задачи; воркер продлевает её, пока работает
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))  # выдач одной задачи (при падениях воркеров)
+WORK_POLL_INTERVAL = float(os.getenv("WORK_POLL_INTERVAL", "0.1"))
+
+# 🗄 Кеш готовых результатов (одинаковые запросы не идут в OpenAI повторно)
+CACHE_DIR = os.getenv("CACHE_DIR", "cache/results")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+
+# 💾 SQLite (WAL, пул читателей, один писатель с батчами)
+DB_PATH = os.getenv("DB_PATH", "users.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "256"))
+HOLD_TTL = float(os.getenv("HOLD_TTL", "900"))  # сек; резерв кредитов под генерацию
+
+# 💳 CryptoPay: опрос ожидающих счетов или webhook
+INVOICE_TTL = int(os.getenv("INVOICE_TTL", "3600"))  # сек; потом счёт истекает
+CRYPTOPAY_POLL_INTERVAL = float(os.getenv("CRYPTOPAY_POLL_INTERVAL", "15"))
+CRYPTOPAY_WEBHOOK_HOST = os.getenv("CRYPTOPAY_WEBHOOK_HOST", "0.0.0.0")
+CRYPTOPAY_WEBHOOK_PORT = int(os.getenv("CRYPTOPAY_WEBHOOK_PORT", "0"))  # 0 — выключен
+CRYPTOPAY_WEBHOOK_PATH = os.getenv("CRYPTOPAY_WEBHOOK_PATH", "/cryptopay")
+CRYPTOPAY_RECONCILE_INTERVAL = float(os.getenv("CRYPTOPAY_RECONCILE_INTERVAL", "300"))  # сверка при webhook'е
+
+# 📷 Сессии пользователей (последнее фото/маска)
+SESSION_DIR = os.getenv("SESSION_DIR", "cache/sessions")
+SESSION_MEM_BYTES = int(os.getenv("SESSION_MEM_BYTES", str(64 * 1024 * 1024)))
+SESSION_DISK_BYTES = int(os.getenv("SESSION_DISK_BYTES", str(1024 * 1024 * 1024)))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+EDIT_HISTORY = int(os.getenv("EDIT_HISTORY", "10"))  # версий в цепочке правок (/undo, /history)
+
+# 📥 Загрузки из Telegram (фото/документы/маски, кеш по file_unique_id)
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "cache/downloads")
+DOWNLOAD_DISK_BYTES = int(os.getenv("DOWNLOAD_DISK_BYTES", str(512 * 1024 * 1024)))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))  # больше Bot API и не отдаёт
+DOWNLOAD_TTL = float(os.getenv("DOWNLOAD_TTL", str(24 * 3600)))
+
+# 🌐 Приём апдейтов: polling (один процесс) или webhook (несколько инстансов за балансировщиком)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, напр. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # сверяем с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SET_ON_START = os.getenv("WEBHOOK_SET_ON_START", "1") == "1"  # на остальных инстансах — 0
+# Кеш балансов (сек): 0 — без срока (один процесс); в webhook-режиме инстансов несколько — по умолчанию 3
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "3" if BOT_MODE == "webhook" else "0"))
+
+# 🖼 Подготовка входных картинок для /edit
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+PREPROCESS_CACHE_BYTES = int(os.getenv("PREPROCESS_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# 📤 Исходящие вызовы Telegram (лимиты Bot API)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "28"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+TG_DROP_LOW_AFTER = int(os.getenv("TG_DROP_LOW_AFTER", "50"))
+
+# 🔑 Несколько ключей OpenAI: "key1|org1|base_url1,key2,key3|org3" (иначе берётся OPENAI_API_KEY)
+OPENAI_API_KEYS = os.getenv("OPENAI_API_KEYS")
+OPENAI_ORG_ID = os.getenv("OPENAI_ORG_ID")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "10"))
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+
+# 🧪 Альтернативные адреса API (локальный Bot API server, стенды, bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # напр. http://127.0.0.1:8081
+CRYPTOPAY_API_URL = os.getenv("CRYPTOPAY_API_URL")  # вместо MAINNET/TESTNET
+
+# 📈 Метрики в формате Prometheus (гистограммы этапов, счётчики, глубина очереди, лаг event loop)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — выключено
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+READY_PATH = os.getenv("READY_PATH", "/ready")  # readiness-проба: на порту метрик и на порту webhook
+
+# 🔁 Остановка и рестарт: недоделанные генерации — в журнал, следующий запуск их выполняет
+JOBS_JOURNAL = os.getenv("JOBS_JOURNAL", "jobs_journal.jsonl")
+SHUTDOWN_DRAIN = float(os.getenv("SHUTDOWN_DRAIN", "20"))  # сек ждём текущие генерации при остановке
+JOURNAL_MAX_AGE = float(os.getenv("JOURNAL_MAX_AGE", "3600"))  # более старые записи не возобновляем
+
+# 🎲 /variants: несколько картинок одним вызовом images.generate (n) и одним альбомом
+VARIANTS_MAX = int(os.getenv("VARIANTS_MAX", "4"))
+VARIANTS_DEFAULT = int(os.getenv("VARIANTS_DEFAULT", "4"))
+
+# 🖼 Черновики: промежуточные картинки (stream + partial_images) вместо «⏳» до самого конца
+IMAGE_STREAM = int(os.getenv("IMAGE_STREAM", "0"))  # 1 — включить; по умолчанию выкл.: частичные картинки платные
+IMAGE_PARTIALS = int(os.getenv("IMAGE_PARTIALS", "2"))  # 0–3; каждая промежуточная платная (+токены)
+PREVIEW_INTERVAL = float(os.getenv("PREVIEW_INTERVAL", "2"))  # сек между правками черновика
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "512"))
+
+# 📤 Доставка: фото — сжатой копией, PNG-оригинал — документом по кнопке «Оригинал без сжатия»
+DELIVERY_FORMAT = os.getenv("DELIVERY_FORMAT", "jpeg")  # jpeg | webp
+DELIVERY_QUALITY = int(os.getenv("DELIVERY_QUALITY", "85"))
+DELIVERY_MAX_SIDE = int(os.getenv("DELIVERY_MAX_SIDE", "2048"))
+
+# ⚙️ Тарифы качества (/quality) и авто-деградация бесплатных запросов под нагрузкой
+DEFAULT_QUALITY = os.getenv("DEFAULT_QUALITY", "medium")  # low | medium | high
+DEGRADE_QUEUE_DEPTH = int(os.getenv("DEGRADE_QUEUE_DEPTH", "20"))  # 0 — не учитывать очередь
+DEGRADE_LATENCY = float(os.getenv("DEGRADE_LATENCY", "45"))  # сек сглаженного ответа OpenAI; 0 — не учитывать
+
+# 🚫 Пред-фильтр модерации: промпты, уже заблокированные OpenAI, отклоняются локально
+MODERATION_CACHE_TTL = float(os.getenv("MODERATION_CACHE_TTL", str(3 * 24 * 3600)))  # сек
+MODERATION_CACHE_MAX = int(os.getenv("MODERATION_CACHE_MAX", "20000"))
+MODERATION_NEAR_BITS = int(os.getenv("MODERATION_NEAR_BITS", "6"))  # из 64; 0 — только точные повторы
+
+# 🚦 Анти-флуд до хендлеров: "операция=в минуту:запас" на пользователя (generate, edit, check, pay, other)
+FLOOD_LIMITS = os.getenv("FLOOD_LIMITS", "generate=6:3,edit=6:3,check=6:2,pay=3:2,other=30:10")
+FLOOD_CHAT_FACTOR = float(os.getenv("FLOOD_CHAT_FACTOR", "3"))  # лимит группового чата = лимит пользователя × N
+FLOOD_DEDUP_WINDOW = float(os.getenv("FLOOD_DEDUP_WINDOW", "3"))  # сек; повтор того же текста отбрасывается молча
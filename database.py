@@ -1,21 +1,39 @@
 # database.py
+import asyncio
+import logging
 import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
-conn = sqlite3.connect("users.db")
-cursor = conn.cursor()
+import config
+from metrics import db_seconds
 
-# Таблица пользователей: credits = сколько генераций осталось
-cursor.execute(
+log = logging.getLogger(__name__)
+
+DB_PATH = getattr(config, "DB_PATH", "users.db")
+DB_READERS = int(getattr(config, "DB_READERS", 4))
+DB_BATCH_MAX = int(getattr(config, "DB_BATCH_MAX", 256))
+HOLD_TTL = float(getattr(config, "HOLD_TTL", 900))  # сек; зависшие резервы возвращаются
+HOLD_SWEEP_INTERVAL = 60.0
+# 0 — кеш балансов без срока (один процесс); >0 — для нескольких инстансов на одной БД:
+# баланс, изменённый другим инстансом, виден здесь не позже чем через столько секунд
+BALANCE_CACHE_TTL = float(getattr(
+    config, "BALANCE_CACHE_TTL", 3 if getattr(config, "BOT_MODE", "polling") == "webhook" else 0
+))
+
+FREE_CREDITS_ON_FIRST_SEEN = 3  # первые 3 бесплатно (один раз на пользователя)
+
+_SCHEMA = [
+    # Таблица пользователей: credits = сколько генераций осталось
     """
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         credits INTEGER NOT NULL DEFAULT 0
     )
-    """
-)
-
-# Таблица платежей: чтобы не начислять повторно по одному invoice_id
-cursor.execute(
+    """,
+    # Таблица платежей: чтобы не начислять повторно по одному invoice_id
     """
     CREATE TABLE IF NOT EXISTS payments (
         payment_id TEXT PRIMARY KEY,
@@ -23,69 +41,718 @@ cursor.execute(
         amount REAL NOT NULL,
         confirmed INTEGER NOT NULL DEFAULT 1
     )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)",
+    # Счета CryptoPay: локальный индекс, чтобы не сканировать всю историю в API
+    """
+    CREATE TABLE IF NOT EXISTS invoices (
+        invoice_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        generations INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'active',
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_invoices_user_status ON invoices(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status, invoice_id)",
+    # Служебные отметки (разовые миграции и т.п.)
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """,
+    # Состояние пользователя (последнее фото/маска, последний запрос): общее для всех инстансов
+    """
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user_id, key)
+    )
+    """,
+    # Резервы (holds): кредиты списаны из users.credits, но генерация ещё идёт
+    """
+    CREATE TABLE IF NOT EXISTS holds (
+        hold_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_holds_expires ON holds(expires_at)",
+    # Журнал движений кредитов (только добавление)
+    """
+    CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        ref TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_ledger_ref ON ledger(ref)",
+    # Промпты, заблокированные модерацией OpenAI (локальный пред-фильтр, см. moderation.py)
+    """
+    CREATE TABLE IF NOT EXISTS blocked_prompts (
+        fingerprint TEXT PRIMARY KEY,
+        scope TEXT NOT NULL,
+        simhash INTEGER NOT NULL,
+        categories TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_blocked_expires ON blocked_prompts(expires_at)",
+    # События генераций/правок (журнал) и инкрементальные сводки по часам/дням для /stats
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        user_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        size TEXT,
+        quality TEXT,
+        latency REAL,
+        outcome TEXT NOT NULL,
+        category TEXT,
+        credits INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts)",
+    """
+    CREATE TABLE IF NOT EXISTS rollups (
+        period TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        latency_sum REAL NOT NULL DEFAULT 0,
+        latency_max REAL NOT NULL DEFAULT 0,
+        credits INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (period, bucket, op, outcome)
+    )
+    """,
+    # кто уже посчитан активным в часовой/дневной корзине — число уникальных пользователей растёт инкрементально
+    """
+    CREATE TABLE IF NOT EXISTS rollup_active (
+        period TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (period, bucket, user_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+    BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+    """,
     """
-)
+    CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+    BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+    """,
+]
 
-conn.commit()
 
-FREE_CREDITS_ON_FIRST_SEEN = 3  # первые 3 бесплатно (один раз на пользователя)
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class StorageClosed(RuntimeError):
+    """БД уже закрыта (close_db) — поздний вызов, например из finally отменённого хендлера."""
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Переносы данных между версиями схемы (идемпотентно, в транзакции создания схемы)."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_users'").fetchone():
+        # старая таблица помнила только дневную корзину
+        conn.execute("INSERT OR IGNORE INTO rollup_active SELECT 'd', bucket, user_id FROM rollup_users")
+        conn.execute("DROP TABLE rollup_users")
+
+
+# ───── хранилище: пул читателей + один писатель с батч-транзакциями
+class _Storage:
+    def __init__(self):
+        self._readers: Optional[asyncio.Queue] = None
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        self._write_pool: Optional[ThreadPoolExecutor] = None
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._sweeper_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def started(self) -> bool:
+        return self._writer_task is not None
+
+    async def start(self, maintenance: bool = False) -> None:
+        if self._closed:
+            raise StorageClosed("database is closed")
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not self.started:
+                await self._open()
+            if maintenance and self._sweeper_task is None:
+                self._sweeper_task = asyncio.create_task(_sweep_holds_forever())
+
+    async def _open(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._write_pool = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+        self._read_pool = ThreadPoolExecutor(DB_READERS, thread_name_prefix="db-reader")
+        self._writer_conn = await loop.run_in_executor(self._write_pool, self._init_writer)
+        self._readers = asyncio.Queue()
+        for _ in range(DB_READERS):
+            self._readers.put_nowait(await loop.run_in_executor(self._read_pool, _connect))
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    @staticmethod
+    def _init_writer() -> sqlite3.Connection:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        for stmt in _SCHEMA:
+            conn.execute(stmt)
+        _migrate(conn)
+        conn.execute("COMMIT")
+        return conn
+
+    async def stop(self) -> None:
+        """Закрывает БД насовсем: последующие read/write не переоткрывают её, а бросают StorageClosed."""
+        self._closed = True
+        if not self.started:
+            return
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            await asyncio.gather(self._sweeper_task, return_exceptions=True)
+            self._sweeper_task = None
+        # дожидаемся, пока писатель выгребет очередь
+        await self._write_queue.join()
+        self._writer_task.cancel()
+        await asyncio.gather(self._writer_task, return_exceptions=True)
+        self._writer_task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._write_pool, self._writer_conn.close)
+        while not self._readers.empty():
+            conn = self._readers.get_nowait()
+            await loop.run_in_executor(self._read_pool, conn.close)
+        self._write_pool.shutdown(wait=False)
+        self._read_pool.shutdown(wait=False)
+
+    # ── чтение
+    async def read(self, fn: Callable[[sqlite3.Connection], object]):
+        if self._closed:
+            raise StorageClosed("database is closed")
+        if not self.started:
+            await self.start()
+        with db_seconds.time("read"):
+            conn = await self._readers.get()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._read_pool, fn, conn)
+            finally:
+                self._readers.put_nowait(conn)
+
+    # ── запись
+    async def write(self, fn: Callable[[sqlite3.Connection], object]):
+        if self._closed:
+            raise StorageClosed("database is closed")
+        if not self.started:
+            await self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((fn, fut))
+        with db_seconds.time("write"):
+            return await fut
+
+    async def _writer_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._write_queue.get()]
+            while len(batch) < DB_BATCH_MAX:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                with db_seconds.time("batch"):
+                    results = await loop.run_in_executor(self._write_pool, self._apply_batch, [fn for fn, _ in batch])
+            except Exception as e:
+                log.exception("DB writer: batch failed")
+                results = [(False, e)] * len(batch)
+            for (_, fut), (ok, value) in zip(batch, results):
+                if fut.done():
+                    continue
+                if ok:
+                    fut.set_result(value)
+                else:
+                    fut.set_exception(value)
+            for _ in batch:
+                self._write_queue.task_done()
+
+    def _apply_batch(self, fns: List[Callable]) -> List[Tuple[bool, object]]:
+        """Одна транзакция на весь батч; каждая операция — в своём SAVEPOINT."""
+        conn = self._writer_conn
+        results: List[Tuple[bool, object]] = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn in fns:
+                conn.execute("SAVEPOINT op")
+                try:
+                    value = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((False, e))
+                else:
+                    conn.execute("RELEASE op")
+                    results.append((True, value))
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return results
+
+
+_storage = _Storage()
+
+
+async def init_db(maintenance: bool = True) -> None:
+    """
+    maintenance — фоновое обслуживание (возврат истёкших резервов, чистка сводок): только в процессе бота.
+    Воркеры генерации (worker.py) открывают ту же БД с maintenance=False.
+    """
+    await _storage.start(maintenance)
+
+
+async def close_db() -> None:
+    await _storage.stop()
+
+
+# ───── кеш балансов в памяти процесса (инвалидируется при записи)
+_balance: Dict[int, Tuple[int, float]] = {}
+_balance_gen: Dict[int, int] = {}
+
+
+def _invalidate(user_id: int, value: Optional[int] = None) -> None:
+    _balance_gen[user_id] = _balance_gen.get(user_id, 0) + 1
+    if value is None:
+        _balance.pop(user_id, None)
+    else:
+        _balance[user_id] = (value, time.monotonic())
 
 
-def _ensure_user_with_free_credits(user_id: int) -> None:
+def _cached_balance(user_id: int) -> Optional[int]:
+    hit = _balance.get(user_id)
+    if hit is None:
+        return None
+    if BALANCE_CACHE_TTL and time.monotonic() - hit[1] > BALANCE_CACHE_TTL:
+        return None
+    return hit[0]
+
+
+def _ensure_user(conn: sqlite3.Connection, user_id: int) -> None:
     """
     Создаёт пользователя с FREE_CREDITS_ON_FIRST_SEEN при первом обращении.
     Если пользователь уже есть — ничего не меняем.
     """
-    cursor.execute(
+    cur = conn.execute(
         "INSERT OR IGNORE INTO users (user_id, credits) VALUES (?, ?)",
         (user_id, FREE_CREDITS_ON_FIRST_SEEN),
     )
-    conn.commit()
+    if cur.rowcount:
+        _log(conn, user_id, FREE_CREDITS_ON_FIRST_SEEN, "signup")
+        _rollup(conn, time.time(), "signup", "new")
+
+
+def _log(conn: sqlite3.Connection, user_id: int, delta: int, kind: str, ref: Optional[str] = None) -> None:
+    conn.execute(
+        "INSERT INTO ledger (ts, user_id, delta, kind, ref) VALUES (?, ?, ?, ?, ?)",
+        (time.time(), user_id, delta, kind, ref),
+    )
+
 
+def _select_credits(conn: sqlite3.Connection, user_id: int) -> Optional[int]:
+    row = conn.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return int(row[0]) if row else None
 
-def get_credits(user_id: int) -> int:
-    _ensure_user_with_free_credits(user_id)
-    cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    return int(row[0]) if row else 0
 
+async def get_credits(user_id: int) -> int:
+    cached = _cached_balance(user_id)
+    if cached is not None:
+        return cached
+    gen = _balance_gen.get(user_id, 0)
+    credits = await _storage.read(lambda c: _select_credits(c, user_id))
+    if credits is None:
+        # первый визит — создаём пользователя один раз (через писателя)
+        def op(c):
+            _ensure_user(c, user_id)
+            return _select_credits(c, user_id)
+        credits = await _storage.write(op)
+        _invalidate(user_id, credits)
+        return credits or 0
+    if _balance_gen.get(user_id, 0) == gen:
+        _balance[user_id] = (credits, time.monotonic())
+    return credits
 
-def has_credits(user_id: int) -> bool:
-    """Есть ли хотя бы 1 генерация в остатке (с учётом бесплатных при первом заходе)."""
-    return get_credits(user_id) > 0
+
+async def add_uses(user_id: int, count: int, ref: Optional[str] = None) -> None:
+    """Начислить пользователю N генераций (например, после оплаты)."""
+    def op(c):
+        _ensure_user(c, user_id)
+        c.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (count, user_id))
+        _log(c, user_id, count, "topup", ref)
+        return _select_credits(c, user_id)
+    _invalidate(user_id, await _storage.write(op))
 
 
-def consume_credit(user_id: int, n: int = 1) -> bool:
+# ───── резервы: reserve → (генерация) → commit | release
+async def reserve_credits(user_id: int, n: int = 1, ttl: float = HOLD_TTL) -> Optional[str]:
     """
-    Списывает n генераций, если хватает. Возвращает True/False.
-    Использовать ТОЛЬКО ПОСЛЕ успешной генерации/редактирования.
+    Атомарно откладывает n кредитов под генерацию. Возвращает hold_id или None, если не хватает.
+    Параллельные генерации одного пользователя не блокируют друг друга и не уходят в минус.
     """
-    _ensure_user_with_free_credits(user_id)
-    cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    credits = int(row[0]) if row else 0
-    if credits < n:
+    hold_id = uuid.uuid4().hex
+
+    def op(c):
+        _ensure_user(c, user_id)
+        cur = c.execute(
+            "UPDATE users SET credits = credits - ? WHERE user_id = ? AND credits >= ?",
+            (n, user_id, n),
+        )
+        if not cur.rowcount:
+            return False, _select_credits(c, user_id)
+        now = time.time()
+        c.execute(
+            "INSERT INTO holds (hold_id, user_id, amount, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (hold_id, user_id, n, now, now + ttl),
+        )
+        _log(c, user_id, -n, "reserve", hold_id)
+        return True, _select_credits(c, user_id)
+    ok, left = await _storage.write(op)
+    _invalidate(user_id, left)
+    return hold_id if ok else None
+
+
+async def commit_hold(hold_id: str, used: Optional[int] = None) -> bool:
+    """
+    Генерация удалась — резерв становится окончательным списанием.
+    used < суммы резерва (например, вариантов пришло меньше, чем просили) — остаток возвращается.
+    Резерв успел истечь (долгая очередь/ретраи) и кредиты уже вернул expire_holds — списываем напрямую.
+    """
+    def op(c):
+        row = c.execute("SELECT user_id, amount FROM holds WHERE hold_id = ?", (hold_id,)).fetchone()
+        if not row:
+            return _charge_expired(c, hold_id, used)
+        user_id, amount = row
+        c.execute("DELETE FROM holds WHERE hold_id = ?", (hold_id,))
+        _log(c, user_id, 0, "commit", hold_id)
+        refund = amount - used if used is not None and used < amount else 0
+        if refund <= 0:
+            return True, None
+        c.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (refund, user_id))
+        _log(c, user_id, refund, "release", hold_id)
+        return True, (user_id, _select_credits(c, user_id))
+    ok, balance = await _storage.write(op)
+    if balance:
+        _invalidate(*balance)
+    if not ok:
+        log.warning("commit_hold: резерв %s не найден", hold_id)
+    return ok
+
+
+def _charge_expired(c: sqlite3.Connection, hold_id: str, used: Optional[int]) -> Tuple[bool, Optional[Tuple[int, int]]]:
+    """Списание по истёкшему резерву: сколько вернул expire_holds, но не больше остатка (в минус не уходим)."""
+    row = c.execute("SELECT user_id, delta FROM ledger WHERE ref = ? AND kind = 'expire'", (hold_id,)).fetchone()
+    if not row or c.execute("SELECT 1 FROM ledger WHERE ref = ? AND kind = 'commit'", (hold_id,)).fetchone():
+        return False, None
+    user_id, amount = row
+    n = min(amount, (_select_credits(c, user_id) or 0), used if used is not None else amount)
+    if n > 0:
+        c.execute("UPDATE users SET credits = credits - ? WHERE user_id = ?", (n, user_id))
+        _log(c, user_id, -n, "late_commit", hold_id)
+    _log(c, user_id, 0, "commit", hold_id)
+    return True, (user_id, _select_credits(c, user_id))
+
+
+def _return_hold(c: sqlite3.Connection, hold_id: str, kind: str) -> Optional[Tuple[int, int]]:
+    row = c.execute("SELECT user_id, amount FROM holds WHERE hold_id = ?", (hold_id,)).fetchone()
+    if not row:
+        return None
+    user_id, amount = row
+    c.execute("DELETE FROM holds WHERE hold_id = ?", (hold_id,))
+    c.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (amount, user_id))
+    _log(c, user_id, amount, kind, hold_id)
+    return user_id, _select_credits(c, user_id)
+
+
+async def release_hold(hold_id: str) -> bool:
+    """Ошибка/модерация — возвращаем отложенные кредиты."""
+    try:
+        res = await _storage.write(lambda c: _return_hold(c, hold_id, "release"))
+    except StorageClosed:
+        # отменённый при остановке хендлер: резерв вернёт expire_holds при следующем запуске
+        log.warning("release_hold: БД уже закрыта, резерв %s вернётся по TTL", hold_id)
         return False
-    cursor.execute("UPDATE users SET credits = credits - ? WHERE user_id = ?", (n, user_id))
-    conn.commit()
-    return True
+    if res:
+        _invalidate(*res)
+    return res is not None
 
 
-def add_uses(user_id: int, count: int) -> None:
-    """Начислить пользователю N генераций (например, после оплаты)."""
-    _ensure_user_with_free_credits(user_id)
-    cursor.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (count, user_id))
-    conn.commit()
+async def expire_holds() -> int:
+    """Возвращает кредиты по истёкшим резервам (например, процесс упал посреди генерации)."""
+    def op(c):
+        ids = [r[0] for r in c.execute("SELECT hold_id FROM holds WHERE expires_at < ?", (time.time(),))]
+        return [r for r in (_return_hold(c, h, "expire") for h in ids) if r]
+    returned = await _storage.write(op)
+    for user_id, left in returned:
+        _invalidate(user_id, left)
+    if returned:
+        log.info("expire_holds: возвращено %d резервов", len(returned))
+    return len(returned)
+
+
+async def _sweep_holds_forever() -> None:
+    while True:
+        try:
+            await expire_holds()
+            await prune_rollup_active()
+        except Exception:
+            log.exception("expire_holds failed")
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL)
+
+
+# ───── состояние пользователя (key → value), общее для всех инстансов бота
+async def get_state(user_id: int, key: str) -> Optional[str]:
+    row = await _storage.read(lambda c: c.execute(
+        "SELECT value FROM user_state WHERE user_id = ? AND key = ?", (user_id, key)
+    ).fetchone())
+    return row[0] if row else None
+
+
+async def set_state(user_id: int, key: str, value: Optional[str]) -> None:
+    """value=None — удалить ключ."""
+    def op(c):
+        if value is None:
+            c.execute("DELETE FROM user_state WHERE user_id = ? AND key = ?", (user_id, key))
+        else:
+            c.execute(
+                "INSERT INTO user_state (user_id, key, value, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(user_id, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (user_id, key, value, time.time()),
+            )
+    await _storage.write(op)
+
+
+# ───── счета
+async def save_invoice(invoice_id: int, user_id: int, amount: float, generations: int) -> None:
+    def op(c):
+        now = time.time()
+        c.execute(
+            "INSERT OR IGNORE INTO invoices (invoice_id, user_id, amount, generations, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, 'active', ?, ?)",
+            (invoice_id, user_id, amount, generations, now, now),
+        )
+    await _storage.write(op)
+
+
+async def import_invoices(items: List[Tuple[int, int, float, int, str]]) -> int:
+    """
+    Счета, созданные до локального индекса: (invoice_id, user_id, amount, generations, created_at).
+    Уже зачисленные старым /check (есть в payments) не переносим. Возвращает число добавленных.
+    """
+    def op(c):
+        now = time.time()
+        added = 0
+        for invoice_id, user_id, amount, gens, created_at in items:
+            if c.execute("SELECT 1 FROM payments WHERE payment_id = ?", (str(invoice_id),)).fetchone():
+                continue
+            added += c.execute(
+                "INSERT OR IGNORE INTO invoices (invoice_id, user_id, amount, generations, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'active', ?, ?)",
+                (invoice_id, user_id, amount, gens, created_at, now),
+            ).rowcount
+        return added
+    return await _storage.write(op)
+
+
+async def pending_invoice_ids(user_id: Optional[int] = None) -> List[int]:
+    """Неоплаченные счета (все или одного пользователя) — по индексу, без сканирования истории."""
+    if user_id is None:
+        sql, args = "SELECT invoice_id FROM invoices WHERE status = 'active' ORDER BY invoice_id", ()
+    else:
+        sql, args = "SELECT invoice_id FROM invoices WHERE user_id = ? AND status = 'active'", (user_id,)
+    return await _storage.read(lambda c: [r[0] for r in c.execute(sql, args)])
+
+
+async def mark_invoice_paid(invoice_id: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Одной транзакцией: счёт → paid, запись в payments, начисление генераций.
+    Идемпотентно: повторный вызов (или платёж, уже записанный старым /check) вернёт None.
+    Иначе (user_id, generations, баланс).
+    """
+    def op(c):
+        row = c.execute(
+            "SELECT user_id, amount, generations FROM invoices WHERE invoice_id = ? AND status = 'active'",
+            (invoice_id,),
+        ).fetchone()
+        if not row:
+            return None
+        user_id, amount, gens = row
+        c.execute(
+            "UPDATE invoices SET status = 'paid', updated_at = ? WHERE invoice_id = ?",
+            (time.time(), invoice_id),
+        )
+        cur = c.execute(
+            "INSERT OR IGNORE INTO payments (payment_id, user_id, amount, confirmed) VALUES (?, ?, ?, 1)",
+            (str(invoice_id), user_id, amount),
+        )
+        if not cur.rowcount:
+            return None
+        _ensure_user(c, user_id)
+        c.execute("UPDATE users SET credits = credits + ? WHERE user_id = ?", (gens, user_id))
+        _log(c, user_id, gens, "topup", str(invoice_id))
+        first = c.execute("SELECT COUNT(*) FROM payments WHERE user_id = ?", (user_id,)).fetchone()[0] == 1
+        _rollup(c, time.time(), "topup", "first" if first else "repeat", credits=gens, amount=amount)
+        return user_id, gens, _select_credits(c, user_id)
+    res = await _storage.write(op)
+    if res:
+        _invalidate(res[0], res[2])
+        _paying.add(res[0])
+    return res
+
+
+async def mark_invoice_status(invoice_id: int, status: str) -> None:
+    def op(c):
+        c.execute(
+            "UPDATE invoices SET status = ?, updated_at = ? WHERE invoice_id = ? AND status = 'active'",
+            (status, time.time(), invoice_id),
+        )
+    await _storage.write(op)
+
+
+# ───── служебные отметки
+async def get_meta(key: str) -> Optional[str]:
+    row = await _storage.read(lambda c: c.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone())
+    return row[0] if row else None
+
+
+async def set_meta(key: str, value: str) -> None:
+    await _storage.write(lambda c: c.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value),
+    ))
+
+
+# ───── заблокированные модерацией промпты
+async def save_blocked(fingerprint: str, scope: str, simhash: int, categories: str, expires_at: float) -> None:
+    def op(c):
+        c.execute(
+            "INSERT INTO blocked_prompts (fingerprint, scope, simhash, categories, created_at, expires_at)"
+            " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(fingerprint) DO UPDATE SET"
+            " categories = excluded.categories, expires_at = excluded.expires_at",
+            (fingerprint, scope, simhash, categories, time.time(), expires_at),
+        )
+    await _storage.write(op)
+
+
+async def load_blocked() -> List[Tuple[str, str, int, str, float]]:
+    """Неистёкшие записи (fingerprint, scope, simhash, categories, expires_at); истёкшие удаляются."""
+    now = time.time()
+    await _storage.write(lambda c: c.execute("DELETE FROM blocked_prompts WHERE expires_at <= ?", (now,)))
+    return await _storage.read(lambda c: c.execute(
+        "SELECT fingerprint, scope, simhash, categories, expires_at FROM blocked_prompts WHERE expires_at > ?", (now,)
+    ).fetchall())
+
+
+async def delete_blocked(fingerprints: Optional[List[str]] = None) -> int:
+    """fingerprints=None — очистить всё. Возвращает число удалённых записей."""
+    def op(c):
+        if fingerprints is None:
+            return c.execute("DELETE FROM blocked_prompts").rowcount
+        return c.executemany("DELETE FROM blocked_prompts WHERE fingerprint = ?", [(f,) for f in fingerprints]).rowcount
+    return await _storage.write(op)
+
+
+# ───── аналитика: журнал событий + сводки, которые обновляются в той же транзакции
+ROLLUP_PERIODS = (("h", 3600), ("d", 86400))  # корзины по UTC
+# сколько помним «уже активен в этой корзине»: события пишутся текущим временем, старые корзины не нужны
+ROLLUP_ACTIVE_KEEP = {"h": 2 * 3600, "d": 2 * 86400}
+
+
+def _rollup(conn: sqlite3.Connection, ts: float, op: str, outcome: str, latency: float = 0.0,
+            credits: int = 0, amount: float = 0.0, periods=ROLLUP_PERIODS) -> None:
+    for period, width in periods:
+        conn.execute(
+            "INSERT INTO rollups (period, bucket, op, outcome, count, latency_sum, latency_max, credits, amount)"
+            " VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?) ON CONFLICT(period, bucket, op, outcome) DO UPDATE SET"
+            " count = count + 1, latency_sum = latency_sum + excluded.latency_sum,"
+            " latency_max = MAX(latency_max, excluded.latency_max),"
+            " credits = credits + excluded.credits, amount = amount + excluded.amount",
+            (period, int(ts // width * width), op, outcome, latency, latency, credits, amount),
+        )
+
+
+async def record_event(user_id: int, op: str, outcome: str, latency: float, size: Optional[str] = None,
+                       quality: Optional[str] = None, category: Optional[str] = None, credits: int = 0) -> None:
+    """Генерация/правка/варианты: строка в events и +1 в часовой и дневной сводке."""
+    def op_(c):
+        ts = time.time()
+        c.execute(
+            "INSERT INTO events (ts, user_id, op, size, quality, latency, outcome, category, credits)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (ts, user_id, op, size, quality, latency, outcome, category, credits),
+        )
+        _rollup(c, ts, op, outcome, latency, credits)
+        # «активные» — уникальные пользователи в каждой корзине отдельно: первый раз за час и первый раз за день
+        for period, width in ROLLUP_PERIODS:
+            if c.execute(
+                "INSERT OR IGNORE INTO rollup_active (period, bucket, user_id) VALUES (?, ?, ?)",
+                (period, int(ts // width * width), user_id),
+            ).rowcount:
+                _rollup(c, ts, "active", "", periods=((period, width),))
+    await _storage.write(op_)
+
+
+async def read_rollups(period: str, since: float) -> List[Tuple]:
+    """(bucket, op, outcome, count, latency_sum, latency_max, credits, amount) — только из сводок."""
+    return await _storage.read(lambda c: c.execute(
+        "SELECT bucket, op, outcome, count, latency_sum, latency_max, credits, amount FROM rollups"
+        " WHERE period = ? AND bucket >= ? ORDER BY bucket, op, outcome",
+        (period, int(since)),
+    ).fetchall())
+
+
+async def prune_rollup_active() -> None:
+    now = time.time()
+    await _storage.write(lambda c: c.executemany(
+        "DELETE FROM rollup_active WHERE period = ? AND bucket < ?",
+        [(period, now - keep) for period, keep in ROLLUP_ACTIVE_KEEP.items()],
+    ))
 
 
-def is_payment_recorded(payment_id: str) -> bool:
-    cursor.execute("SELECT 1 FROM payments WHERE payment_id = ?", (payment_id,))
-    return cursor.fetchone() is not None
+# ───── платящие пользователи (для приоритета в очереди)
+_paying: set = set()
 
 
-def record_payment(payment_id: str, user_id: int, amount: float) -> None:
-    cursor.execute(
-        "INSERT OR IGNORE INTO payments (payment_id, user_id, amount, confirmed) VALUES (?, ?, ?, 1)",
-        (payment_id, user_id, amount),
+async def is_paying_user(user_id: int) -> bool:
+    """Был ли у пользователя хотя бы один подтверждённый платёж."""
+    if user_id in _paying:
+        return True
+    found = await _storage.read(
+        lambda c: c.execute("SELECT 1 FROM payments WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
     )
-    conn.commit()
\ No newline at end of file
+    if found:
+        _paying.add(user_id)
+    return found
@@ -0,0 +1,284 @@
+# downloads.py
+import asyncio
+import logging
+import mmap
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import aiohttp
+
+import config
+from imaging import ImageError
+from metrics import Counter
+from singleflight import inflight
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_DIR = getattr(config, "DOWNLOAD_DIR", "cache/downloads")
+DOWNLOAD_DISK_BYTES = int(getattr(config, "DOWNLOAD_DISK_BYTES", 512 * 1024 * 1024))
+DOWNLOAD_MAX_BYTES = int(getattr(config, "DOWNLOAD_MAX_BYTES", 20 * 1024 * 1024))  # больше Bot API и не отдаёт
+DOWNLOAD_TTL = float(getattr(config, "DOWNLOAD_TTL", 24 * 3600))
+DOWNLOAD_TIMEOUT = 120.0
+CHUNK_SIZE = 256 * 1024
+MAX_ALIASES = 100_000
+
+downloads_total = Counter("bot_downloads_total", "Загрузки файлов из Telegram", ("result",))
+
+
+def too_large(size: Optional[int]) -> bool:
+    return bool(size) and size > DOWNLOAD_MAX_BYTES
+
+
+def _too_large_error() -> ImageError:
+    return ImageError(f"Файл слишком большой: максимум {DOWNLOAD_MAX_BYTES // (1024 * 1024)} МБ.")
+
+
+class _Entry:
+    __slots__ = ("size", "created", "view")
+
+    def __init__(self, size: int, created: float):
+        self.size = size
+        self.created = created
+        self.view: Optional[mmap.mmap] = None
+
+
+class Downloads:
+    """
+    Файлы от пользователей (фото, документы, маски) — один раз на диск, дальше отовсюду из кеша.
+    - ключ — file_unique_id: пересланная или повторно присланная картинка не качается заново
+      (file_id у каждой пересылки свой, поэтому держим ещё и отображение file_id → file_unique_id);
+    - размер проверяется до скачивания (по file_size из апдейта и из getFile);
+    - тело идёт потоком прямо во временный файл, без сборки целиком в памяти;
+    - одновременные запросы одного файла ждут одну загрузку (singleflight);
+    - наружу отдаётся mmap файла (read-only), а не свежая копия bytes.
+    Бюджет диска — LRU по DOWNLOAD_DISK_BYTES, запись живёт не дольше DOWNLOAD_TTL.
+    """
+
+    def __init__(self, root: str = DOWNLOAD_DIR, max_bytes: int = DOWNLOAD_DISK_BYTES, ttl: float = DOWNLOAD_TTL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._index: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()  # file_id → file_unique_id
+        self._total = 0
+
+    def _path(self, unique_id: str) -> str:
+        return os.path.join(self.root, f"{unique_id}.bin")
+
+    # ── загрузка индекса при старте
+    def _scan(self) -> list:
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".tmp"):
+                # недокачанное прошлым процессом
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(".bin"):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append((st.st_atime, name[:-4], _Entry(st.st_size, st.st_mtime)))
+        found.sort(key=lambda x: x[0])
+        return [(key, e) for _, key, e in found]
+
+    async def load(self) -> None:
+        entries = await asyncio.to_thread(self._scan)
+        self._index.clear()
+        self._total = 0
+        for key, e in entries:
+            self._index[key] = e
+            self._total += e.size
+        await self._evict()
+        log.info("Downloads: %d files, %.1f MB", len(self._index), self._total / 1e6)
+
+    # ── чтение
+    def _alias(self, file_id: str, unique_id: str) -> None:
+        self._aliases[file_id] = unique_id
+        self._aliases.move_to_end(file_id)
+        if len(self._aliases) > MAX_ALIASES:
+            self._aliases.popitem(last=False)
+
+    async def _lookup(self, unique_id: str) -> Optional[mmap.mmap]:
+        """Файл с диска; stat и mmap — в потоке (уже отображённый отдаётся без обращения к диску)."""
+        e = self._index.get(unique_id)
+        if e is None:
+            e = await self._probe(unique_id)
+        if e is None:
+            return None
+        if self.ttl and time.time() - e.created > self.ttl:
+            await self._drop(unique_id)
+            return None
+        if e.view is None:
+            try:
+                view = await asyncio.to_thread(self._map, self._path(unique_id))
+            except (OSError, ValueError):
+                await self._drop(unique_id)
+                return None
+            if self._index.get(unique_id) is not e:
+                return view  # пока отображали, запись вытеснили/заменили — отдаём, но не запоминаем
+            e.view = e.view or view
+        self._index.move_to_end(unique_id)
+        return e.view
+
+    @staticmethod
+    def _map(path: str) -> mmap.mmap:
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def _probe(self, unique_id: str) -> Optional[_Entry]:
+        """Промах по индексу: файл мог скачать другой инстанс на этом же диске."""
+        try:
+            st = await asyncio.to_thread(os.stat, self._path(unique_id))
+        except OSError:
+            return None
+        e = self._index.get(unique_id)
+        if e is not None:  # пока ждали stat, файл докачал этот же процесс
+            return e
+        e = _Entry(st.st_size, st.st_mtime)
+        self._index[unique_id] = e
+        self._total += e.size
+        return e
+
+    async def fetch(self, bot, file_id: str, unique_id: Optional[str] = None,
+                    size: Optional[int] = None) -> mmap.mmap:
+        """
+        Содержимое файла (mmap, только чтение). ImageError — если файл больше DOWNLOAD_MAX_BYTES.
+        unique_id и size — из апдейта (PhotoSize/Document), если есть: тогда повтор не стоит даже getFile.
+        """
+        if too_large(size):
+            downloads_total.inc("too_large")
+            raise _too_large_error()
+        unique_id = unique_id or self._aliases.get(file_id)
+        if unique_id:
+            self._alias(file_id, unique_id)
+            view = await self._lookup(unique_id)
+            if view is not None:
+                downloads_total.inc("hit")
+                return view
+        key = f"dl:{unique_id or file_id}"
+        if inflight.inflight(key):
+            downloads_total.inc("shared")
+        return await inflight.do(key, lambda: self._download(bot, file_id, unique_id))
+
+    async def _download(self, bot, file_id: str, unique_id: Optional[str]) -> mmap.mmap:
+        file = await bot.get_file(file_id)
+        if too_large(file.file_size):
+            downloads_total.inc("too_large")
+            raise _too_large_error()
+        unique_id = file.file_unique_id or unique_id or file_id
+        self._alias(file_id, unique_id)
+        view = await self._lookup(unique_id)
+        if view is not None:
+            # та же картинка под другим file_id (пересылка) — уже на диске
+            downloads_total.inc("hit")
+            return view
+        downloads_total.inc("miss")
+        path = self._path(unique_id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+        try:
+            size = await self._stream(bot, file.file_path, tmp)
+            if not size:
+                raise ImageError("Telegram отдал пустой файл — пришли его ещё раз.")
+            await asyncio.to_thread(os.replace, tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        old = self._index.pop(unique_id, None)
+        if old is not None:
+            self._total -= old.size
+        self._index[unique_id] = _Entry(size, time.time())
+        self._total += size
+        await self._evict()
+        view = await self._lookup(unique_id)
+        if view is None:
+            raise ImageError("Не удалось сохранить файл — попробуй ещё раз.")
+        return view
+
+    @staticmethod
+    async def _stream(bot, file_path: str, dest: str) -> int:
+        """Тело ответа — кусками в файл; обрываем, как только вышли за лимит (если file_size не было)."""
+        session = await bot.get_session()
+        written = 0
+        async with session.get(
+            bot.get_file_url(file_path),
+            timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT),
+            proxy=bot.proxy,
+            proxy_auth=bot.proxy_auth,
+            raise_for_status=True,
+        ) as response:
+            if too_large(response.content_length):
+                downloads_total.inc("too_large")
+                raise _too_large_error()
+            with open(dest, "wb") as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > DOWNLOAD_MAX_BYTES:
+                        downloads_total.inc("too_large")
+                        raise _too_large_error()
+                    f.write(chunk)
+        return written
+
+    def prefetch(self, bot, file_id: str, unique_id: Optional[str] = None, size: Optional[int] = None) -> None:
+        """Скачать заранее, в фоне (документ пришёл, а /edit будет позже)."""
+        if too_large(size):
+            return
+        task = asyncio.ensure_future(self.fetch(bot, file_id, unique_id, size))
+        task.add_done_callback(_log_failure)
+
+    # ── вытеснение (уже отданные mmap остаются валидными: файл удаляется, отображение живёт)
+    def _forget(self, unique_id: str) -> None:
+        e = self._index.pop(unique_id, None)
+        if e is not None:
+            self._total -= e.size
+            e.view = None
+
+    def _unlink(self, keys: list) -> None:
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    async def _drop(self, unique_id: str) -> None:
+        self._forget(unique_id)
+        await asyncio.to_thread(self._unlink, [unique_id])
+
+    async def _evict(self) -> None:
+        now = time.time()
+        victims = []
+        if self.ttl:
+            victims = [k for k, e in self._index.items() if now - e.created > self.ttl]
+        expired = set(victims)
+        total = self._total - sum(self._index[k].size for k in victims)
+        for k, e in self._index.items():  # от самых давно использованных
+            if total <= self.max_bytes:
+                break
+            if k in expired:
+                continue
+            victims.append(k)
+            total -= e.size
+        if victims:
+            for k in victims:
+                self._forget(k)
+            await asyncio.to_thread(self._unlink, victims)
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None and not isinstance(task.exception(), ImageError):
+        log.warning("Downloads: prefetch failed: %s", task.exception())
+
+
+downloads = Downloads()
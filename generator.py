@@ -1,10 +1,13 @@
 # generator.py
 import os
-import base64
+import asyncio
+import binascii
 import json
+import logging
+import random
 import re
-from io import BytesIO
-from typing import Optional, List, Tuple
+import time
+from typing import Awaitable, Callable, Optional, List
 
 # ───── конфиг
 try:
@@ -12,13 +15,21 @@ try:
     OPENAI_API_KEY = getattr(config, "OPENAI_API_KEY", None) or os.getenv("OPENAI_API_KEY")
     OPENAI_ORG_ID  = getattr(config, "OPENAI_ORG_ID", None)  or os.getenv("OPENAI_ORG_ID")
     OPENAI_HTTPS_PROXY = getattr(config, "OPENAI_HTTPS_PROXY", None) or os.getenv("OPENAI_HTTPS_PROXY") or os.getenv("HTTPS_PROXY")
+    OPENAI_API_KEYS = getattr(config, "OPENAI_API_KEYS", None) or os.getenv("OPENAI_API_KEYS")
+    OPENAI_BASE_URL = getattr(config, "OPENAI_BASE_URL", None) or os.getenv("OPENAI_BASE_URL")
 except Exception:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_ORG_ID  = os.getenv("OPENAI_ORG_ID")
     OPENAI_HTTPS_PROXY = os.getenv("OPENAI_HTTPS_PROXY") or os.getenv("HTTPS_PROXY")
+    OPENAI_API_KEYS = os.getenv("OPENAI_API_KEYS")
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY не найден. Укажи его в .env или config.py")
+from metrics import stage_seconds, api_errors_total
+from moderation import blocklist
+
+log = logging.getLogger(__name__)
+
+IMAGE_MODEL = "gpt-image-1"
 
 # ───── исключение для модерации
 class ModerationError(Exception):
@@ -27,24 +38,263 @@ class ModerationError(Exception):
         self.categories = categories
         self.raw = raw
 
-# ───── клиент OpenAI (SDK v1+ c httpx-прокси при необходимости)
-def _get_client() -> Tuple[str, object]:
+# ───── все ключи перегружены/недоступны (после ретраев)
+class ProviderUnavailable(Exception):
+    pass
+
+# ───── лимиты пула соединений
+def _cfg(name: str, default, cast: Callable = float):
+    """Настройка из config.py или окружения; кривое значение — предупреждение и значение по умолчанию."""
     try:
-        from openai import OpenAI
-        if OPENAI_HTTPS_PROXY:
-            import httpx
-            http_client = httpx.Client(proxies=OPENAI_HTTPS_PROXY, timeout=60)
-            return "new", OpenAI(api_key=OPENAI_API_KEY, organization=OPENAI_ORG_ID, http_client=http_client)
-        return "new", OpenAI(api_key=OPENAI_API_KEY, organization=OPENAI_ORG_ID)
+        import config  # type: ignore
+        val = getattr(config, name, None)
     except Exception:
-        import openai  # fallback для старого интерфейса
-        openai.api_key = OPENAI_API_KEY
-        if OPENAI_ORG_ID:
-            openai.organization = OPENAI_ORG_ID
-        # старый клиент читает HTTPS_PROXY из окружения автоматически
-        return "fallback", openai
-
-def _handle_moderation_and_reraise(e: Exception):
+        val = None
+    if val is None:
+        val = os.getenv(name)
+    if val is None:
+        return default
+    try:
+        return cast(val)
+    except (TypeError, ValueError):
+        log.warning("%s=%r не разобрать как %s, беру %r", name, val, cast.__name__, default)
+        return default
+
+OPENAI_MAX_CONNECTIONS = _cfg("OPENAI_MAX_CONNECTIONS", 32, int)
+OPENAI_MAX_KEEPALIVE = _cfg("OPENAI_MAX_KEEPALIVE", 16, int)
+OPENAI_KEEPALIVE_EXPIRY = _cfg("OPENAI_KEEPALIVE_EXPIRY", 60.0, float)
+OPENAI_CONNECT_TIMEOUT = _cfg("OPENAI_CONNECT_TIMEOUT", 10.0, float)
+OPENAI_TIMEOUT = _cfg("OPENAI_TIMEOUT", 180.0, float)
+OPENAI_MAX_ATTEMPTS = _cfg("OPENAI_MAX_ATTEMPTS", 4, int)
+OPENAI_BACKOFF_BASE = _cfg("OPENAI_BACKOFF_BASE", 0.5, float)
+OPENAI_BACKOFF_MAX = _cfg("OPENAI_BACKOFF_MAX", 10.0, float)
+OPENAI_BREAKER_THRESHOLD = _cfg("OPENAI_BREAKER_THRESHOLD", 5, int)
+OPENAI_BREAKER_COOLDOWN = _cfg("OPENAI_BREAKER_COOLDOWN", 30.0, float)
+# стриминг промежуточных картинок (partial_images): 0 — только обычный режим
+IMAGE_STREAM = _cfg("IMAGE_STREAM", 0, int)
+IMAGE_PARTIALS = _cfg("IMAGE_PARTIALS", 2, int)
+
+# колбэк превью: получает байты очередной промежуточной картинки
+OnPartial = Callable[[bytes], Awaitable[None]]
+
+def _b64decode(data: str) -> bytes:
+    """
+    base64 → bytes одной копией: a2b_base64 читает ASCII-строку из ответа SDK напрямую,
+    без промежуточного .encode() в b64decode (для PNG на 2–3 МБ — минус ещё 3–4 МБ на запрос).
+    """
+    return binascii.a2b_base64(data)
+
+# ───── пул ключей OpenAI поверх одного общего httpx.AsyncClient
+_http_client = None
+_pool = None
+
+def _build_http_client():
+    import httpx
+    limits = httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+    kwargs = {"limits": limits, "timeout": timeout}
+    if OPENAI_HTTPS_PROXY:
+        kwargs["proxy"] = OPENAI_HTTPS_PROXY
+    return httpx.AsyncClient(**kwargs)
+
+def _parse_key_specs() -> List[tuple]:
+    """
+    OPENAI_API_KEYS="key1|org1|base_url1,key2,key3|org3" — ключ, опционально организация и base URL.
+    Без него — один OPENAI_API_KEY / OPENAI_ORG_ID / OPENAI_BASE_URL.
+    """
+    specs = []
+    for item in (OPENAI_API_KEYS or "").split(","):
+        parts = [p.strip() or None for p in item.strip().split("|")]
+        if parts and parts[0]:
+            parts += [None] * (3 - len(parts))
+            specs.append(tuple(parts[:3]))
+    if not specs and OPENAI_API_KEY:
+        specs.append((OPENAI_API_KEY, OPENAI_ORG_ID, OPENAI_BASE_URL))
+    return specs
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """Заголовки x-ratelimit-reset-*: «1s», «6m0s», «250ms» → секунды."""
+    if not value:
+        return None
+    total = 0.0
+    for num, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        total += float(num) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total or None
+
+class _Provider:
+    """Один ключ/организация: свой AsyncOpenAI, учёт лимитов по заголовкам и circuit breaker."""
+
+    def __init__(self, api_key: str, org: Optional[str], base_url: Optional[str], http_client):
+        from openai import AsyncOpenAI
+        self.name = f"…{api_key[-4:]}" + (f"@{org}" if org else "")
+        # ретраи делаем сами — с переключением на другой ключ
+        self.client = AsyncOpenAI(
+            api_key=api_key, organization=org, base_url=base_url, http_client=http_client, max_retries=0
+        )
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.inflight = 0
+        self.failures = 0
+        self.blocked_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.blocked_until
+
+    def capacity(self, now: float) -> float:
+        if self.remaining is None or now >= self.reset_at:
+            return 1e9 - self.inflight  # лимиты неизвестны/сброшены — ключ «свободен»
+        return self.remaining - self.inflight
+
+    def observe(self, headers) -> None:
+        if not headers:
+            return
+        remaining, reset = None, None
+        for k, v in headers.items():
+            k = k.lower()
+            if k.startswith("x-ratelimit-remaining-"):
+                try:
+                    remaining = int(v) if remaining is None else min(remaining, int(v))
+                except ValueError:
+                    pass
+            elif k.startswith("x-ratelimit-reset-"):
+                r = _parse_reset(v)
+                if r is not None:
+                    reset = r if reset is None else max(reset, r)
+        if remaining is not None:
+            self.remaining = remaining
+            self.reset_at = time.monotonic() + (reset or 60.0)
+
+    def success(self) -> None:
+        self.failures = 0
+
+    def rate_limited(self, retry_after: Optional[float]) -> None:
+        self.remaining = 0
+        self.reset_at = time.monotonic() + (retry_after or 20.0)
+        self.blocked_until = self.reset_at
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= OPENAI_BREAKER_THRESHOLD:
+            # circuit breaker: ключ выключается на время, потом одна пробная попытка (half-open)
+            self.blocked_until = time.monotonic() + OPENAI_BREAKER_COOLDOWN
+            self.failures = OPENAI_BREAKER_THRESHOLD - 1
+            log.warning("OpenAI key %s: circuit open for %.0fs", self.name, OPENAI_BREAKER_COOLDOWN)
+
+class ProviderPool:
+    def __init__(self, specs: List[tuple], http_client):
+        self.providers = [_Provider(k, o, u, http_client) for k, o, u in specs]
+        self.latency: Optional[float] = None  # сглаженное время успешного вызова (EWMA), сек
+
+    def pick(self, tried: set) -> Optional[_Provider]:
+        now = time.monotonic()
+        ready = [p for p in self.providers if p.available(now) and p not in tried]
+        if not ready:
+            ready = [p for p in self.providers if p.available(now)]
+        if not ready:
+            return None
+        return max(ready, key=lambda p: (p.capacity(now), -p.inflight))
+
+    def observe_latency(self, took: float) -> None:
+        self.latency = took if self.latency is None else 0.8 * self.latency + 0.2 * took
+
+    def next_ready_in(self) -> float:
+        now = time.monotonic()
+        return max(0.0, min(p.blocked_until for p in self.providers) - now)
+
+    async def call(self, method: str, **kwargs):
+        """
+        Вызов images.<method> с выбором ключа по остатку лимита.
+        429/5xx/сеть → джиттер-бэкофф и другой ключ; модерацию не ретраим никогда.
+        """
+        import openai
+        tried: set = set()
+        last_exc: Optional[Exception] = None
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            provider = self.pick(tried)
+            if provider is None:
+                wait = self.next_ready_in()
+                if wait > OPENAI_BACKOFF_MAX:
+                    break
+                await asyncio.sleep(wait)
+                continue
+            tried.add(provider)
+            provider.inflight += 1
+            started = time.monotonic()
+            try:
+                raw = await getattr(provider.client.images.with_raw_response, method)(**kwargs)
+            except Exception as e:
+                if _moderation_error(e) is not None:
+                    provider.success()
+                    raise
+                last_exc = e
+                api_errors_total.inc("openai", type(e).__name__)
+                headers = getattr(getattr(e, "response", None), "headers", None)
+                provider.observe(headers)
+                if isinstance(e, openai.RateLimitError):
+                    provider.rate_limited(_parse_reset((headers or {}).get("retry-after", "") + "s"))
+                elif isinstance(e, (openai.APIConnectionError, openai.InternalServerError)) or (
+                    isinstance(e, openai.APIStatusError) and e.status_code >= 500
+                ):
+                    provider.failure()
+                else:
+                    raise  # 4xx и прочее — ретраи не помогут
+                log.warning("OpenAI %s via %s failed (%s), attempt %d", method, provider.name, type(e).__name__, attempt + 1)
+            else:
+                provider.observe(raw.headers)
+                provider.success()
+                if not kwargs.get("stream"):  # у стрима здесь только начало ответа, его меряет _stream_image
+                    self.observe_latency(time.monotonic() - started)
+                return raw.parse()
+            finally:
+                provider.inflight -= 1
+            cap = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, cap))  # full jitter
+        raise ProviderUnavailable(str(last_exc) if last_exc else "no OpenAI keys available")
+
+def configured() -> bool:
+    return bool(OPENAI_API_KEY or OPENAI_API_KEYS)
+
+def init_client():
+    """
+    Создаёт общий httpx-клиент и пул ключей (идемпотентно). Вызывается из main.on_startup
+    или лениво — первым запросом; без ключей — RuntimeError (импорт модуля ключей не требует).
+    """
+    global _http_client, _pool
+    if _pool is None:
+        if not configured():
+            raise RuntimeError("OPENAI_API_KEY не найден. Укажи его в .env или config.py")
+        _http_client = _build_http_client()
+        _pool = ProviderPool(_parse_key_specs(), _http_client)
+        log.info("OpenAI pool: %s", ", ".join(p.name for p in _pool.providers))
+    return _pool
+
+async def close_client() -> None:
+    """Закрывает пул соединений. Вызывается из main.on_shutdown."""
+    global _http_client, _pool
+    pool, http = _pool, _http_client
+    _pool = _http_client = None
+    if pool is not None:
+        for p in pool.providers:
+            await p.client.close()
+    if http is not None and not http.is_closed:
+        await http.aclose()
+
+def _get_pool() -> ProviderPool:
+    return _pool or init_client()
+
+def recent_latency() -> Optional[float]:
+    """Сглаженное время ответа OpenAI (для политики нагрузки в tiers.py)."""
+    return _pool.latency if _pool is not None else None
+
+def observe_latency(took: float) -> None:
+    """Время вызова, измеренное в другом процессе (воркеры, см. workqueue.py)."""
+    _get_pool().observe_latency(took)
+
+def _moderation_error(e: Exception) -> Optional[ModerationError]:
     s = str(e)
     if ("moderation_blocked" in s
         or "safety_violations" in s
@@ -61,47 +311,170 @@ def _handle_moderation_and_reraise(e: Exception):
             m = re.search(r"safety_violations=\[([^\]]+)\]", s)
             if m:
                 cats = [c.strip().strip("'\"") for c in m.group(1).split(",")]
-        raise ModerationError(categories=cats or [], raw=s)
+        return ModerationError(categories=cats or [], raw=s)
+    return None
+
+def _handle_moderation_and_reraise(e: Exception, prompt: str, image: Optional[bytes] = None):
+    me = _moderation_error(e)
+    if me is not None:
+        blocklist.remember(prompt, me.categories, image)
+        raise me
     raise e
 
+def check_blocked(prompt: str, image: Optional[bytes] = None) -> None:
+    """
+    Локальный пред-фильтр: тот же (или почти тот же) промпт уже блокировала модерация —
+    ModerationError сразу, без очереди и round trip к OpenAI.
+    """
+    hit = blocklist.check(prompt, image)
+    if hit is not None:
+        categories, match = hit
+        raise ModerationError(categories=categories, raw=f"prefilter:{match}")
+
+# ───── стриминг: промежуточные картинки по мере готовности
+_stream_disabled = False
+
+async def _stream_image(method: str, op: str, on_partial: OnPartial, **kwargs) -> Optional[bytes]:
+    """
+    images.<method>(stream=True, partial_images=N): каждую промежуточную картинку отдаём в on_partial,
+    возвращаем финальную. None — стриминг не удался до первого события, вызывающий идёт обычным
+    (не потоковым) путём. Оборвался после событий — генерация уже оплачена у OpenAI, повтор списал бы
+    её второй раз: ошибка пробрасывается. Модерация и ProviderUnavailable пробрасываются как есть.
+    """
+    global _stream_disabled
+    import openai
+    started = time.perf_counter()
+    final_b64 = None
+    received = False
+    try:
+        with stage_seconds.time(op, "openai"):
+            stream = await _get_pool().call(method, stream=True, partial_images=IMAGE_PARTIALS, **kwargs)
+            first = True
+            async for event in stream:
+                received = True
+                kind = getattr(event, "type", "") or ""
+                if kind.endswith("partial_image"):
+                    if first:
+                        stage_seconds.observe(time.perf_counter() - started, op, "first_partial")
+                        first = False
+                    try:
+                        await on_partial(_b64decode(event.b64_json))
+                    except Exception as e:
+                        log.debug("on_partial failed: %s", e)
+                elif kind.endswith("completed"):
+                    final_b64 = event.b64_json
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        if _moderation_error(e) is not None:
+            raise
+        api_errors_total.inc("openai", "stream_" + type(e).__name__)
+        if received:
+            log.warning("OpenAI stream %s broke after partials (%s), not retrying", method, type(e).__name__)
+            raise
+        if isinstance(e, openai.BadRequestError):
+            # напр. организация не верифицирована для стриминга — больше не пытаемся
+            _stream_disabled = True
+            log.warning("OpenAI streaming disabled: %s", e)
+        else:
+            log.warning("OpenAI stream %s failed (%s), falling back", method, type(e).__name__)
+        return None
+    if final_b64 is None:
+        if received:
+            raise RuntimeError("поток OpenAI закончился без финальной картинки")
+        log.warning("OpenAI stream %s ended without a completed event, falling back", method)
+        return None
+    _get_pool().observe_latency(time.perf_counter() - started)
+    with stage_seconds.time(op, "decode"):
+        return await asyncio.to_thread(_b64decode, final_b64)
+
+def _streaming(on_partial: Optional[OnPartial]) -> bool:
+    return on_partial is not None and bool(IMAGE_STREAM) and not _stream_disabled
+
+async def _decode_all(resp) -> List[bytes]:
+    """
+    Картинки ответа images.generate/edit: base64 декодируем в потоках (и для n=1 — это несколько МБ),
+    элементы без b64_json пропускаем.
+    """
+    return list(await asyncio.gather(
+        *(asyncio.to_thread(_b64decode, d.b64_json) for d in (resp.data or []) if getattr(d, "b64_json", None))
+    ))
+
 # ───── генерация с нуля
-def generate_image_bytes(prompt: str, size: str = "1024x1024") -> Optional[bytes]:
-    mode, cli = _get_client()
+# options — доп. параметры API (quality, output_format, output_compression), см. tiers.Render.options
+async def generate_image_bytes(
+    prompt: str, size: str = "1024x1024", on_partial: Optional[OnPartial] = None, **options
+) -> Optional[bytes]:
+    check_blocked(prompt)
+    if _streaming(on_partial):
+        try:
+            png = await _stream_image(
+                "generate", "generate", on_partial, model=IMAGE_MODEL, prompt=prompt, size=size, **options
+            )
+        except ProviderUnavailable:
+            raise
+        except Exception as e:
+            _handle_moderation_and_reraise(e, prompt)
+        if png is not None:
+            return png
+    images = await generate_images(prompt, size=size, n=1, op="generate", **options)
+    return images[0] if images else None
+
+async def generate_images(
+    prompt: str, size: str = "1024x1024", n: int = 1, op: str = "variants", **options
+) -> List[bytes]:
+    """
+    n картинок одним вызовом images.generate (один сетевой round trip вместо n).
+    base64 декодируем параллельно в потоках — event loop не держит мегабайты декодирования.
+    """
+    check_blocked(prompt)
     try:
-        resp = (cli.images.generate if mode == "new" else cli.images.generate)(
-            model="gpt-image-1",
-            prompt=prompt,
-            size=size
-        )
-        b64 = resp.data[0].b64_json
-        return base64.b64decode(b64)
+        kwargs = dict(options, n=n) if n > 1 else options
+        with stage_seconds.time(op, "openai"):
+            resp = await _get_pool().call(
+                "generate",
+                model=IMAGE_MODEL,
+                prompt=prompt,
+                size=size,
+                **kwargs
+            )
+        with stage_seconds.time(op, "decode"):
+            return await _decode_all(resp)
+    except ProviderUnavailable:
+        raise
     except Exception as e:
-        _handle_moderation_and_reraise(e)
+        _handle_moderation_and_reraise(e, prompt)
 
 # ───── редактирование
-def edit_image_bytes(
+async def edit_image_bytes(
     image_bytes: bytes,
     prompt: str,
     size: str = "1024x1024",
-    mask_bytes: Optional[bytes] = None
+    mask_bytes: Optional[bytes] = None,
+    on_partial: Optional[OnPartial] = None,
+    **options,
 ) -> Optional[bytes]:
-    mode, cli = _get_client()
-    img_bio = BytesIO(image_bytes); img_bio.name = "image.png"
-    mask_bio = None
+    check_blocked(prompt, image_bytes)
+    # файлы — кортежами (имя, байты, mime): при ретрае на другой ключ их не нужно «перематывать»
+    kwargs = dict(options)
     if mask_bytes:
-        mask_bio = BytesIO(mask_bytes); mask_bio.name = "mask.png"
+        kwargs["mask"] = ("mask.png", mask_bytes, "image/png")
     try:
-        if mode == "new":
-            if mask_bio:
-                resp = cli.images.edit(model="gpt-image-1", image=img_bio, mask=mask_bio, prompt=prompt, size=size)
-            else:
-                resp = cli.images.edit(model="gpt-image-1", image=img_bio, prompt=prompt, size=size)
-        else:
-            if mask_bio:
-                resp = cli.images.edit(model="gpt-image-1", image=img_bio, mask=mask_bio, prompt=prompt, size=size)
-            else:
-                resp = cli.images.edit(model="gpt-image-1", image=img_bio, prompt=prompt, size=size)
-        b64 = resp.data[0].b64_json
-        return base64.b64decode(b64)
+        if _streaming(on_partial):
+            png = await _stream_image(
+                "edit", "edit", on_partial,
+                model=IMAGE_MODEL, image=("image.png", image_bytes, "image/png"), prompt=prompt, size=size, **kwargs
+            )
+            if png is not None:
+                return png
+        with stage_seconds.time("edit", "openai"):
+            resp = await _get_pool().call(
+                "edit", model=IMAGE_MODEL, image=("image.png", image_bytes, "image/png"), prompt=prompt, size=size, **kwargs
+            )
+        with stage_seconds.time("edit", "decode"):
+            images = await _decode_all(resp)
+            return images[0] if images else None
+    except ProviderUnavailable:
+        raise
     except Exception as e:
-        _handle_moderation_and_reraise(e)
\ No newline at end of file
+        _handle_moderation_and_reraise(e, prompt, image_bytes)
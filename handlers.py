@@ -1,18 +1,56 @@
 # handlers.py
+import asyncio
+import base64
+import binascii
+import csv
+import hashlib
+import io
+import json
+import logging
+import time
+from datetime import datetime, timezone
 from io import BytesIO
-from aiogram import Dispatcher, types
+from typing import Dict, List, Optional
+import aiohttp
+from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
-from generator import generate_image_bytes, edit_image_bytes, ModerationError
+from aiogram.utils.exceptions import TelegramAPIError
+from generator import check_blocked, ModerationError, ProviderUnavailable, IMAGE_MODEL
+import workqueue
+# GEN_BACKEND=workers: вызовы OpenAI и декодирование — в процессах worker.py, здесь только ожидание
+if workqueue.enabled():
+    from workqueue import generate_image_bytes, generate_images, edit_image_bytes
+else:
+    from generator import generate_image_bytes, generate_images, edit_image_bytes
+from moderation import blocklist
+from cache import result_cache, make_key
 from database import (
-    has_credits, consume_credit, get_credits,
-    is_payment_recorded, record_payment, add_uses,
+    get_credits, reserve_credits, commit_hold, release_hold,
+    is_paying_user, pending_invoice_ids, get_state, set_state, record_event, read_rollups,
 )
-from payment import create_invoice, cryptopay
+from jobs import queue as gen_queue, Job, QueueFullError
+from sessions import sessions
+from downloads import downloads, too_large, DOWNLOAD_MAX_BYTES
+from imaging import prepare_edit_inputs, encode_delivery, image_ext, ImageError
+from outbox import outbox, Status, Preview
+import tiers
+from antiflood import AntiFlood
+from lifecycle import lifecycle, Draining
+from payment import create_invoice, import_legacy_invoices, refresh_invoices
+from metrics import stage_seconds, requests_total, cache_total, moderation_total, upload_bytes_total, api_errors_total
 from config import ADMIN_IDS
+import config
 
-# Память последних изображений (на проде лучше хранить в БД/кеше)
-LAST_PHOTO: dict[int, bytes] = {}
-LAST_MASK: dict[int, bytes] = {}
+log = logging.getLogger(__name__)
+
+# сбои при получении фото/маски из Telegram: getFile, обрыв/таймаут скачивания, диск кеша загрузок
+_FETCH_ERRORS = (TelegramAPIError, aiohttp.ClientError, asyncio.TimeoutError, OSError)
+_FETCH_FAILED = "⚠️ Не получилось скачать фото из Telegram — пришли его ещё раз или повтори чуть позже."
+
+VARIANTS_MAX = int(getattr(config, "VARIANTS_MAX", 4))
+VARIANTS_DEFAULT = int(getattr(config, "VARIANTS_DEFAULT", 4))
+
+# Последние фото/маски — в SessionStore (бюджет памяти, TTL, вытеснение на диск)
 
 # ── утилиты
 def _humanize_categories(cats):
@@ -31,29 +69,336 @@ def _humanize_categories(cats):
         return "контент, нарушающий правила безопасности"
     return ", ".join(mapping.get(c, c) for c in cats)
 
-async def _ensure_quota_or_pay(message: types.Message, is_admin: bool) -> bool:
+async def _reserve_or_pay(message: types.Message, is_admin: bool, n: int = 1):
+    """
+    Откладывает n кредитов под генерацию. Возвращает (можно_генерировать, hold_id).
+    У админа резерва нет (hold_id=None); при нехватке — предлагаем пополнить.
+    """
     if is_admin:
-        return True
-    if has_credits(message.from_user.id):
-        return True
+        return True, None
+    hold_id = await reserve_credits(message.from_user.id, n)
+    if hold_id:
+        return True, hold_id
     keyboard = InlineKeyboardMarkup().add(
         InlineKeyboardButton("Пополнить 1 TON (10 генераций)", callback_data="pay_now")
     )
-    await message.answer(
-        "⚠️ У тебя закончились генерации. Пополни баланс, чтобы продолжить:",
-        reply_markup=keyboard
+    text = (
+        "⚠️ У тебя закончились генерации. Пополни баланс, чтобы продолжить:" if n == 1
+        else f"⚠️ Не хватает генераций: нужно {n}. Пополни баланс, чтобы продолжить:"
+    )
+    await outbox.answer(message, text, reply_markup=keyboard)
+    return False, None
+
+def _submit(user_id: int, factory, priority: bool, op: str) -> Job:
+    submitted = time.perf_counter()
+
+    async def timed():
+        stage_seconds.observe(time.perf_counter() - submitted, op, "queue")
+        return await factory()
+
+    return gen_queue.submit(user_id, timed, priority=priority)
+
+async def _wait_queued(status: Status, job: Job):
+    """Ждёт задачу очереди, показывая позицию в сообщении «⏳» (у каждого ждущего — своё)."""
+    base_text = status.text
+    while True:
+        pos = gen_queue.position(job)
+        # статус правим на месте; при перегрузке такие правки отбрасываются первыми
+        await status.update(base_text + (f"\n👥 Позиция в очереди: {pos}" if pos > 0 else ""))
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout=5)
+        except asyncio.TimeoutError:
+            continue
+
+async def _run_queued(message: types.Message, status: Status, factory, is_admin: bool, op: str):
+    """
+    Ставит генерацию в общую очередь и ждёт результат,
+    показывая позицию в очереди в сообщении «⏳».
+    """
+    user_id = message.from_user.id
+    priority = is_admin or await is_paying_user(user_id)
+    job = _submit(user_id, factory, priority, op)
+    try:
+        return await _wait_queued(status, job)
+    except asyncio.CancelledError:
+        job.future.cancel()
+        raise
+
+
+class _Shared:
+    """
+    Одна генерация на одинаковые запросы «в полёте»: задача очереди общая,
+    а статус и черновики у каждого ждущего свои. Кредиты каждый списывает сам.
+    """
+
+    __slots__ = ("job", "previews", "latest")
+
+    def __init__(self):
+        self.job: Optional[Job] = None
+        self.previews: List[Preview] = []
+        self.latest: Optional[bytes] = None  # последний кадр — сразу показываем присоединившемуся
+
+    async def show(self, data: bytes) -> None:
+        self.latest = data
+        for preview in list(self.previews):
+            await preview.show(data)
+
+    async def join(self, preview: Preview) -> None:
+        self.previews.append(preview)
+        if self.latest is not None:
+            await preview.show(self.latest)
+
+
+_shared: Dict[str, _Shared] = {}
+
+def _forget_shared(key: str, shared: _Shared) -> None:
+    if _shared.get(key) is shared:
+        del _shared[key]
+
+async def _cached_or_run(message: types.Message, status: Status, preview: Preview, key: str, factory,
+                         is_admin: bool, use_cache: bool = True, op: str = "generate"):
+    """
+    Результат из кеша (file_id или байты) либо новая генерация через очередь.
+    factory(on_partial) — вызов OpenAI с обработчиком промежуточных картинок.
+    Возвращает (png_bytes, file_id) — заполнено хотя бы одно, если всё удалось.
+    """
+    if not use_cache:
+        # «Перегенерировать» — заведомо новый вызов: не склеиваем и не кешируем
+        return await _run_queued(message, status, lambda: factory(preview.show), is_admin, op), None
+
+    entry = await result_cache.get(key)
+    if entry is not None:
+        if entry.file_id:
+            cache_total.inc("file_id")
+            return None, entry.file_id
+        cached = await result_cache.read(entry)
+        if cached:
+            cache_total.inc("disk")
+            return cached, None
+    cache_total.inc("miss")
+
+    user_id = message.from_user.id
+    priority = is_admin or await is_paying_user(user_id)
+    shared = _shared.get(key)
+    if shared is None:
+        shared = _Shared()
+
+        async def produce():
+            png = await factory(shared.show)
+            if png:
+                await result_cache.put(key, png)
+            return png
+
+        # QueueFullError — до регистрации: следующий одинаковый запрос попробует поставить свою
+        shared.job = _submit(user_id, produce, priority, op)
+        _shared[key] = shared
+        shared.job.future.add_done_callback(lambda _f: _forget_shared(key, shared))
+    elif priority:
+        # платящий присоединился к чужой бесплатной генерации — она идёт его уровнем
+        gen_queue.promote(shared.job)
+    await shared.join(preview)
+    try:
+        return await _wait_queued(status, shared.job), None
+    finally:
+        shared.previews.remove(preview)
+        # ушли все ждущие — ещё не начатую задачу снимаем с очереди
+        if not shared.previews and not shared.job.future.done():
+            shared.job.future.cancel()
+
+async def _remember_request(user_id: int, op: str, prompt: str):
+    """Последний запрос — для кнопки «Перегенерировать» (в общей БД, доступен любому инстансу)."""
+    await set_state(user_id, "last_request", json.dumps({"op": op, "prompt": prompt}, ensure_ascii=False))
+
+def _job_entry(message: types.Message, op: str, prompt: str, **extra) -> dict:
+    """Всё, что нужно, чтобы повторить запрос после рестарта (для правок — source: file_id/ключи фото и маски)."""
+    return dict(extra, op=op, prompt=prompt, user_id=message.from_user.id, chat_id=message.chat.id,
+                message_id=message.message_id)
+
+async def _defer_if_draining(message: types.Message, op: str, prompt: str, **extra) -> bool:
+    """Бот останавливается: новый запрос не начинаем, а кладём в журнал — его выполнит следующий запуск."""
+    if not lifecycle.draining:
+        return False
+    await lifecycle.defer(_job_entry(message, op, prompt, **extra))
+    await outbox.answer(message, "🔄 Бот перезапускается — выполню запрос сразу после старта.")
+    return True
+
+async def _begin_or_defer(message: types.Message, hold, op: str, prompt: str, **extra) -> Optional[int]:
+    """
+    Регистрирует генерацию в lifecycle сразу после резерва. Остановка началась, пока шёл резерв
+    (drain уже снял снимок) — резерв возвращаем, запрос в журнал, как в _defer_if_draining.
+    """
+    entry = _job_entry(message, op, prompt, **extra)
+    try:
+        return lifecycle.begin(entry)
+    except Draining:
+        pass
+    if hold:
+        await release_hold(hold)
+    await lifecycle.defer(entry)
+    await outbox.answer(message, "🔄 Бот перезапускается — выполню запрос сразу после старта.")
+    return None
+
+async def resume_job(bot, entry: dict):
+    """Повтор запроса из журнала прошлого процесса (lifecycle.resume): кредиты резервируются заново."""
+    Bot.set_current(bot)
+    message = types.Message(**{
+        "message_id": entry.get("message_id") or 0,
+        "date": int(entry.get("ts") or time.time()),
+        "chat": {"id": entry["chat_id"], "type": "private"},
+        "from": {"id": entry["user_id"], "is_bot": False, "first_name": ""},
+    })
+    op, prompt = entry["op"], entry["prompt"]
+    await outbox.answer(message, "♻️ Бот перезапускался — продолжаю твой запрос.")
+    if op == "generate":
+        await _generate_from_prompt(message, prompt, use_cache=entry.get("use_cache", True))
+    elif op == "edit":
+        await _edit_last_photo(message, prompt, use_cache=entry.get("use_cache", True), source=entry.get("source"))
+    elif op == "variants":
+        await _generate_variants(message, prompt, int(entry.get("n") or VARIANTS_DEFAULT))
+    else:
+        log.warning("resume_job: unknown op %r", op)
+
+def _status_text(text: str, render: tiers.Render, is_admin: bool) -> str:
+    if is_admin:
+        text += " (режим админа)"
+    if render.degraded:
+        text += "\n⚡ Сейчас высокая нагрузка — делаю в быстром режиме (списывается по его цене)."
+    return text
+
+def _original_token(key: str) -> str:
+    """Ключ кеша (sha256 hex, 64 символа) в callback_data не влезает с префиксом — base64url, 43 символа."""
+    return base64.urlsafe_b64encode(bytes.fromhex(key)).rstrip(b"=").decode()
+
+def _original_key(token: str):
+    try:
+        return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).hex() or None
+    except (ValueError, binascii.Error):
+        return None
+
+def _original_button(key: str, label: str = "📎 Оригинал без сжатия") -> InlineKeyboardButton:
+    return InlineKeyboardButton(label, callback_data=f"png:{_original_token(key)}")
+
+def _regen_keyboard(variants: bool = False, undo: bool = False, key: str = None) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup().add(
+        InlineKeyboardButton("🔄 Перегенерировать", callback_data="regen")
+    )
+    if key:
+        keyboard.add(_original_button(key))
+    if variants:
+        keyboard.add(InlineKeyboardButton(f"🎲 Ещё варианты ×{VARIANTS_DEFAULT}", callback_data="variants"))
+    if undo:
+        keyboard.add(InlineKeyboardButton("↩️ Отменить правку", callback_data="undo"))
+    return keyboard
+
+async def _send_result(message: types.Message, key: str, png_bytes, file_id, caption: str, op: str = "generate",
+                       preview: Preview = None):
+    """
+    Отправляет результат и запоминает его file_id в кеше — следующий хит уйдёт без аплоада.
+    Если по ходу генерации показывался черновик (preview), финальная картинка встаёт на его место.
+    """
+    sent = None
+    keyboard = _regen_keyboard(variants=op == "generate", undo=op == "edit", key=key)
+    with stage_seconds.time(op, "upload"):
+        if preview is not None and png_bytes:
+            photo, ext = await encode_delivery(png_bytes)
+            sent = await preview.finish(photo, caption, reply_markup=keyboard, filename=f"image.{ext}")
+        if sent is None and file_id:
+            try:
+                sent = await outbox.answer_photo(
+                    message, photo=file_id, caption=caption, reply_markup=keyboard
+                )
+            except Exception:
+                entry = await result_cache.get(key)
+                png_bytes = await result_cache.read(entry) if entry else None
+                if not png_bytes:
+                    raise
+        if sent is None:
+            sent = await _send_image(message, png_bytes, caption, reply_markup=keyboard)
+    if preview is not None:
+        preview.first_pixel()
+    if sent and sent.photo:
+        # сжатая копия — только для переотправки; оригинал остаётся в кеше под key
+        await result_cache.set_file_id(key, sent.photo[-1].file_id)
+    return sent
+
+async def _chain_edit(user_id: int, sent, key: str, png_bytes, prompt: str):
+    """
+    Результат правки — новое текущее фото: следующий /edit продолжит с оригинала без сжатия
+    (кеш результатов по key), а file_id отправленного сообщения — только для показа в /undo.
+    """
+    if sent and sent.photo:
+        await sessions.push_version(user_id, sent.photo[-1].file_id, png_bytes, prompt, result_key=key)
+
+async def _send_image(message: types.Message, png_bytes: bytes, caption: str = "", reply_markup=None):
+    """Фото уходит сжатой копией (JPEG/WebP); PNG-оригинал лежит в кеше результатов — по кнопке."""
+    photo, ext = await encode_delivery(png_bytes)
+    upload_bytes_total.inc("photo", n=len(photo))
+    return await outbox.answer_photo(
+        message, photo=InputFile(BytesIO(photo), filename=f"image.{ext}"), caption=caption, reply_markup=reply_markup
+    )
+
+async def _send_album(message: types.Message, images: list, caption: str):
+    """Несколько картинок одним альбомом (sendMediaGroup) — один вызов Telegram вместо n."""
+    # оригиналы — в кеш результатов по содержимому: альбом кнопок не несёт, они уходят отдельным сообщением
+    keys = [hashlib.sha256(png).hexdigest() for png in images]
+    await asyncio.gather(*(result_cache.put(k, png) for k, png in zip(keys, images)))
+    if len(images) == 1:
+        return await _send_image(message, images[0], caption, reply_markup=_regen_keyboard(True, key=keys[0]))
+    encoded = await asyncio.gather(*(encode_delivery(png) for png in images))
+    media = types.MediaGroup()
+    for i, (photo, ext) in enumerate(encoded):
+        upload_bytes_total.inc("photo", n=len(photo))
+        media.attach_photo(InputFile(BytesIO(photo), filename=f"variant_{i + 1}.{ext}"), caption=caption if i == 0 else None)
+    sent = await outbox.answer_media_group(message, media)
+    keyboard = InlineKeyboardMarkup(row_width=len(keys)).add(
+        *(_original_button(k, f"📎 {i + 1}") for i, k in enumerate(keys))
     )
-    return False
+    await outbox.answer(message, "Оригиналы без сжатия (PNG):", reply_markup=keyboard)
+    return sent
+
+async def _send_original(query: types.CallbackQuery, token: str):
+    """Кнопка «Оригинал без сжатия»: PNG из кеша результатов документом (повторно — по file_id)."""
+    key = _original_key(token)
+    entry = await result_cache.get(key) if key else None
+    data = None
+    if entry is not None and not entry.doc_file_id:
+        data = await result_cache.read(entry)
+    if entry is None or not (entry.doc_file_id or data):
+        await query.answer("Оригинал уже удалён из кеша — перегенерируй картинку 🔄", show_alert=True)
+        return
+    await query.answer()
+    if entry.doc_file_id:
+        try:
+            await outbox.answer_document(query.message, document=entry.doc_file_id)
+            return
+        except Exception:
+            data = await result_cache.read(entry)
+            if not data:
+                return
+    upload_bytes_total.inc("original", n=len(data))
+    with stage_seconds.time("original", "upload"):
+        sent = await outbox.answer_document(
+            query.message, document=InputFile(BytesIO(data), filename=f"original.{image_ext(data)}")
+        )
+    if sent and sent.document:
+        await result_cache.set_file_id(key, sent.document.file_id, document=True)
 
-async def _send_png(message: types.Message, png_bytes: bytes, caption: str = ""):
-    bio = BytesIO(png_bytes)
-    bio.name = "image.png"
-    await message.answer_photo(photo=InputFile(bio, filename="image.png"), caption=caption)
+async def _track(user_id: int, op: str, outcome: str, started: float, render: tiers.Render,
+                 category: str = None, spent: int = 0):
+    """Итог запроса: метрики процесса + событие в БД (сводки для /stats)."""
+    latency = time.perf_counter() - started
+    stage_seconds.observe(latency, op, "total")
+    requests_total.inc(op, outcome)
+    try:
+        await record_event(user_id, op, outcome, latency, render.size, render.quality.name, category, spent)
+    except Exception as e:
+        log.warning("record_event failed: %s", e)
 
 # ── команды
 async def start_handler(message: types.Message):
-    left = get_credits(message.from_user.id)
-    await message.answer(
+    left = await get_credits(message.from_user.id)
+    await outbox.answer(
+        message,
         "👋 Привет! Я — AI-бот для генерации и редактирования изображений.\n\n"
         "🖼 Сгенерировать с нуля: просто пришли текст-описание.\n"
         "✏️ Редактировать: пришли фото (по желанию — PNG-маску как Документ), затем /edit \"описание правок\".\n"
@@ -63,13 +408,16 @@ async def start_handler(message: types.Message):
         "/check — проверить оплату\n"
         "/balance — остаток генераций\n"
         "/edit \"описание правок\" — отредактировать последнее фото (учту маску)\n"
+        f"/variants {VARIANTS_DEFAULT} \"описание\" — несколько вариантов одним альбомом\n"
+        "/undo, /history — откат и история правок (каждая правка продолжает предыдущую)\n"
+        "/quality — качество и формат картинки\n"
         "/clear — забыть сохранённые фото/маску\n\n"
         f"🎁 Бесплатные генерации: {left}"
     )
 
 async def balance_handler(message: types.Message):
-    left = get_credits(message.from_user.id)
-    await message.answer(f"💰 Остаток генераций: {left}")
+    left = await get_credits(message.from_user.id)
+    await outbox.answer(message, f"💰 Остаток генераций: {left}")
 
 async def pay_handler(message: types.Message):
     keyboard = InlineKeyboardMarkup(row_width=1)
@@ -78,67 +426,216 @@ async def pay_handler(message: types.Message):
         InlineKeyboardButton("💎 50 генераций — 4 TON", callback_data="buy_50"),
         InlineKeyboardButton("💎 200 генераций — 12 TON", callback_data="buy_200"),
     )
-    await message.answer("Выберите тариф:", reply_markup=keyboard)
+    await outbox.answer(message, "Выберите тариф:", reply_markup=keyboard)
 
 async def check_handler(message: types.Message):
     user_id = message.from_user.id
+    started = time.perf_counter()
+    outcome = "error"
     try:
-        invoices = await cryptopay.get_invoices()
-        for inv in invoices:
-            if getattr(inv, "status", None) != "paid":
-                continue
-            desc = getattr(inv, "description", "") or ""
-            if not desc.startswith(str(user_id)):
-                continue
-            if is_payment_recorded(inv.invoice_id):
-                continue
-            try:
-                _, gens_str = desc.split(":")
-                gens = int(gens_str)
-            except Exception as parse_err:
-                print(f"[CHECK] Ошибка разбора description: {desc} | {parse_err}")
-                continue
-            record_payment(inv.invoice_id, user_id, inv.amount)
-            add_uses(user_id, gens)
-            await message.answer(f"✅ Платёж подтверждён! Начислено {gens} генераций. Баланс: {get_credits(user_id)}")
-            return
-        await message.answer("🕓 Пока не найдено подтверждённых счетов. Попробуй позже.")
+        # локальный индекс: только неоплаченные счета этого пользователя
+        pending = await pending_invoice_ids(user_id)
+        if not pending and await import_legacy_invoices():
+            # счета, выставленные до локального индекса (разовый перенос ещё не прошёл)
+            pending = await pending_invoice_ids(user_id)
+        credited = await refresh_invoices(pending) if pending else []
+        if credited:
+            gens = sum(g for _, g, _ in credited)
+            left = credited[-1][2]
+            await outbox.answer(message, f"✅ Платёж подтверждён! Начислено {gens} генераций. Баланс: {left}")
+            outcome = "paid"
+        elif pending:
+            await outbox.answer(message, "🕓 Пока не найдено подтверждённых счетов. Попробуй позже.")
+            outcome = "pending"
+        else:
+            await outbox.answer(message, f"🧾 Неоплаченных счетов нет. Баланс: {await get_credits(user_id)}")
+            outcome = "none"
     except Exception as e:
         print("[💥] Ошибка /check:", e)
-        await message.answer("❌ Ошибка при проверке. Попробуй позже.")
+        await outbox.answer(message, "❌ Ошибка при проверке. Попробуй позже.")
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, "check", "total")
+        requests_total.inc("check", outcome)
+
+async def notify_payment(bot, user_id: int, gens: int, left: int):
+    """Уведомление от фонового поллера/webhook'а CryptoPay."""
+    await outbox.send_message(bot, user_id, f"✅ Платёж подтверждён! Начислено {gens} генераций. Баланс: {left}")
 
 async def clear_handler(message: types.Message):
     uid = message.from_user.id
-    LAST_PHOTO.pop(uid, None)
-    LAST_MASK.pop(uid, None)
-    await message.answer("🧹 Ок! Забыл твоё последнее фото и маску.")
+    await sessions.drop(uid)
+    await outbox.answer(message, "🧹 Ок! Забыл твоё последнее фото и маску.")
+
+# ── цепочка правок: /undo и /history
+async def undo_handler(message: types.Message):
+    await _undo(message, message.from_user.id)
+
+async def _undo(message: types.Message, user_id: int, index: int = None):
+    res = await sessions.revert(user_id, index)
+    if res is None:
+        await outbox.answer(message, "Откатывать нечего — это исходное фото 📷")
+        return
+    version, entry = res
+    what = "исходное фото" if version == 0 else f"версия {version}: {entry['prompt']}"
+    # сообщение с этой версией уже есть в чате — переотправка по file_id, без загрузки
+    await outbox.answer_photo(message, photo=entry["file_id"], caption=f"↩️ Текущее фото — {what}")
+
+async def history_handler(message: types.Message):
+    versions = await sessions.history(message.from_user.id)
+    if not versions:
+        await outbox.answer(message, "Пока нет фото для правок — пришли фото 📷")
+        return
+    lines = ["🧬 История правок (следующий /edit продолжит с последней):"]
+    keyboard = InlineKeyboardMarkup(row_width=5)
+    for i, v in enumerate(versions):
+        what = "исходное фото" if i == 0 else (v["prompt"] if len(v["prompt"]) <= 60 else v["prompt"][:57] + "...")
+        lines.append(f"{i}. {what}" + (" ← сейчас" if i == len(versions) - 1 else ""))
+    keyboard.add(*[InlineKeyboardButton(f"↩️ {i}", callback_data=f"ver:{i}") for i in range(len(versions) - 1)])
+    await outbox.answer(message, "\n".join(lines), reply_markup=keyboard if len(versions) > 1 else None)
+
+async def unblock_handler(message: types.Message):
+    """/unblock [промпт] — админ снимает блок пред-фильтра модерации (без аргумента — со всех)."""
+    if message.from_user.id not in (ADMIN_IDS or []):
+        return
+    prompt = (message.get_args() or "").strip()
+    if not prompt:
+        removed = await blocklist.clear()
+        await outbox.answer(message, f"🧹 Кеш блокировок модерации очищен (записей: {removed}).")
+        return
+    removed = await blocklist.clear(prompt)
+    await outbox.answer(message, f"🧹 Снято блокировок: {removed}. Осталось в кеше: {len(blocklist)}.")
+
+# ── /stats — сводки по часам/дням (только таблица rollups, без сканирования истории)
+STATS_OPS = (("generate", "🎨"), ("edit", "✏️"), ("variants", "🎲"))
+
+def _summarize(rows) -> dict:
+    """Строки rollups → {op: {count, ok, moderation, error, latency_sum, latency_max, credits, amount}}."""
+    out: dict = {}
+    for _bucket, op, outcome, count, lat_sum, lat_max, credits, amount in rows:
+        s = out.setdefault(op, {"count": 0, "ok": 0, "moderation": 0, "first": 0,
+                                "latency_sum": 0.0, "latency_max": 0.0, "credits": 0, "amount": 0.0})
+        s["count"] += count
+        if outcome in ("ok", "moderation", "first"):
+            s[outcome] += count
+        s["latency_sum"] += lat_sum
+        s["latency_max"] = max(s["latency_max"], lat_max)
+        s["credits"] += credits
+        s["amount"] += amount
+    return out
+
+def _stats_block(title: str, rows, active_label: str) -> str:
+    s = _summarize(rows)
+    lines = [f"<b>{title}</b>"]
+    for op, icon in STATS_OPS:
+        o = s.get(op)
+        if not o:
+            continue
+        lines.append(
+            f"{icon} {op}: {o['count']} (ok {o['ok']}, модерация {o['moderation']}, "
+            f"прочее {o['count'] - o['ok'] - o['moderation']}), ср. {o['latency_sum'] / o['count']:.1f} с, "
+            f"макс {o['latency_max']:.0f} с"
+        )
+    spent = sum(s.get(op, {}).get("credits", 0) for op, _ in STATS_OPS)
+    topup = s.get("topup", {})
+    new = s.get("signup", {}).get("count", 0)
+    lines.append(f"💸 списано генераций: {spent}")
+    lines.append(
+        f"💰 оплат: {topup.get('count', 0)} (первых {topup.get('first', 0)}), "
+        f"{topup.get('amount', 0.0):.2f} TON, +{topup.get('credits', 0)} генераций"
+    )
+    lines.append(f"👤 новых: {new}, {active_label}: {s.get('active', {}).get('count', 0)}"
+                 + (f", конверсия в оплату: {100 * topup.get('first', 0) / new:.1f}%" if new else ""))
+    return "\n".join(lines)
+
+async def stats_handler(message: types.Message):
+    """/stats — сводка; /stats csv [h|d] [дней] — выгрузка сводок в CSV."""
+    if message.from_user.id not in (ADMIN_IDS or []):
+        return
+    args = (message.get_args() or "").split()
+    now = time.time()
+    if args and args[0].lower() == "csv":
+        period = "h" if len(args) > 1 and args[1].lower().startswith("h") else "d"
+        days = int(args[2]) if len(args) > 2 and args[2].isdigit() else (2 if period == "h" else 30)
+        rows = await read_rollups(period, now - days * 86400)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["bucket_utc", "op", "outcome", "count", "latency_avg", "latency_max", "credits", "amount_ton"])
+        for bucket, op, outcome, count, lat_sum, lat_max, credits, amount in rows:
+            writer.writerow([
+                datetime.fromtimestamp(bucket, timezone.utc).strftime("%Y-%m-%d %H:%M"), op, outcome, count,
+                f"{lat_sum / count:.3f}" if count else "", f"{lat_max:.3f}", credits, f"{amount:.4f}",
+            ])
+        name = f"stats_{period}_{datetime.now(timezone.utc):%Y%m%d}.csv"
+        await outbox.answer_document(
+            message, document=InputFile(BytesIO(buf.getvalue().encode("utf-8")), filename=name),
+            caption=f"📊 Сводки ({'по часам' if period == 'h' else 'по дням'}, {days} дн., UTC)",
+        )
+        return
+    day_start = now // 86400 * 86400
+    hourly = await read_rollups("h", now // 3600 * 3600 - 23 * 3600)
+    daily = await read_rollups("d", day_start - 6 * 86400)
+    today = [r for r in daily if r[0] >= day_start]
+    text = "\n\n".join([
+        _stats_block("📊 За 24 часа", [r for r in hourly if r[1] != "active"] + [r for r in today if r[1] == "active"],
+                     "активных сегодня"),
+        _stats_block("📅 За 7 дней (UTC)", daily, "активных (сумма по дням)"),
+    ])
+    await outbox.answer(message, text + "\n\nCSV: /stats csv [h|d] [дней]", parse_mode="HTML")
 
 # ── генерация с текста
 async def prompt_text_handler(message: types.Message):
+    await _generate_from_prompt(message, (message.text or "").strip())
+
+async def _generate_from_prompt(message: types.Message, prompt: str, use_cache: bool = True):
+    started = time.perf_counter()
     user_id = message.from_user.id
     is_admin = user_id in (ADMIN_IDS or [])
-    if not await _ensure_quota_or_pay(message, is_admin):
-        return
-
-    prompt = (message.text or "").strip()
     if not prompt:
-        await message.answer("Напиши описание изображения текстом 🙂")
+        await outbox.answer(message, "Напиши описание изображения текстом 🙂")
+        return
+    if await _defer_if_draining(message, "generate", prompt, use_cache=use_cache):
+        return
+    render = await tiers.resolve(user_id, is_admin)
+    ok, hold = await _reserve_or_pay(message, is_admin, render.cost)
+    if not ok:
+        return
+    job = await _begin_or_defer(message, hold, "generate", prompt, use_cache=use_cache)
+    if job is None:
         return
 
-    wait_msg = await message.answer("🎨 Генерирую изображение... ⏳" + (" (режим админа)" if is_admin else ""))
+    size = render.size
+    await _remember_request(user_id, "generate", prompt)
+    key = make_key(IMAGE_MODEL, prompt, size, **render.cache_extra)
+    status = await Status.create(message, _status_text("🎨 Генерирую изображение... ⏳", render, is_admin))
+    preview = Preview(message, "generate", started)
+    outcome, category, spent = "error", None, 0
     try:
-        png_bytes = generate_image_bytes(prompt, size="1024x1024")
-        if not png_bytes:
-            await message.answer("❌ Не удалось сгенерировать изображение. Попробуй позже.")
+        # уже блокированный промпт отклоняем сразу, не занимая место в очереди
+        check_blocked(prompt)
+        png_bytes, file_id = await _cached_or_run(
+            message, status, preview, key,
+            lambda on_partial: generate_image_bytes(prompt, size=size, on_partial=on_partial, **render.options),
+            is_admin, use_cache
+        )
+        if not png_bytes and not file_id:
+            await status.fail("❌ Не удалось сгенерировать изображение. Попробуй позже.")
             return
 
-        # успех → списываем 1 генерацию (не для админа)
-        if not is_admin:
-            consume_credit(user_id)
+        # успех → резерв становится списанием (у админа резерва нет)
+        if hold:
+            await commit_hold(hold)
+            hold = None
+            spent = render.cost
+        # результат готов и оплачен: при остановке не повторять (иначе второе списание)
+        lifecycle.committed(job)
 
         caption = f"Готово ✅\nPrompt: {prompt}" + ("\n👑 Админ-режим: безлимит" if is_admin else "")
-        await _send_png(message, png_bytes, caption)
+        await _send_result(message, key, png_bytes, file_id, caption, preview=preview)
+        outcome = "ok"
     except ModerationError as me:
+        outcome = "moderation"
+        category = ",".join(me.categories) or "unknown"
+        moderation_total.inc("generate")
         cats_h = _humanize_categories(me.categories)
         tips = [
             "исключи слова про обнажёнку/сексуальные детали",
@@ -146,27 +643,36 @@ async def prompt_text_handler(message: types.Message):
             "замени явные термины на нейтральные (напр. «гламурная фотосессия в платье»)",
             "сфокусируйся на стиле/окружении/ракурсе, а не на телесных деталях",
         ]
-        await message.answer(
+        await status.fail(
             "🚫 Запрос заблокирован системой безопасности.\n"
             f"Категории: *{cats_h}*.\n\n"
             "Попробуй переформулировать:\n"
             f"• {tips[0]}\n• {tips[1]}\n• {tips[2]}\n• {tips[3]}",
             parse_mode="Markdown"
         )
+    except QueueFullError:
+        outcome = "queue_full"
+        await status.fail("🚦 Сейчас слишком много запросов в очереди. Попробуй через минуту.")
+    except ProviderUnavailable:
+        outcome = "unavailable"
+        await status.fail("⏳ Сервис генерации сейчас перегружен. Попробуй через пару минут.")
     except Exception as e:
         text = str(e)
         if "Verify Organization" in text or "must be verified" in text:
-            await message.answer(
+            await status.fail(
                 "❌ Модель пока недоступна для организации. Settings → Organization → Verify Organization.\n"
                 "После верификации доступ включается примерно за 15 минут."
             )
         else:
-            await message.answer(f"❌ Ошибка: {e}")
+            await status.fail(f"❌ Ошибка: {e}")
     finally:
-        try:
-            await wait_msg.delete()
-        except Exception:
-            pass
+        lifecycle.end(job)
+        # не дошли до commit (ошибка, модерация, отмена) — кредиты возвращаются
+        if hold:
+            await release_hold(hold)
+        await preview.discard()
+        await status.close()
+        await _track(user_id, "generate", outcome, started, render, category, spent)
 
 # ── фото (сохраняем/редактируем)
 async def photo_handler(message: types.Message):
@@ -176,14 +682,12 @@ async def photo_handler(message: types.Message):
     if not photo_sizes:
         return
     best = photo_sizes[-1]
-    file = await message.bot.get_file(best.file_id)
-    file_bytes = await message.bot.download_file(file.file_path)
-    image_bytes = file_bytes.read()
-    LAST_PHOTO[user_id] = image_bytes
-
     caption = (message.caption or "").strip()
     if not caption:
-        await message.answer(
+        # без подписи фото нужно только на будущее — храним file_id, скачаем при /edit
+        await sessions.put(user_id, "photo", file_id=best.file_id, unique_id=best.file_unique_id)
+        await outbox.answer(
+            message,
             "📷 Фото сохранено. Теперь:\n"
             "• (опционально) пришли PNG-маску как Документ\n"
             "• затем /edit <что изменить>\n"
@@ -192,43 +696,106 @@ async def photo_handler(message: types.Message):
         )
         return
 
-    if not await _ensure_quota_or_pay(message, is_admin):
+    started = time.perf_counter()
+    render = await tiers.resolve(user_id, is_admin)
+    size = render.size
+    try:
+        # одна и та же картинка (пересылки, повторы) качается один раз — по file_unique_id
+        with stage_seconds.time("edit", "download"):
+            image_bytes = await downloads.fetch(message.bot, best.file_id, best.file_unique_id, best.file_size)
+        await sessions.put(user_id, "photo", file_id=best.file_id, unique_id=best.file_unique_id)
+        source = await sessions.snapshot(user_id)
+        with stage_seconds.time("edit", "download"):
+            mask = await sessions.get(user_id, "mask", message.bot, meta=source.get("mask"))
+        # PNG/RGBA под нужный размер, маска — той же геометрии и с альфой
+        with stage_seconds.time("edit", "preprocess"):
+            image_bytes, mask = await prepare_edit_inputs(image_bytes, mask, size)
+    except ImageError as ie:
+        await outbox.answer(message, f"⚠️ {ie}")
+        return
+    except _FETCH_ERRORS as e:
+        # до резерва кредитов: возвращать нечего, только сказать пользователю
+        log.warning("photo_handler: download failed: %r", e)
+        api_errors_total.inc("telegram", type(e).__name__)
+        await outbox.answer(message, _FETCH_FAILED)
+        return
+    # после рестарта — /edit по этому же фото и маске (source), а не по тому, что будет текущим
+    if await _defer_if_draining(message, "edit", caption, source=source):
+        return
+    ok, hold = await _reserve_or_pay(message, is_admin, render.cost)
+    if not ok:
+        return
+    job = await _begin_or_defer(message, hold, "edit", caption, source=source)
+    if job is None:
         return
 
-    wait_msg = await message.answer("✏️ Редактирую фото... ⏳" + (" (режим админа)" if is_admin else ""))
+    await _remember_request(user_id, "edit", caption)
+    key = make_key(IMAGE_MODEL, caption, size, image=image_bytes, mask=mask, **render.cache_extra)
+    status = await Status.create(message, _status_text("✏️ Редактирую фото... ⏳", render, is_admin))
+    preview = Preview(message, "edit", started)
+    outcome, category, spent = "error", None, 0
     try:
-        mask = LAST_MASK.get(user_id)
-        png_bytes = edit_image_bytes(image_bytes=image_bytes, prompt=caption, size="1024x1024", mask_bytes=mask)
-        if not png_bytes:
-            await message.answer("❌ Не удалось отредактировать изображение. Попробуй позже.")
+        check_blocked(caption, image_bytes)
+        png_bytes, file_id = await _cached_or_run(
+            message, status, preview, key,
+            lambda on_partial: edit_image_bytes(
+                image_bytes=image_bytes, prompt=caption, size=size, mask_bytes=mask, on_partial=on_partial,
+                **render.options
+            ),
+            is_admin, op="edit",
+        )
+        if not png_bytes and not file_id:
+            await status.fail("❌ Не удалось отредактировать изображение. Попробуй позже.")
             return
 
-        if not is_admin:
-            consume_credit(user_id)
+        if hold:
+            await commit_hold(hold)
+            hold = None
+            spent = render.cost
+        # результат готов и оплачен: при остановке не повторять (иначе второе списание)
+        lifecycle.committed(job)
 
-        cap = f"Готово ✅\nEdit-prompt: {caption}" + ("\n👑 Админ-режим: безлимит" if is_admin else "")
-        await _send_png(message, png_bytes, cap)
+        version = len(await sessions.history(user_id))
+        cap = (
+            f"Готово ✅\nEdit-prompt: {caption}\n🧬 Версия {version} — следующий /edit продолжит с неё (/undo, /history)"
+            + ("\n👑 Админ-режим: безлимит" if is_admin else "")
+        )
+        sent = await _send_result(message, key, png_bytes, file_id, cap, op="edit", preview=preview)
+        await _chain_edit(user_id, sent, key, png_bytes, caption)
+        outcome = "ok"
     except ModerationError as me:
+        outcome = "moderation"
+        category = ",".join(me.categories) or "unknown"
+        moderation_total.inc("edit")
         cats_h = _humanize_categories(me.categories)
         tips = [
             "исключи слова про обнажёнку/сексуальные детали",
             "не проси менять возраст/внешность на несовершеннолетних",
             "используй нейтральные формулировки (напр. «добавить очки», «заменить фон на городской»)",
         ]
-        await message.answer(
+        await status.fail(
             "🚫 Редактирование заблокировано системой безопасности.\n"
             f"Категории: *{cats_h}*.\n\n"
             "Попробуй переформулировать:\n"
             f"• {tips[0]}\n• {tips[1]}\n• {tips[2]}",
             parse_mode="Markdown"
         )
+    except QueueFullError:
+        outcome = "queue_full"
+        await status.fail("🚦 Сейчас слишком много запросов в очереди. Попробуй через минуту.")
+    except ProviderUnavailable:
+        outcome = "unavailable"
+        await status.fail("⏳ Сервис генерации сейчас перегружен. Попробуй через пару минут.")
     except Exception as e:
-        await message.answer(f"❌ Ошибка: {e}")
+        await status.fail(f"❌ Ошибка: {e}")
     finally:
-        try:
-            await wait_msg.delete()
-        except Exception:
-            pass
+        lifecycle.end(job)
+        # не дошли до commit (ошибка, модерация, отмена) — кредиты возвращаются
+        if hold:
+            await release_hold(hold)
+        await preview.discard()
+        await status.close()
+        await _track(user_id, "edit", outcome, started, render, category, spent)
 
 # ── документы (маска PNG или исходник-картинка как файл)
 async def document_handler(message: types.Message):
@@ -236,61 +803,241 @@ async def document_handler(message: types.Message):
     doc: types.Document = message.document
     if not doc:
         return
-    file = await message.bot.get_file(doc.file_id)
-    file_bytes = await message.bot.download_file(file.file_path)
-    content = file_bytes.read()
     filename = (doc.file_name or "").lower()
     mime = (doc.mime_type or "").lower()
 
+    if too_large(doc.file_size):
+        await outbox.answer(message, f"⚠️ Файл слишком большой: максимум {DOWNLOAD_MAX_BYTES // (1024 * 1024)} МБ.")
+        return
+    # качаем сразу в фоне (потоком на диск) — к /edit файл уже будет в кеше загрузок
+    downloads.prefetch(message.bot, doc.file_id, doc.file_unique_id, doc.file_size)
+
     if filename.endswith(".png") or "png" in mime:
-        LAST_MASK[user_id] = content
-        await message.answer("🖌 Маска сохранена. Пришли `/edit <промпт>` для применения к последнему фото.", parse_mode="Markdown")
+        await sessions.put(user_id, "mask", file_id=doc.file_id, unique_id=doc.file_unique_id)
+        await outbox.answer(
+            message,
+            "🖌 Маска сохранена. Прозрачные (или белые на ч/б маске) области будут перерисованы.\n"
+            "Пришли `/edit <промпт>` для применения к последнему фото.",
+            parse_mode="Markdown"
+        )
     else:
-        LAST_PHOTO[user_id] = content
-        await message.answer("📷 Фото сохранено как исходник. Пришли PNG-маску (по желанию), затем `/edit <промпт>`.", parse_mode="Markdown")
+        await sessions.put(user_id, "photo", file_id=doc.file_id, unique_id=doc.file_unique_id)
+        await outbox.answer(message, "📷 Фото сохранено как исходник. Пришли PNG-маску (по желанию), затем `/edit <промпт>`.", parse_mode="Markdown")
 
-# ── /edit <промпт> — редактировать последнее фото (учитывая маску)
-async def edit_command_handler(message: types.Message):
+# ── /variants [n] <промпт> — n картинок одним запросом и одним альбомом
+async def variants_handler(message: types.Message):
+    parts = (message.get_args() or "").strip().split(maxsplit=1)
+    n = VARIANTS_DEFAULT
+    if parts and parts[0].isdigit():
+        n = int(parts.pop(0))
+    prompt = parts[0].strip() if parts else ""
+    if not prompt or not 2 <= n <= VARIANTS_MAX:
+        await outbox.reply(
+            message, f"Использование: `/variants [2–{VARIANTS_MAX}] <описание>`", parse_mode="Markdown"
+        )
+        return
+    await _generate_variants(message, prompt, n)
+
+async def _generate_variants(message: types.Message, prompt: str, n: int):
+    started = time.perf_counter()
     user_id = message.from_user.id
     is_admin = user_id in (ADMIN_IDS or [])
+    if await _defer_if_draining(message, "variants", prompt, n=n):
+        return
+    # резерв сразу на n; если OpenAI вернёт меньше — лишнее вернётся при commit
+    render = await tiers.resolve(user_id, is_admin)
+    ok, hold = await _reserve_or_pay(message, is_admin, n * render.cost)
+    if not ok:
+        return
+    job = await _begin_or_defer(message, hold, "variants", prompt, n=n)
+    if job is None:
+        return
+
+    size = render.size
+    await _remember_request(user_id, "generate", prompt)
+    status = await Status.create(message, _status_text(f"🎲 Генерирую {n} вариантов... ⏳", render, is_admin))
+    outcome, category, spent = "error", None, 0
+    try:
+        check_blocked(prompt)
+        images = await _run_queued(
+            message, status, lambda: generate_images(prompt, size=size, n=n, **render.options), is_admin, "variants"
+        )
+        if not images:
+            await status.fail("❌ Не удалось сгенерировать изображения. Попробуй позже.")
+            return
+
+        if hold:
+            await commit_hold(hold, used=len(images) * render.cost)
+            spent = len(images) * render.cost
+            hold = None
+        # результат готов и оплачен: при остановке не повторять (иначе второе списание)
+        lifecycle.committed(job)
+
+        caption = f"Готово ✅ ({len(images)} шт.)\nPrompt: {prompt}" + ("\n👑 Админ-режим: безлимит" if is_admin else "")
+        with stage_seconds.time("variants", "upload"):
+            await _send_album(message, images, caption)
+        outcome = "ok"
+    except ModerationError as me:
+        outcome = "moderation"
+        category = ",".join(me.categories) or "unknown"
+        moderation_total.inc("variants")
+        await status.fail(
+            "🚫 Запрос заблокирован системой безопасности.\n"
+            f"Категории: *{_humanize_categories(me.categories)}*.",
+            parse_mode="Markdown"
+        )
+    except QueueFullError:
+        outcome = "queue_full"
+        await status.fail("🚦 Сейчас слишком много запросов в очереди. Попробуй через минуту.")
+    except ProviderUnavailable:
+        outcome = "unavailable"
+        await status.fail("⏳ Сервис генерации сейчас перегружен. Попробуй через пару минут.")
+    except Exception as e:
+        await status.fail(f"❌ Ошибка: {e}")
+    finally:
+        lifecycle.end(job)
+        if hold:
+            await release_hold(hold)
+        await status.close()
+        await _track(user_id, "variants", outcome, started, render, category, spent)
+
+# ── /quality — выбор качества и формата (цена в генерациях)
+def _quality_keyboard(choice: dict) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    keyboard.row(*[
+        InlineKeyboardButton(("✅ " if q.name == choice["quality"] else "") + f"{q.title} ×{q.cost}",
+                             callback_data=f"tier:q:{q.name}")
+        for q in tiers.QUALITIES.values()
+    ])
+    keyboard.row(*[
+        InlineKeyboardButton(("✅ " if size == choice["size"] else "") + title + (f" +{extra}" if extra else ""),
+                             callback_data=f"tier:s:{size}")
+        for size, (title, extra) in tiers.SIZES.items()
+    ])
+    return keyboard
+
+def _quality_text(choice: dict) -> str:
+    render = tiers.Render(choice["size"], tiers.QUALITIES[choice["quality"]])
+    return (
+        "⚙️ Качество и формат картинки.\n"
+        f"Сейчас: {render.quality.title}, {tiers.SIZES[render.size][0]} — {render.cost} ген. за картинку.\n\n"
+        "При высокой нагрузке бесплатные запросы временно делаются в быстром режиме; "
+        "после пополнения баланса выбранное качество сохраняется всегда."
+    )
+
+async def quality_handler(message: types.Message):
+    choice = await tiers.get_choice(message.from_user.id)
+    await outbox.answer(message, _quality_text(choice), reply_markup=_quality_keyboard(choice))
+
+# ── /edit <промпт> — редактировать последнее фото (учитывая маску)
+async def edit_command_handler(message: types.Message):
     args = (message.get_args() or "").strip()
     if not args:
-        await message.reply("Использование: `/edit <описание правок>`", parse_mode="Markdown")
+        await outbox.reply(message, "Использование: `/edit <описание правок>`", parse_mode="Markdown")
+        return
+    await _edit_last_photo(message, args)
+
+async def _edit_last_photo(message: types.Message, args: str, use_cache: bool = True, source: dict = None):
+    """source — фото и маска из журнала остановки (sessions.snapshot); по умолчанию — текущие."""
+    started = time.perf_counter()
+    user_id = message.from_user.id
+    is_admin = user_id in (ADMIN_IDS or [])
+    if source is None:
+        source = await sessions.snapshot(user_id)
+    # байты качаем только сейчас, по сохранённому file_id (или берём из SessionStore)
+    try:
+        with stage_seconds.time("edit", "download"):
+            image_bytes = None
+            if source.get("photo"):
+                image_bytes = await sessions.get(user_id, "photo", message.bot, meta=source["photo"])
+        if not image_bytes:
+            await outbox.reply(message, "Сначала пришли фото, которое нужно отредактировать 📷")
+            return
+        render = await tiers.resolve(user_id, is_admin)
+        size = render.size
+        mask = None
+        if source.get("mask"):
+            with stage_seconds.time("edit", "download"):
+                mask = await sessions.get(user_id, "mask", message.bot, meta=source["mask"])
+        with stage_seconds.time("edit", "preprocess"):
+            image_bytes, mask = await prepare_edit_inputs(image_bytes, mask, size)
+    except ImageError as ie:
+        await outbox.reply(message, f"⚠️ {ie}")
         return
-    image_bytes = LAST_PHOTO.get(user_id)
-    if not image_bytes:
-        await message.reply("Сначала пришли фото, которое нужно отредактировать 📷")
+    except _FETCH_ERRORS as e:
+        log.warning("edit: download failed: %r", e)
+        api_errors_total.inc("telegram", type(e).__name__)
+        await outbox.reply(message, _FETCH_FAILED)
         return
-    if not await _ensure_quota_or_pay(message, is_admin):
+    if await _defer_if_draining(message, "edit", args, use_cache=use_cache, source=source):
+        return
+    ok, hold = await _reserve_or_pay(message, is_admin, render.cost)
+    if not ok:
+        return
+    job = await _begin_or_defer(message, hold, "edit", args, use_cache=use_cache, source=source)
+    if job is None:
         return
 
-    wait_msg = await message.answer("✏️ Редактирую последнее фото... ⏳" + (" (режим админа)" if is_admin else ""))
+    await _remember_request(user_id, "edit", args)
+    key = make_key(IMAGE_MODEL, args, size, image=image_bytes, mask=mask, **render.cache_extra)
+    status = await Status.create(message, _status_text("✏️ Редактирую последнее фото... ⏳", render, is_admin))
+    preview = Preview(message, "edit", started)
+    outcome, category, spent = "error", None, 0
     try:
-        mask = LAST_MASK.get(user_id)
-        png_bytes = edit_image_bytes(image_bytes=image_bytes, prompt=args, size="1024x1024", mask_bytes=mask)
-        if not png_bytes:
-            await message.answer("❌ Не удалось отредактировать изображение. Попробуй позже.")
+        check_blocked(args, image_bytes)
+        png_bytes, file_id = await _cached_or_run(
+            message, status, preview, key,
+            lambda on_partial: edit_image_bytes(
+                image_bytes=image_bytes, prompt=args, size=size, mask_bytes=mask, on_partial=on_partial,
+                **render.options
+            ),
+            is_admin, use_cache, op="edit",
+        )
+        if not png_bytes and not file_id:
+            await status.fail("❌ Не удалось отредактировать изображение. Попробуй позже.")
             return
 
-        if not is_admin:
-            consume_credit(user_id)
+        if hold:
+            await commit_hold(hold)
+            hold = None
+            spent = render.cost
+        # результат готов и оплачен: при остановке не повторять (иначе второе списание)
+        lifecycle.committed(job)
 
-        cap = f"Готово ✅\nEdit-prompt: {args}" + ("\n👑 Админ-режим: безлимит" if is_admin else "")
-        await _send_png(message, png_bytes, cap)
+        version = len(await sessions.history(user_id))
+        cap = (
+            f"Готово ✅\nEdit-prompt: {args}\n🧬 Версия {version} — следующий /edit продолжит с неё (/undo, /history)"
+            + ("\n👑 Админ-режим: безлимит" if is_admin else "")
+        )
+        sent = await _send_result(message, key, png_bytes, file_id, cap, op="edit", preview=preview)
+        await _chain_edit(user_id, sent, key, png_bytes, args)
+        outcome = "ok"
     except ModerationError as me:
+        outcome = "moderation"
+        category = ",".join(me.categories) or "unknown"
+        moderation_total.inc("edit")
         cats_h = _humanize_categories(me.categories)
-        await message.answer(
+        await status.fail(
             "🚫 Редактирование заблокировано системой безопасности.\n"
             f"Категории: *{cats_h}*.",
             parse_mode="Markdown"
         )
+    except QueueFullError:
+        outcome = "queue_full"
+        await status.fail("🚦 Сейчас слишком много запросов в очереди. Попробуй через минуту.")
+    except ProviderUnavailable:
+        outcome = "unavailable"
+        await status.fail("⏳ Сервис генерации сейчас перегружен. Попробуй через пару минут.")
     except Exception as e:
-        await message.answer(f"❌ Ошибка: {e}")
+        await status.fail(f"❌ Ошибка: {e}")
     finally:
-        try:
-            await wait_msg.delete()
-        except Exception:
-            pass
+        lifecycle.end(job)
+        # не дошли до commit (ошибка, модерация, отмена) — кредиты возвращаются
+        if hold:
+            await release_hold(hold)
+        await preview.discard()
+        await status.close()
+        await _track(user_id, "edit", outcome, started, render, category, spent)
 
 # ── inline-кнопки (тарифы/проверка)
 async def button_handler(callback_query: types.CallbackQuery):
@@ -310,7 +1057,8 @@ async def button_handler(callback_query: types.CallbackQuery):
             InlineKeyboardButton(f"Оплатить {amount} TON", url=pay_url),
             InlineKeyboardButton("🔄 Проверить оплату", callback_data="check_payment"),
         )
-        await callback_query.message.edit_text(
+        await outbox.edit_text(
+            callback_query.message,
             f"Нажми кнопку ниже, чтобы оплатить {amount} TON и получить {gens} генераций:",
             reply_markup=keyboard
         )
@@ -318,15 +1066,64 @@ async def button_handler(callback_query: types.CallbackQuery):
         msg = callback_query.message
         msg.from_user = callback_query.from_user
         await check_handler(msg)
+    elif data == "regen":
+        # «Перегенерировать» — тот же запрос в обход кеша (новый результат перезапишет запись)
+        raw = await get_state(user_id, "last_request")
+        last = json.loads(raw) if raw else None
+        await callback_query.answer()
+        if not last:
+            await outbox.answer(callback_query.message, "Не нашёл предыдущий запрос — пришли описание заново 🙂")
+            return
+        msg = callback_query.message
+        msg.from_user = callback_query.from_user
+        if last["op"] == "generate":
+            await _generate_from_prompt(msg, last["prompt"], use_cache=False)
+        else:
+            # перегенерировать правку — значит заново применить её к предыдущей версии, а не к результату
+            versions = await sessions.history(user_id)
+            if len(versions) > 1 and versions[-1]["prompt"] == last["prompt"]:
+                await sessions.revert(user_id)
+            await _edit_last_photo(msg, last["prompt"], use_cache=False)
+    elif data == "variants":
+        # «Ещё варианты» — тот же текстовый запрос, n картинок одним вызовом
+        raw = await get_state(user_id, "last_request")
+        last = json.loads(raw) if raw else None
+        await callback_query.answer()
+        if not last or last["op"] != "generate":
+            await outbox.answer(callback_query.message, "Варианты доступны для текстовых запросов — пришли описание 🙂")
+            return
+        msg = callback_query.message
+        msg.from_user = callback_query.from_user
+        await _generate_variants(msg, last["prompt"], VARIANTS_DEFAULT)
+    elif data.startswith("png:"):
+        await _send_original(callback_query, data[4:])
+    elif data == "undo" or data.startswith("ver:"):
+        await callback_query.answer()
+        await _undo(callback_query.message, user_id, int(data[4:]) if data.startswith("ver:") else None)
+    elif data.startswith("tier:"):
+        _, kind, value = data.split(":", 2)
+        choice = await tiers.set_choice(
+            user_id, quality=value if kind == "q" else None, size=value if kind == "s" else None
+        )
+        await callback_query.answer("Сохранено ✅")
+        await outbox.edit_text(callback_query.message, _quality_text(choice), reply_markup=_quality_keyboard(choice))
 
 # ── регистрация
 def register_handlers(dp: Dispatcher):
+    # анти-флуд — раньше любых хендлеров (и их обращений к БД/API)
+    dp.middleware.setup(AntiFlood())
     dp.register_message_handler(start_handler, commands=["start"])
     dp.register_message_handler(balance_handler, commands=["balance"])
     dp.register_message_handler(pay_handler, commands=["pay"])
     dp.register_message_handler(check_handler, commands=["check"])
     dp.register_message_handler(clear_handler, commands=["clear"])
     dp.register_message_handler(edit_command_handler, commands=["edit"])
+    dp.register_message_handler(variants_handler, commands=["variants"])
+    dp.register_message_handler(quality_handler, commands=["quality"])
+    dp.register_message_handler(undo_handler, commands=["undo"])
+    dp.register_message_handler(history_handler, commands=["history"])
+    dp.register_message_handler(unblock_handler, commands=["unblock"])
+    dp.register_message_handler(stats_handler, commands=["stats"])
     dp.register_callback_query_handler(button_handler)
 
     dp.register_message_handler(document_handler, content_types=types.ContentTypes.DOCUMENT)
@@ -0,0 +1,194 @@
+# imaging.py
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import config
+
+PREPROCESS_WORKERS = int(getattr(config, "PREPROCESS_WORKERS", 2))
+PREPROCESS_CACHE_BYTES = int(getattr(config, "PREPROCESS_CACHE_BYTES", 32 * 1024 * 1024))
+PREVIEW_MAX_SIDE = int(getattr(config, "PREVIEW_MAX_SIDE", 512))
+DELIVERY_FORMAT = str(getattr(config, "DELIVERY_FORMAT", "jpeg")).lower()  # jpeg | webp
+DELIVERY_QUALITY = int(getattr(config, "DELIVERY_QUALITY", 85))
+DELIVERY_MAX_SIDE = int(getattr(config, "DELIVERY_MAX_SIDE", 2048))  # gpt-image отдаёт до 1536 — обычно без ресайза
+MAX_SIDE_AUTO = 1536  # для size="auto"
+
+# Pillow отпускает GIL на декодировании/ресайзе/кодировании — потоков достаточно,
+# а байты не приходится гонять через pickle, как в ProcessPool
+_pool = ThreadPoolExecutor(PREPROCESS_WORKERS, thread_name_prefix="imaging")
+
+
+class ImageError(Exception):
+    """Картинку/маску нельзя использовать; текст — для пользователя."""
+
+
+def _target_box(size: str) -> Tuple[int, int]:
+    try:
+        w, h = size.lower().split("x")
+        return int(w), int(h)
+    except ValueError:
+        return MAX_SIDE_AUTO, MAX_SIDE_AUTO
+
+
+def _open(data: bytes, what: str) -> Image.Image:
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+    except (UnidentifiedImageError, OSError) as e:
+        raise ImageError(f"Не удалось прочитать {what}: поддерживаются JPEG/PNG/WEBP.") from e
+    return img
+
+
+def _encode_png(img: Image.Image) -> bytes:
+    out = BytesIO()
+    img.save(out, format="PNG", compress_level=6)
+    return out.getvalue()
+
+
+def _prepare_image(data: bytes, size: str) -> Tuple[bytes, Tuple[int, int]]:
+    """Декодирование → поворот по EXIF → уменьшение под size → PNG/RGBA."""
+    img = ImageOps.exif_transpose(_open(data, "фото"))
+    img = img.convert("RGBA")
+    img.thumbnail(_target_box(size), Image.LANCZOS)  # только уменьшает, пропорции сохраняются
+    return _encode_png(img), img.size
+
+
+def _prepare_mask(data: bytes, dims: Tuple[int, int]) -> bytes:
+    """
+    Маска для images.edit: PNG того же размера, что и фото, с альфа-каналом
+    (прозрачные области — то, что нужно перерисовать).
+    Маска без альфы (ч/б) переводится: белое → прозрачное (редактируем), чёрное → оставляем.
+    """
+    mask = _open(data, "маску")
+    if "A" in mask.getbands():
+        alpha = mask.getchannel("A")
+    else:
+        alpha = ImageOps.invert(mask.convert("L"))
+    if alpha.size != dims:
+        alpha = alpha.resize(dims, Image.BILINEAR)
+    lo, _ = alpha.getextrema()
+    if lo == 255:
+        raise ImageError("В маске нет прозрачных областей — непонятно, что редактировать.")
+    out = Image.new("RGBA", dims, (0, 0, 0, 255))
+    out.putalpha(alpha)
+    return _encode_png(out)
+
+
+def _downscale_jpeg(data: bytes, max_side: int) -> bytes:
+    img = _open(data, "превью").convert("RGB")
+    img.thumbnail((max_side, max_side), Image.BILINEAR)
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=70)
+    return out.getvalue()
+
+
+async def make_preview(data: bytes, max_side: int = PREVIEW_MAX_SIDE) -> bytes:
+    """Уменьшенная JPEG-копия (черновики генерации) — в пуле потоков, чтобы не держать event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_pool, _downscale_jpeg, data, max_side)
+
+
+# ───── доставка: компактная копия для answer_photo (PNG-оригинал — документом по кнопке)
+def image_ext(data) -> str:
+    """Расширение по сигнатуре: результат бывает PNG, JPEG (быстрый тариф) или WebP."""
+    head = bytes(data[:12])
+    if head.startswith(b"\xff\xd8"):
+        return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return "png"
+
+
+def _encode_delivery(data: bytes) -> Tuple[bytes, str]:
+    img = _open(data, "результат")
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        img = flat
+    else:
+        img = img.convert("RGB")
+    img.thumbnail((DELIVERY_MAX_SIDE, DELIVERY_MAX_SIDE), Image.LANCZOS)
+    out = BytesIO()
+    if DELIVERY_FORMAT == "webp":
+        img.save(out, format="WEBP", quality=DELIVERY_QUALITY, method=4)
+        return out.getvalue(), "webp"
+    img.save(out, format="JPEG", quality=DELIVERY_QUALITY, subsampling=2, progressive=True)
+    return out.getvalue(), "jpg"
+
+
+def _delivery(data: bytes) -> Tuple[bytes, str]:
+    packed, ext = _encode_delivery(data)
+    # простая графика бывает в PNG компактнее — тогда отправляем оригинал
+    return (packed, ext) if len(packed) < len(data) else (bytes(data), "png")
+
+
+async def encode_delivery(data: bytes) -> Tuple[bytes, str]:
+    """
+    (байты, расширение) для отправки фото: JPEG/WebP вместо многомегабайтного PNG —
+    Telegram всё равно пережимает фото, а аплоад на порядок меньше. Кодирование — в пуле потоков.
+    Уже сжатый результат (JPEG/WebP от быстрого тарифа) уходит как есть.
+    """
+    ext = image_ext(data)
+    if ext != "png":
+        return bytes(data), ext
+    return await asyncio.get_running_loop().run_in_executor(_pool, _delivery, data)
+
+
+# ───── кеш уже подготовленных входов (повторные /edit по тому же фото)
+_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_cache_bytes = 0
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _cache_get(key: tuple):
+    hit = _cache.get(key)
+    if hit is not None:
+        _cache.move_to_end(key)
+    return hit
+
+
+def _cache_put(key: tuple, value: tuple, nbytes: int) -> None:
+    global _cache_bytes
+    old = _cache.pop(key, None)
+    if old is not None:
+        _cache_bytes -= old[-1]
+    _cache[key] = value + (nbytes,)
+    _cache_bytes += nbytes
+    while _cache_bytes > PREPROCESS_CACHE_BYTES and _cache:
+        _, evicted = _cache.popitem(last=False)
+        _cache_bytes -= evicted[-1]
+
+
+async def prepare_edit_inputs(
+    image_bytes: bytes, mask_bytes: Optional[bytes], size: str
+) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Готовит фото (и маску) к images.edit в пуле потоков.
+    Результаты кешируются по содержимому исходника, так что повторный /edit не пересчитывает их.
+    """
+    loop = asyncio.get_running_loop()
+    img_key = ("img", _digest(image_bytes), size)
+    hit = _cache_get(img_key)
+    if hit is None:
+        png, dims = await loop.run_in_executor(_pool, _prepare_image, image_bytes, size)
+        _cache_put(img_key, (png, dims), len(png))
+    else:
+        png, dims, _ = hit
+    if not mask_bytes:
+        return png, None
+    mask_key = ("mask", _digest(mask_bytes), dims)
+    hit = _cache_get(mask_key)
+    if hit is None:
+        mask_png = await loop.run_in_executor(_pool, _prepare_mask, mask_bytes, dims)
+        _cache_put(mask_key, (mask_png,), len(mask_png))
+    else:
+        mask_png = hit[0]
+    return png, mask_png
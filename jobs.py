@@ -0,0 +1,205 @@
+# jobs.py
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+import config
+
+log = logging.getLogger(__name__)
+
+GEN_WORKERS = int(getattr(config, "GEN_WORKERS", 4))
+GEN_PER_USER_INFLIGHT = int(getattr(config, "GEN_PER_USER_INFLIGHT", 2))
+GEN_MAX_PENDING = int(getattr(config, "GEN_MAX_PENDING", 200))
+GEN_MAX_PENDING_PER_USER = int(getattr(config, "GEN_MAX_PENDING_PER_USER", 3))
+
+
+class QueueFullError(Exception):
+    """Очередь переполнена (глобально или для конкретного пользователя)."""
+
+
+class Job:
+    __slots__ = ("user_id", "factory", "priority", "future")
+
+    def __init__(self, user_id: int, factory: Callable[[], Awaitable], priority: bool):
+        self.user_id = user_id
+        self.factory = factory
+        self.priority = priority
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class GenerationQueue:
+    """
+    Очередь генераций между хендлерами и generator.py.
+    - N воркеров → глобальный предел одновременных вызовов OpenAI;
+    - у каждого пользователя не больше `per_user_inflight` задач в работе;
+    - внутри уровня приоритета пользователи обслуживаются по кругу (round-robin);
+    - платящие пользователи и админы идут в приоритетный уровень.
+    """
+
+    def __init__(
+        self,
+        workers: int = GEN_WORKERS,
+        per_user_inflight: int = GEN_PER_USER_INFLIGHT,
+        max_pending: int = GEN_MAX_PENDING,
+        max_pending_per_user: int = GEN_MAX_PENDING_PER_USER,
+    ):
+        self.workers = max(1, workers)
+        self.per_user_inflight = max(1, per_user_inflight)
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        # уровень → {user_id: очередь задач}; порядок ключей = порядок обхода
+        self._tiers: tuple = (OrderedDict(), OrderedDict())
+        self._inflight: Dict[int, int] = {}
+        self._pending = 0
+        self._cond: Optional[asyncio.Condition] = None
+        self._tasks: list = []
+
+    # ── состояние
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    @property
+    def inflight(self) -> int:
+        return sum(self._inflight.values())
+
+    def _user_pending(self, user_id: int) -> int:
+        return sum(len(t.get(user_id, ())) for t in self._tiers)
+
+    # ── постановка
+    def submit(self, user_id: int, factory: Callable[[], Awaitable], priority: bool = False) -> Job:
+        if self._cond is None:
+            # не запущена или уже остановлена: ожидание такой задачи не закончилось бы никогда
+            raise RuntimeError("GenerationQueue не запущена (start() / после stop())")
+        if self._pending >= self.max_pending:
+            raise QueueFullError("queue_full")
+        if self._user_pending(user_id) >= self.max_pending_per_user:
+            raise QueueFullError("user_queue_full")
+        job = Job(user_id, factory, priority)
+        tier = self._tiers[0 if priority else 1]
+        tier.setdefault(user_id, deque()).append(job)
+        self._pending += 1
+        self._notify()
+        return job
+
+    def position(self, job: Job) -> int:
+        """
+        Примерное число задач впереди с учётом round-robin (0 — следующая или уже в работе).
+        """
+        if job.future.done():
+            return 0
+        tier_idx = 0 if job.priority else 1
+        tier = self._tiers[tier_idx]
+        own: Deque[Job] = tier.get(job.user_id, deque())
+        try:
+            k = own.index(job)
+        except ValueError:
+            return 0  # уже взята воркером
+        ahead = k
+        if tier_idx == 1:
+            ahead += sum(len(q) for q in self._tiers[0].values())
+        before = True
+        for uid, q in tier.items():
+            if uid == job.user_id:
+                before = False
+                continue
+            ahead += min(len(q), k + 1 if before else k)
+        return ahead
+
+    def promote(self, job: Job) -> None:
+        """
+        Переносит ждущую задачу в приоритетный уровень — к общей генерации присоединился платящий.
+        Уже взятую воркером или приоритетную не трогаем.
+        """
+        if job.priority or job.future.done():
+            return
+        own = self._tiers[1].get(job.user_id)
+        if not own or job not in own:
+            return
+        own.remove(job)
+        if not own:
+            del self._tiers[1][job.user_id]
+        job.priority = True
+        self._tiers[0].setdefault(job.user_id, deque()).append(job)
+        self._notify()
+
+    # ── выборка
+    def _take(self) -> Optional[Job]:
+        for tier in self._tiers:
+            for uid in list(tier.keys()):
+                if self._inflight.get(uid, 0) >= self.per_user_inflight:
+                    continue
+                q = tier[uid]
+                job = q.popleft()
+                # пользователь уходит в конец круга
+                del tier[uid]
+                if q:
+                    tier[uid] = q
+                self._pending -= 1
+                if job.future.done():  # ожидающий ушёл (отмена) — пропускаем
+                    return self._take()
+                self._inflight[uid] = self._inflight.get(uid, 0) + 1
+                return job
+        return None
+
+    def _notify(self) -> None:
+        cond = self._cond
+
+        async def _wake():
+            async with cond:
+                cond.notify_all()
+        asyncio.get_running_loop().create_task(_wake())
+
+    async def _worker(self, idx: int) -> None:
+        while True:
+            async with self._cond:
+                job = self._take()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._take()
+            try:
+                result = await job.factory()
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                left = self._inflight.get(job.user_id, 1) - 1
+                if left > 0:
+                    self._inflight[job.user_id] = left
+                else:
+                    self._inflight.pop(job.user_id, None)
+                # освободился слот пользователя — его следующая задача может стартовать
+                self._notify()
+
+    # ── жизненный цикл
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        log.info("GenerationQueue: %d workers, per-user inflight=%d", self.workers, self.per_user_inflight)
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._cond = None  # поздний submit() падает сразу, а не ждёт остановленных воркеров
+        for tier in self._tiers:
+            for q in tier.values():
+                for job in q:
+                    if not job.future.done():
+                        job.future.cancel()
+            tier.clear()
+        self._pending = 0
+
+
+queue = GenerationQueue()
@@ -0,0 +1,187 @@
+# lifecycle.py
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import config
+
+log = logging.getLogger(__name__)
+
+# Журнал недоделанных генераций: пишется при остановке, читается при следующем старте
+JOBS_JOURNAL = getattr(config, "JOBS_JOURNAL", "jobs_journal.jsonl")
+SHUTDOWN_DRAIN = float(getattr(config, "SHUTDOWN_DRAIN", 20))  # сек ждём, пока текущие генерации доделаются
+JOURNAL_MAX_AGE = float(getattr(config, "JOURNAL_MAX_AGE", 3600))  # более старые записи не возобновляем
+CANCEL_GRACE = 5.0  # сек на finally отменённых хендлеров (возврат кредитов, удаление статусов)
+
+STARTING, READY, DRAINING, STOPPED = "starting", "ready", "draining", "stopped"
+
+
+class Draining(Exception):
+    """Генерация не начата: бот не готов или останавливается (запрос нужно отложить в журнал)."""
+
+
+class _Tracked:
+    __slots__ = ("entry", "task", "committed")
+
+    def __init__(self, entry: dict, task: Optional[asyncio.Task]):
+        self.entry = entry
+        self.task = task
+        self.committed = False  # кредиты уже списаны — повтор после рестарта списал бы второй раз
+
+
+class Lifecycle:
+    """
+    Жизненный цикл процесса бота: готовность (readiness) и аккуратная остановка.
+    - starting → ready, когда поднялись БД, кеши и сессия Telegram; /ready до этого отвечает 503;
+    - draining: новые генерации не начинаются, а откладываются в журнал; текущие доделываются
+      до SHUTDOWN_DRAIN секунд, остальные записываются в журнал и отменяются (резервы кредитов возвращаются);
+    - при следующем старте записи журнала выполняются заново — рестарт не теряет запросов.
+    Журнал — JSON Lines, одна строка на запрос (op, пользователь, чат, сообщение, промпт, параметры).
+    """
+
+    def __init__(self, path: str = JOBS_JOURNAL, drain_timeout: float = SHUTDOWN_DRAIN):
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self.state = STARTING
+        self._jobs: Dict[int, _Tracked] = {}
+        self._seq = 0
+        self._idle: Optional[asyncio.Event] = None
+
+    # ── состояние
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    @property
+    def draining(self) -> bool:
+        return self.state in (DRAINING, STOPPED)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._jobs)
+
+    def set_ready(self) -> None:
+        if self.state == STARTING:
+            self.state = READY
+            log.info("Lifecycle: ready")
+
+    async def ready_handler(self, _request):
+        """GET /ready для балансировщика/оркестратора: 200 — принимаем запросы, 503 — стартуем или останавливаемся."""
+        from aiohttp import web
+        return web.Response(status=200 if self.ready else 503, text=self.state)
+
+    # ── учёт генераций в работе
+    def begin(self, entry: dict) -> int:
+        """
+        Регистрирует генерацию — вызывать сразу после резерва кредитов, без await между ними:
+        drain() тогда либо увидит её в своём снимке, либо begin() откажет (Draining).
+        """
+        if self.state != READY:
+            raise Draining(self.state)
+        self._seq += 1
+        self._jobs[self._seq] = _Tracked(dict(entry, ts=entry.get("ts") or time.time()), asyncio.current_task())
+        if self._idle is not None:
+            self._idle.clear()
+        return self._seq
+
+    def committed(self, job_id: Optional[int]) -> None:
+        """Генерация готова и оплачена (commit_hold): осталось отправить, в журнал такую не пишем."""
+        tracked = self._jobs.get(job_id)
+        if tracked is not None:
+            tracked.committed = True
+
+    def end(self, job_id: Optional[int]) -> None:
+        if job_id is not None:
+            self._jobs.pop(job_id, None)
+        if not self._jobs and self._idle is not None:
+            self._idle.set()
+
+    # ── журнал
+    def _append(self, entries: List[dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def defer(self, entry: dict) -> None:
+        """Запрос пришёл во время остановки — сразу в журнал, выполнит следующий запуск."""
+        await asyncio.to_thread(self._append, [dict(entry, ts=time.time())])
+
+    def _take_journal(self) -> List[dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        os.remove(self.path)
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                log.warning("Lifecycle: bad journal line skipped")
+        return entries
+
+    # ── остановка
+    async def drain(self) -> int:
+        """
+        Перестаёт брать генерации, ждёт текущие, недоделанные — в журнал и отменяет.
+        Возвращает число записанных в журнал.
+        """
+        self.state = DRAINING
+        if self._jobs:
+            log.info("Lifecycle: draining %d generations (up to %.0fs)", len(self._jobs), self.drain_timeout)
+            self._idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        left = list(self._jobs.values())
+        self._jobs.clear()
+        journaled = [t.entry for t in left if not t.committed]
+        if journaled:
+            try:
+                await asyncio.to_thread(self._append, journaled)
+            except OSError as e:
+                log.error("Lifecycle: journal write failed, %d generations lost: %s", len(journaled), e)
+        if left:
+            tasks = [t.task for t in left if t.task is not None and not t.task.done()]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks, timeout=CANCEL_GRACE)
+            log.warning("Lifecycle: %d generations checkpointed to %s, %d already paid cancelled while sending",
+                        len(journaled), self.path, len(left) - len(journaled))
+        self.state = STOPPED
+        return len(journaled)
+
+    # ── возобновление
+    async def resume(self, runner: Callable[[dict], Awaitable]) -> int:
+        """Запускает в фоне записи журнала прошлого процесса (runner — повтор запроса хендлерами)."""
+        try:
+            entries = await asyncio.to_thread(self._take_journal)
+        except OSError as e:
+            log.error("Lifecycle: journal read failed: %s", e)
+            return 0
+        now = time.time()
+        fresh = [e for e in entries if now - e.get("ts", 0) <= JOURNAL_MAX_AGE]
+        if len(fresh) < len(entries):
+            log.warning("Lifecycle: %d stale journal entries dropped", len(entries) - len(fresh))
+        for entry in fresh:
+            task = asyncio.create_task(runner(entry))
+            task.add_done_callback(_log_failure)
+        if fresh:
+            log.info("Lifecycle: resuming %d generations from %s", len(fresh), self.path)
+        return len(fresh)
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("Lifecycle: resumed job failed: %s", task.exception())
+
+
+lifecycle = Lifecycle()
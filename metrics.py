@@ -0,0 +1,210 @@
+# metrics.py
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import config
+
+log = logging.getLogger(__name__)
+
+METRICS_HOST = getattr(config, "METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(getattr(config, "METRICS_PORT", 0) or 0)
+METRICS_PATH = getattr(config, "METRICS_PATH", "/metrics")
+READY_PATH = getattr(config, "READY_PATH", "/ready")
+LOOP_LAG_INTERVAL = 0.5  # сек между замерами лага event loop
+
+# Границы по умолчанию: от миллисекунд (SQLite, кеш) до минут (генерация в очереди)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+_registry: List["_Metric"] = []
+
+
+def _fmt_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [
+        '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, n: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + n
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение снимается в момент отдачи /metrics (fn) либо выставляется set()."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, doc)
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def _samples(self) -> List[str]:
+        value = self.value
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return []
+        return [f"{self.name} {value}"]
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist: "Histogram", labels: Tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма с фиксированными границами. observe() — bisect и два сложения:
+    всё в одном потоке event loop, без блокировок и аллокаций на горячем пути.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}  # labels → [counts по бакетам + +Inf, сумма]
+
+    def observe(self, value: float, *labels) -> None:
+        s = self._series.get(labels)
+        if s is None:
+            s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def time(self, *labels) -> _Timer:
+        """with hist.time("generate", "openai"): await ... — работает и вокруг await."""
+        return _Timer(self, labels)
+
+    def _samples(self) -> List[str]:
+        out = []
+        for labels, (counts, total) in self._series.items():
+            acc = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(float(bound)))
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, labels, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, labels)} {total}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, labels)} {acc}")
+        return out
+
+
+def render() -> str:
+    lines: List[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ───── метрики бота
+# op: generate | edit | check; stage: download | preprocess | queue | openai | decode | upload | cryptopay | total
+# (+ worker — ожидание результата от процессов worker.py при GEN_BACKEND=workers)
+stage_seconds = Histogram("bot_stage_seconds", "Время этапа обработки запроса", ("op", "stage"))
+db_seconds = Histogram("bot_db_seconds", "Ожидание SQLite (очередь писателя + выполнение)", ("kind",))
+requests_total = Counter("bot_requests_total", "Запросы пользователей по исходу", ("op", "outcome"))
+cache_total = Counter("bot_cache_total", "Обращения к кешу результатов", ("result",))
+moderation_total = Counter("bot_moderation_blocks_total", "Блокировки модерацией", ("op",))
+api_errors_total = Counter("bot_api_errors_total", "Ошибки внешних API", ("service", "error"))
+upload_bytes_total = Counter("bot_upload_bytes_total", "Байты картинок, загруженные в Telegram", ("kind",))
+loop_lag = Histogram(
+    "bot_event_loop_lag_seconds", "Опоздание event loop относительно запланированного",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+def gauge(name: str, doc: str, fn: Callable[[], float]) -> Gauge:
+    """Регистрирует gauge, значение которого вычисляется при отдаче /metrics."""
+    return Gauge(name, doc, fn)
+
+
+# ───── HTTP-эндпоинт и замер лага
+_runner = None
+_lag_task: Optional[asyncio.Task] = None
+
+
+async def _measure_lag() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - t - LOOP_LAG_INTERVAL))
+
+
+async def start_server(ready: Optional[Callable] = None) -> bool:
+    """Поднимает /metrics (формат Prometheus), если задан METRICS_PORT; ready — обработчик READY_PATH."""
+    global _runner, _lag_task
+    if not METRICS_PORT or _runner is not None:
+        return False
+    from aiohttp import web
+
+    async def handle(_request: "web.Request") -> "web.Response":
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle)
+    if ready is not None:
+        app.router.add_get(READY_PATH, ready)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    _runner = runner
+    _lag_task = asyncio.create_task(_measure_lag())
+    log.info("Metrics: http://%s:%d%s", METRICS_HOST, METRICS_PORT, METRICS_PATH)
+    return True
+
+
+async def stop_server() -> None:
+    global _runner, _lag_task
+    runner, _runner = _runner, None
+    task, _lag_task = _lag_task, None
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if runner:
+        await runner.cleanup()
@@ -0,0 +1,185 @@
+# moderation.py
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import config
+import database
+from cache import normalize_prompt
+from metrics import Counter
+
+log = logging.getLogger(__name__)
+
+MODERATION_CACHE_TTL = float(getattr(config, "MODERATION_CACHE_TTL", 3 * 24 * 3600))
+MODERATION_CACHE_MAX = int(getattr(config, "MODERATION_CACHE_MAX", 20000))
+# Порог «почти того же» промпта: расстояние Хэмминга между 64-битными simhash
+MODERATION_NEAR_BITS = int(getattr(config, "MODERATION_NEAR_BITS", 6))
+NEAR_MIN_FEATURES = 4  # у совсем коротких промптов simhash слишком грубый — только точное совпадение
+
+prefilter_total = Counter("bot_moderation_prefilter_total", "Отказы локального фильтра модерации", ("match",))
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _features(text: str) -> List[str]:
+    """Слова и пары соседних слов нормализованного промпта."""
+    words = _WORD.findall(text)
+    return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+
+def simhash(features: List[str]) -> int:
+    acc = [0] * 64
+    for f in features:
+        h = int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(64):
+            acc[i] += 1 if h >> i & 1 else -1
+    value = 0
+    for i, v in enumerate(acc):
+        if v > 0:
+            value |= 1 << i
+    # SQLite INTEGER — знаковый 64-битный
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _scope(image: Optional[bytes]) -> str:
+    """Для правок фото блок мог быть из-за самой картинки — сравниваем только в пределах одного фото."""
+    return hashlib.sha256(image).hexdigest()[:32] if image else ""
+
+
+def _fingerprint(text: str, scope: str) -> str:
+    """sha256 текста, для правок — с суффиксом scope (так блок снимается по тексту во всех scope)."""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{digest}/{scope}" if scope else digest
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "scope", "simhash", "categories", "expires_at")
+
+    def __init__(self, fingerprint: str, scope: str, simhash: int, categories: List[str], expires_at: float):
+        self.fingerprint = fingerprint
+        self.scope = scope
+        self.simhash = simhash
+        self.categories = categories
+        self.expires_at = expires_at
+
+    @property
+    def near(self) -> bool:
+        return self.simhash != 0
+
+
+class BlockList:
+    """
+    Отпечатки промптов, которые отклонила модерация OpenAI.
+    Проверка — словарь по точному отпечатку и линейный проход по simhash своего scope
+    (десятки тысяч XOR/popcount — доли миллисекунды); хранение — таблица blocked_prompts.
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, _Entry] = {}
+        self._by_scope: Dict[str, List[_Entry]] = {}
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def _add(self, entry: _Entry) -> None:
+        old = self._exact.get(entry.fingerprint)
+        if old is not None:
+            self._drop(old)
+        self._exact[entry.fingerprint] = entry
+        if entry.near:
+            self._by_scope.setdefault(entry.scope, []).append(entry)
+
+    def _drop(self, entry: _Entry) -> None:
+        self._exact.pop(entry.fingerprint, None)
+        entries = self._by_scope.get(entry.scope)
+        if entry.near and entries:
+            entries.remove(entry)
+            if not entries:
+                del self._by_scope[entry.scope]
+
+    async def load(self) -> None:
+        rows = await database.load_blocked()
+        self._exact.clear()
+        self._by_scope.clear()
+        for fingerprint, scope, sh, cats, expires_at in rows:
+            self._add(_Entry(fingerprint, scope, sh, json.loads(cats), expires_at))
+        log.info("Moderation prefilter: %d blocked prompts", len(self._exact))
+
+    def check(self, prompt: str, image: Optional[bytes] = None) -> Optional[Tuple[List[str], str]]:
+        """(категории, "exact"|"near"), если такой или почти такой промпт уже блокировали."""
+        if not self._exact:
+            return None
+        now = time.time()
+        text = normalize_prompt(prompt)
+        scope = _scope(image)
+        entry = self._exact.get(_fingerprint(text, scope))
+        if entry is not None:
+            if entry.expires_at > now:
+                prefilter_total.inc("exact")
+                return entry.categories, "exact"
+            self._drop(entry)
+        candidates = self._by_scope.get(scope)
+        features = _features(text)
+        if not candidates or len(features) < NEAR_MIN_FEATURES:
+            return None
+        sh = simhash(features)
+        for entry in candidates:
+            if entry.expires_at > now and _distance(entry.simhash, sh) <= MODERATION_NEAR_BITS:
+                prefilter_total.inc("near")
+                return entry.categories, "near"
+        return None
+
+    def remember(self, prompt: str, categories: List[str], image: Optional[bytes] = None) -> None:
+        """Запоминает блок (в памяти сразу, в SQLite — в фоне)."""
+        text = normalize_prompt(prompt)
+        if not text:
+            return
+        scope = _scope(image)
+        features = _features(text)
+        sh = simhash(features) if len(features) >= NEAR_MIN_FEATURES else 0
+        fingerprint = _fingerprint(text, scope)
+        expires_at = time.time() + MODERATION_CACHE_TTL
+        if len(self._exact) >= MODERATION_CACHE_MAX and fingerprint not in self._exact:
+            self._drop(min(self._exact.values(), key=lambda e: e.expires_at))
+        self._add(_Entry(fingerprint, scope, sh, list(categories), expires_at))
+        task = asyncio.create_task(
+            database.save_blocked(fingerprint, scope, sh, json.dumps(categories), expires_at)
+        )
+        task.add_done_callback(_log_failure)
+
+    async def clear(self, prompt: Optional[str] = None) -> int:
+        """Без prompt — очистить всё; иначе снять блок с этого промпта и его почти-дубликатов (любой scope)."""
+        if prompt is None:
+            self._exact.clear()
+            self._by_scope.clear()
+            return await database.delete_blocked()
+        text = normalize_prompt(prompt)
+        features = _features(text)
+        sh = simhash(features) if len(features) >= NEAR_MIN_FEATURES else None
+        digest = _fingerprint(text, "")
+        victims = [
+            e for e in self._exact.values()
+            if e.fingerprint.split("/", 1)[0] == digest
+            or (sh is not None and e.near and _distance(e.simhash, sh) <= MODERATION_NEAR_BITS)
+        ]
+        for e in victims:
+            self._drop(e)
+        if victims:
+            await database.delete_blocked([e.fingerprint for e in victims])
+        return len(victims)
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("Moderation prefilter: failed to persist entry: %s", task.exception())
+
+
+blocklist = BlockList()
@@ -0,0 +1,260 @@
+# outbox.py
+import asyncio
+import logging
+import time
+from io import BytesIO
+from typing import Awaitable, Callable, Optional
+
+from aiogram import types
+from aiogram.types import InputFile, InputMediaPhoto
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+import config
+from imaging import make_preview
+from metrics import api_errors_total, stage_seconds, upload_bytes_total
+from ratelimit import BucketMap, TokenBucket
+
+log = logging.getLogger(__name__)
+
+TG_GLOBAL_RATE = float(getattr(config, "TG_GLOBAL_RATE", 28))  # сообщений/с на бота (лимит ~30)
+TG_CHAT_RATE = float(getattr(config, "TG_CHAT_RATE", 1))  # личный чат: ~1 сообщение/с
+TG_GROUP_RATE = float(getattr(config, "TG_GROUP_RATE", 20 / 60))  # группа: ~20 сообщений/мин
+TG_DROP_LOW_AFTER = int(getattr(config, "TG_DROP_LOW_AFTER", 50))  # ожидающих → выкидываем статусы
+PREVIEW_INTERVAL = float(getattr(config, "PREVIEW_INTERVAL", 2.0))  # сек между правками черновика
+RETRY_AFTER_ATTEMPTS = 3
+
+
+class Outbox:
+    """
+    Единая точка исходящих вызовов Telegram API.
+    - глобальный token bucket + bucket на каждый чат;
+    - RetryAfter (429) → пауза чата и повтор;
+    - низкоприоритетные вызовы (статусы «⏳», позиция в очереди, удаление статуса)
+      отбрасываются первыми, когда отправка не успевает.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._private = BucketMap(TG_CHAT_RATE, 3)
+        self._groups = BucketMap(TG_GROUP_RATE, 3)
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        return (self._groups if chat_id < 0 else self._private).get(chat_id)
+
+    async def _acquire(self, chat_id: int) -> None:
+        chat = self._chat_bucket(chat_id)
+        while True:
+            wait = max(self._global.delay(), chat.delay())
+            if wait <= 0:
+                self._global.tokens -= 1
+                chat.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    async def call(self, chat_id: int, factory: Callable[[], Awaitable], low: bool = False):
+        """Выполняет вызов API с учётом лимитов. Для low=True при перегрузке вернёт None, ничего не отправив."""
+        if low and self._waiting >= TG_DROP_LOW_AFTER:
+            return None
+        self._waiting += 1
+        try:
+            attempt = 0
+            while True:
+                await self._acquire(chat_id)
+                try:
+                    return await factory()
+                except RetryAfter as e:
+                    attempt += 1
+                    api_errors_total.inc("telegram", "RetryAfter")
+                    log.warning("Telegram RetryAfter %ss (chat %s)", e.timeout, chat_id)
+                    self._chat_bucket(chat_id).pause(e.timeout)
+                    if low:
+                        return None
+                    if attempt >= RETRY_AFTER_ATTEMPTS:
+                        raise
+        finally:
+            self._waiting -= 1
+
+    # ── обёртки над типовыми вызовами
+    async def answer(self, message: types.Message, text: str, low: bool = False, **kwargs):
+        return await self.call(message.chat.id, lambda: message.answer(text, **kwargs), low)
+
+    async def reply(self, message: types.Message, text: str, **kwargs):
+        return await self.call(message.chat.id, lambda: message.reply(text, **kwargs))
+
+    async def answer_photo(self, message: types.Message, low: bool = False, **kwargs):
+        return await self.call(message.chat.id, lambda: message.answer_photo(**kwargs), low)
+
+    async def answer_document(self, message: types.Message, **kwargs):
+        return await self.call(message.chat.id, lambda: message.answer_document(**kwargs))
+
+    async def answer_media_group(self, message: types.Message, media: types.MediaGroup):
+        return await self.call(message.chat.id, lambda: message.answer_media_group(media))
+
+    async def send_message(self, bot, chat_id: int, text: str, **kwargs):
+        return await self.call(chat_id, lambda: bot.send_message(chat_id, text, **kwargs))
+
+    async def edit_text(self, message: types.Message, text: str, low: bool = False, **kwargs):
+        async def do():
+            try:
+                return await message.edit_text(text, **kwargs)
+            except MessageNotModified:
+                return message
+        return await self.call(message.chat.id, do, low)
+
+    async def edit_media(self, message: types.Message, media: types.InputMedia, low: bool = False, **kwargs):
+        async def do():
+            try:
+                return await message.edit_media(media, **kwargs)
+            except MessageNotModified:
+                return message
+        return await self.call(message.chat.id, do, low)
+
+    async def delete(self, message: types.Message, low: bool = True):
+        async def do():
+            try:
+                return await message.delete()
+            except Exception:
+                return None
+        return await self.call(message.chat.id, do, low)
+
+
+outbox = Outbox()
+
+
+class Status:
+    """
+    Статус-сообщение «⏳» генерации: обновляется на месте (edit), ошибка заменяет его текст
+    (вместо «удалить + прислать новое»), после успешной отправки результата — удаляется.
+    """
+
+    def __init__(self, message: types.Message, msg: Optional[types.Message], text: str):
+        self.message = message
+        self.msg = msg
+        self.text = text
+        self.final = False
+
+    @classmethod
+    async def create(cls, message: types.Message, text: str) -> "Status":
+        msg = await outbox.answer(message, text)
+        return cls(message, msg, text)
+
+    async def update(self, text: str) -> None:
+        if self.msg is None or self.final or text == self.text:
+            return
+        self.text = text
+        try:
+            await outbox.edit_text(self.msg, text, low=True)
+        except Exception:
+            pass
+
+    async def fail(self, text: str, **kwargs) -> None:
+        """Финальный текст (ошибка/модерация) — в том же сообщении."""
+        self.final = True
+        if self.msg is not None:
+            try:
+                await outbox.edit_text(self.msg, text, **kwargs)
+                return
+            except Exception:
+                pass
+        await outbox.answer(self.message, text, **kwargs)
+
+    async def close(self) -> None:
+        if self.msg is not None and not self.final:
+            self.final = True
+            await outbox.delete(self.msg)
+
+
+class Preview:
+    """
+    Черновик генерации по промежуточным картинкам (partial_images).
+    Первая уходит фото-сообщением, следующие правят его на месте (editMessageMedia, низкий приоритет,
+    не чаще PREVIEW_INTERVAL; между правками показываем только самую свежую), финальная картинка
+    заменяет черновик. Заодно меряем time-to-first-pixel: от начала запроса до первой картинки у пользователя.
+    """
+
+    CAPTION = "🖼 Черновик… дорисовываю"
+
+    def __init__(self, message: types.Message, op: str, started: Optional[float] = None):
+        self.message = message
+        self.op = op
+        self.started = started if started is not None else time.perf_counter()
+        self.msg: Optional[types.Message] = None
+        self._latest: Optional[bytes] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = asyncio.Event()
+        self._shown_at = 0.0
+        self._pixel = False
+
+    def first_pixel(self) -> None:
+        if not self._pixel:
+            self._pixel = True
+            stage_seconds.observe(time.perf_counter() - self.started, self.op, "first_pixel")
+
+    async def show(self, data: bytes) -> None:
+        """on_partial для generator: только запоминает кадр, отправка — в фоне, поток OpenAI не ждёт Telegram."""
+        if self._closed.is_set():
+            return
+        self._latest = data
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self) -> None:
+        while self._latest is not None and not self._closed.is_set():
+            wait = self._shown_at + PREVIEW_INTERVAL - time.monotonic()
+            if self.msg is not None and wait > 0:
+                try:
+                    await asyncio.wait_for(self._closed.wait(), wait)
+                    return  # пришла финальная картинка — черновик больше не нужен
+                except asyncio.TimeoutError:
+                    pass
+            data, self._latest = self._latest, None
+            try:
+                jpeg = await make_preview(data)
+                upload_bytes_total.inc("preview", n=len(jpeg))
+                photo = InputFile(BytesIO(jpeg), filename="preview.jpg")
+                if self.msg is None:
+                    self.msg = await outbox.answer_photo(self.message, low=True, photo=photo, caption=self.CAPTION)
+                else:
+                    await outbox.edit_media(self.msg, InputMediaPhoto(photo, caption=self.CAPTION), low=True)
+            except Exception as e:
+                log.debug("Preview: %s", e)
+            self._shown_at = time.monotonic()
+            if self.msg is not None:
+                self.first_pixel()
+
+    async def _stop(self) -> None:
+        self._closed.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def finish(self, data: bytes, caption: str, reply_markup=None,
+                     filename: str = "image.jpg") -> Optional[types.Message]:
+        """
+        Финальная картинка (уже сжатая для доставки) на месте черновика.
+        None — черновика нет, отправляй обычным сообщением.
+        """
+        await self._stop()
+        msg, self.msg = self.msg, None
+        if msg is None:
+            return None
+        upload_bytes_total.inc("photo", n=len(data))
+        photo = InputFile(BytesIO(data), filename=filename)
+        try:
+            sent = await outbox.edit_media(msg, InputMediaPhoto(photo, caption=caption), reply_markup=reply_markup)
+        except Exception as e:
+            log.warning("Preview: не удалось заменить черновик: %s", e)
+            await outbox.delete(msg)
+            return None
+        return sent if isinstance(sent, types.Message) else msg
+
+    async def discard(self) -> None:
+        """Ошибка/модерация — черновик убираем."""
+        await self._stop()
+        msg, self.msg = self.msg, None
+        if msg is not None:
+            await outbox.delete(msg)
@@ -1,6 +1,19 @@
 # payment.py
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
 from aiocryptopay import AioCryptoPay, Networks
 import config
+import database
+from metrics import stage_seconds, api_errors_total
+from singleflight import inflight
+
+log = logging.getLogger(__name__)
 
 # Поддерживаем оба варианта именования из .env: MAINNET / TESTNET ИЛИ MAIN_NET / TEST_NET
 network_raw = (getattr(config, "CRYPTOPAY_NETWORK", None) or "MAINNET").strip().upper()
@@ -17,19 +30,252 @@ token = (
     or getattr(config, "CRYPTOBOT_TOKEN", None)  # твой текущий .env
 )
 
-if not token:
-    raise RuntimeError("CryptoPay token is missing. Set CRYPTOPAY_TOKEN or CRYPTOBOT_TOKEN in .env")
+# Клиент создаётся при первом обращении: импорт модуля не требует токена и не открывает сессий
+_cryptopay: Optional[AioCryptoPay] = None
+
+
+def _client() -> AioCryptoPay:
+    global _cryptopay
+    if _cryptopay is None:
+        if not token:
+            raise RuntimeError("CryptoPay token is missing. Set CRYPTOPAY_TOKEN or CRYPTOBOT_TOKEN in .env")
+        # CRYPTOPAY_API_URL — свой адрес API (стенд, заглушка из bench/)
+        _cryptopay = AioCryptoPay(token=token, network=getattr(config, "CRYPTOPAY_API_URL", None) or network)
+    return _cryptopay
+
+
+def configured() -> bool:
+    return bool(token)
+
+INVOICE_TTL = int(getattr(config, "INVOICE_TTL", 3600))
+POLL_INTERVAL = float(getattr(config, "CRYPTOPAY_POLL_INTERVAL", 15))
+# при включённом webhook — редкая сверка: webhook мог не дойти (бот лежал, сеть)
+RECONCILE_INTERVAL = float(getattr(config, "CRYPTOPAY_RECONCILE_INTERVAL", 300))
+POLL_BATCH = 100  # столько invoice_ids за один getInvoices
+LEGACY_SCAN_PAGE = 1000  # максимум count у getInvoices
+LEGACY_MARK = "legacy_invoices_imported"
+WEBHOOK_HOST = getattr(config, "CRYPTOPAY_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getattr(config, "CRYPTOPAY_WEBHOOK_PORT", 0) or 0)
+WEBHOOK_PATH = getattr(config, "CRYPTOPAY_WEBHOOK_PATH", "/cryptopay")
+
+# (user_id, generations, баланс) → уведомление пользователя
+OnPaid = Callable[[int, int, int], Awaitable[None]]
 
-cryptopay = AioCryptoPay(token=token, network=network)
 
 async def create_invoice(amount_ton: float, user_id: int, generations: int) -> str:
     """
-    Создаёт счёт в TON. В description шьём '<user_id>:<gens>' для начисления.
+    Создаёт счёт в TON и кладёт его в локальный индекс invoices.
+    В description по-прежнему шьём '<user_id>:<gens>' — для наглядности в CryptoBot.
     """
     description = f"{user_id}:{generations}"
-    inv = await cryptopay.create_invoice(
-        asset="TON",
-        amount=str(amount_ton),
-        description=description,
-    )
-    return inv.pay_url
\ No newline at end of file
+    with stage_seconds.time("pay", "cryptopay"):
+        try:
+            inv = await _client().create_invoice(
+                asset="TON",
+                amount=str(amount_ton),
+                description=description,
+                expires_in=INVOICE_TTL,
+            )
+        except Exception as e:
+            api_errors_total.inc("cryptopay", type(e).__name__)
+            raise
+    await database.save_invoice(inv.invoice_id, user_id, amount_ton, generations)
+    # в aiocryptopay 0.4 поле называется bot_invoice_url, pay_url — из старых версий API
+    return getattr(inv, "pay_url", None) or inv.bot_invoice_url
+
+
+# ───── проверка статусов только по ожидающим счетам
+async def refresh_invoices(invoice_ids: List[int], on_paid: Optional[OnPaid] = None) -> list:
+    """
+    Запрашивает в CryptoPay только переданные счета (пачками) и начисляет оплаченные.
+    Возвращает [(user_id, generations, баланс)] по счетам, зачисленным этим вызовом.
+    """
+    credited = []
+    for i in range(0, len(invoice_ids), POLL_BATCH):
+        batch = invoice_ids[i:i + POLL_BATCH]
+        with stage_seconds.time("check", "cryptopay"):
+            try:
+                items = await _client().get_invoices(invoice_ids=batch, count=len(batch))
+            except Exception as e:
+                api_errors_total.inc("cryptopay", type(e).__name__)
+                raise
+        if not isinstance(items, list):
+            items = [items] if items else []
+        for inv in items:
+            status = getattr(inv, "status", None)
+            if status == "paid":
+                res = await database.mark_invoice_paid(inv.invoice_id)
+                if res:
+                    credited.append(res)
+                    if on_paid:
+                        try:
+                            await on_paid(*res)
+                        except Exception as e:
+                            log.warning("on_paid(%s) failed: %s", inv.invoice_id, e)
+            elif status == "expired":
+                await database.mark_invoice_status(inv.invoice_id, "expired")
+    return credited
+
+
+# ───── счета, созданные до локального индекса
+def _parse_description(desc: str) -> Optional[Tuple[int, int]]:
+    """'<user_id>:<gens>' → (user_id, gens)."""
+    try:
+        user_id, gens = (desc or "").split(":")
+        return int(user_id), int(gens)
+    except ValueError:
+        return None
+
+
+async def import_legacy_invoices() -> int:
+    """
+    Разовый перенос: счета, выставленные до появления таблицы invoices, находятся старым способом —
+    полным обходом getInvoices с разбором description. Неоплаченные и оплаченные, но ещё не зачисленные
+    попадают в индекс и дальше зачисляются обычным опросом. Отметка в meta — второй раз не сканируем.
+    """
+    if await database.get_meta(LEGACY_MARK):
+        return 0
+    # поллер и /check могут прийти сюда одновременно — сканирует один
+    return await inflight.do("cryptopay:legacy", _import_legacy)
+
+
+async def _import_legacy() -> int:
+    if await database.get_meta(LEGACY_MARK):
+        return 0
+    items = []
+    for status in ("active", "paid"):
+        offset = 0
+        while True:
+            with stage_seconds.time("check", "cryptopay"):
+                try:
+                    page = await _client().get_invoices(status=status, offset=offset, count=LEGACY_SCAN_PAGE)
+                except Exception as e:
+                    api_errors_total.inc("cryptopay", type(e).__name__)
+                    raise
+            if not isinstance(page, list):
+                page = [page] if page else []
+            for inv in page:
+                parsed = _parse_description(getattr(inv, "description", None))
+                if parsed is None:
+                    continue
+                created = getattr(inv, "created_at", None)
+                items.append((
+                    inv.invoice_id, parsed[0], float(inv.amount), parsed[1],
+                    created.timestamp() if created else time.time(),
+                ))
+            if len(page) < LEGACY_SCAN_PAGE:
+                break
+            offset += len(page)
+    added = await database.import_invoices(items) if items else 0
+    await database.set_meta(LEGACY_MARK, str(int(time.time())))
+    if added:
+        log.info("CryptoPay: imported %d invoices created before the local index", added)
+    return added
+
+
+_poller_task: Optional[asyncio.Task] = None
+
+
+async def _poll_forever(on_paid: Optional[OnPaid], interval: float) -> None:
+    imported = False
+    while True:
+        if not imported:
+            try:
+                await import_legacy_invoices()
+                imported = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("CryptoPay legacy import: %s", e)
+        try:
+            pending = await database.pending_invoice_ids()
+            if pending:
+                await refresh_invoices(pending, on_paid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("CryptoPay poller: %s", e)
+        await asyncio.sleep(interval)
+
+
+def start_poller(on_paid: Optional[OnPaid] = None, interval: float = POLL_INTERVAL) -> None:
+    """Фоновый опрос ожидающих счетов: основной способ без webhook'а, сверка (RECONCILE_INTERVAL) — с ним."""
+    global _poller_task
+    if _poller_task is None:
+        _poller_task = asyncio.create_task(_poll_forever(on_paid, interval))
+
+
+async def stop_poller() -> None:
+    global _poller_task
+    task, _poller_task = _poller_task, None
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+# ───── webhook CryptoPay (альтернатива поллеру)
+def check_signature(body: bytes, signature: str) -> bool:
+    if not token:
+        return False
+    secret = hashlib.sha256(token.encode("utf-8")).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+_webhook_runner = None
+
+
+def webhook_app(on_paid: Optional[OnPaid] = None):
+    from aiohttp import web
+
+    async def handle(request: "web.Request") -> "web.Response":
+        body = await request.read()
+        if not check_signature(body, request.headers.get("crypto-pay-api-signature", "")):
+            return web.Response(status=401)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        if update.get("update_type") == "invoice_paid":
+            invoice_id = (update.get("payload") or {}).get("invoice_id")
+            if invoice_id is not None:
+                res = await database.mark_invoice_paid(int(invoice_id))
+                if res and on_paid:
+                    try:
+                        await on_paid(*res)
+                    except Exception as e:
+                        log.warning("on_paid(%s) failed: %s", invoice_id, e)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+
+async def start_webhook(on_paid: Optional[OnPaid] = None) -> bool:
+    """Поднимает приёмник webhook'ов CryptoPay, если задан CRYPTOPAY_WEBHOOK_PORT."""
+    global _webhook_runner
+    if not WEBHOOK_PORT or _webhook_runner is not None:
+        return False
+    from aiohttp import web
+    runner = web.AppRunner(webhook_app(on_paid))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    _webhook_runner = runner
+    log.info("CryptoPay webhook: http://%s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    return True
+
+
+async def stop_webhook() -> None:
+    global _webhook_runner
+    runner, _webhook_runner = _webhook_runner, None
+    if runner:
+        await runner.cleanup()
+
+
+async def close_client() -> None:
+    """Закрывает HTTP-сессию aiocryptopay (если клиент создавался). Вызывается из main.on_shutdown."""
+    global _cryptopay
+    client, _cryptopay = _cryptopay, None
+    if client is not None:
+        await client.close()
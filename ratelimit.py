@@ -0,0 +1,60 @@
+# ratelimit.py
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class TokenBucket:
+    """Классический token bucket: `rate` токенов в секунду, не больше `capacity` в запасе."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, n: float = 1) -> float:
+        """Сколько секунд ждать, пока можно будет взять n токенов (0 — можно сейчас)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < n:
+            wait = max(wait, (n - self.tokens) / self.rate)
+        return wait
+
+    def try_take(self, n: float = 1) -> bool:
+        if self.delay(n) > 0:
+            return False
+        self.tokens -= n
+        return True
+
+    def pause(self, seconds: float) -> None:
+        """Жёсткая пауза (например, Telegram ответил RetryAfter)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class BucketMap:
+    """Набор bucket'ов по ключу (chat_id, user_id, ...) с вытеснением давно неиспользуемых."""
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return b
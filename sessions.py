@@ -0,0 +1,334 @@
+# sessions.py
+import asyncio
+import json
+import logging
+import mmap
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import config
+import database
+from cache import result_cache
+from downloads import downloads
+
+log = logging.getLogger(__name__)
+
+SESSION_DIR = getattr(config, "SESSION_DIR", "cache/sessions")
+SESSION_MEM_BYTES = int(getattr(config, "SESSION_MEM_BYTES", 64 * 1024 * 1024))
+SESSION_DISK_BYTES = int(getattr(config, "SESSION_DISK_BYTES", 1024 * 1024 * 1024))
+SESSION_TTL = float(getattr(config, "SESSION_TTL", 24 * 3600))
+EDIT_HISTORY = int(getattr(config, "EDIT_HISTORY", 10))  # версий в цепочке правок (вместе с исходником)
+
+Key = Tuple[int, str]  # (user_id, "photo" | "mask" | "undo")
+
+
+class _Slot:
+    __slots__ = ("file_id", "data", "path", "size", "created")
+
+    def __init__(self, file_id: str, data: Optional[bytes]):
+        self.file_id = file_id
+        self.data = data
+        self.path: Optional[str] = None
+        self.size = len(data) if data else 0
+        self.created = time.time()
+
+
+class SessionStore:
+    """
+    Последние фото/маски пользователей вместо безлимитных dict'ов в памяти.
+    - источник правды — file_id в общей таблице user_state (видна всем инстансам бота);
+    - байты — только локальный кеш процесса, при промахе берём из downloads (качается лениво по file_id,
+      повторно — с диска по file_unique_id);
+    - байты в RAM — в пределах общего бюджета, лишнее (LRU) уходит на диск и читается через mmap;
+    - на диске тоже бюджет: сверх него байты выбрасываются (file_id в БД, скачаем заново);
+    - запись живёт не дольше SESSION_TTL;
+    - цепочка правок: результат правки становится текущим фото (только идентификаторы в истории версий,
+      байты — текущей и одной предыдущей версии, для /undo без скачивания). Байты версии берутся
+      из кеша результатов по result_key (оригинал без сжатия); file_id отправленного фото — сжатая копия,
+      она для показа в чате и на крайний случай, если оригинал уже вытеснен.
+    """
+
+    def __init__(self, root: str = SESSION_DIR, mem_budget: int = SESSION_MEM_BYTES,
+                 disk_budget: int = SESSION_DISK_BYTES, ttl: float = SESSION_TTL):
+        self.root = root
+        self.mem_budget = mem_budget
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        self._slots: "OrderedDict[Key, _Slot]" = OrderedDict()
+        self._mem = 0
+        self._disk = 0
+        self._enforcing = False
+
+    @property
+    def mem_bytes(self) -> int:
+        return self._mem
+
+    # ── общий индекс в БД
+    @staticmethod
+    def _state_key(kind: str) -> str:
+        return f"session:{kind}"
+
+    async def _meta(self, user_id: int, kind: str) -> Optional[dict]:
+        raw = await database.get_state(user_id, self._state_key(kind))
+        if not raw:
+            return None
+        meta = json.loads(raw)
+        if self.ttl and time.time() - meta.get("created", 0) > self.ttl:
+            await self.drop(user_id, kind)
+            return None
+        return meta
+
+    # ── запись
+    async def put(self, user_id: int, kind: str, file_id: str, data: Optional[bytes] = None,
+                  unique_id: Optional[str] = None) -> None:
+        meta = {"file_id": file_id, "created": time.time()}
+        if unique_id:
+            meta["unique_id"] = unique_id
+        await database.set_state(user_id, self._state_key(kind), json.dumps(meta))
+        await self._forget(user_id, kind)
+        if data is not None:
+            await self._remember(user_id, kind, file_id, data)
+        if kind == "photo":
+            # новое фото — новая цепочка правок
+            await self._forget(user_id, "undo")
+            await self._save_history(user_id, [dict(meta, prompt=None)])
+
+    async def has(self, user_id: int, kind: str) -> bool:
+        return await self._meta(user_id, kind) is not None
+
+    async def drop(self, user_id: int, kind: Optional[str] = None) -> None:
+        for k in ((kind,) if kind else ("photo", "mask")):
+            await database.set_state(user_id, self._state_key(k), None)
+            await self._forget(user_id, k)
+            if k == "photo":
+                await database.set_state(user_id, self._state_key("history"), None)
+                await self._forget(user_id, "undo")
+
+    # ── цепочка правок
+    async def history(self, user_id: int) -> List[dict]:
+        """Версии текущего фото: [исходник, правка 1, ...]; последняя — текущая."""
+        if await self._meta(user_id, "photo") is None:
+            return []
+        raw = await database.get_state(user_id, self._state_key("history"))
+        return json.loads(raw) if raw else []
+
+    async def _save_history(self, user_id: int, versions: List[dict]) -> None:
+        await database.set_state(user_id, self._state_key("history"), json.dumps(versions, ensure_ascii=False))
+
+    async def push_version(self, user_id: int, file_id: str, data: Optional[bytes], prompt: str,
+                           result_key: Optional[str] = None) -> int:
+        """
+        Результат правки становится текущим фото. Возвращает номер новой версии.
+        file_id — отправленное (сжатое) фото, result_key — его оригинал в кеше результатов.
+        """
+        versions = await self.history(user_id)
+        now = time.time()
+        version = {"file_id": file_id, "prompt": prompt, "created": now}
+        if result_key:
+            version["result_key"] = result_key
+        versions.append(version)
+        if len(versions) > EDIT_HISTORY:
+            # исходник оставляем, выбрасываем самые старые промежуточные версии
+            versions = versions[:1] + versions[len(versions) - EDIT_HISTORY + 1:]
+        await database.set_state(user_id, self._state_key("photo"), json.dumps(self._version_meta(version)))
+        await self._save_history(user_id, versions)
+        # байты прошлой версии — в слот «undo», чтобы откат не качал файл заново
+        await self._move(user_id, "photo", "undo")
+        if data is not None:
+            await self._remember(user_id, "photo", file_id, data)
+        return len(versions) - 1
+
+    async def revert(self, user_id: int, index: Optional[int] = None) -> Optional[Tuple[int, dict]]:
+        """
+        Делает текущей версию index (по умолчанию — предыдущую), более поздние отбрасывает.
+        (номер, версия) или None, если откатываться некуда.
+        """
+        versions = await self.history(user_id)
+        if index is None:
+            index = len(versions) - 2
+        if not 0 <= index < len(versions) - 1:
+            return None
+        target = versions[index]
+        versions = versions[:index + 1]
+        await database.set_state(
+            user_id, self._state_key("photo"), json.dumps(self._version_meta(target, created=time.time()))
+        )
+        await self._save_history(user_id, versions)
+        undo = await self._alive((user_id, "undo"))
+        if undo is not None and undo.file_id == target["file_id"]:
+            await self._move(user_id, "undo", "photo")
+        else:
+            await self._forget(user_id, "photo")
+            await self._forget(user_id, "undo")
+        return index, target
+
+    @staticmethod
+    def _version_meta(version: dict, created: Optional[float] = None) -> dict:
+        """Версия цепочки → запись «photo» в user_state (идентификаторы, без промпта)."""
+        meta = {"file_id": version["file_id"], "created": created or version["created"]}
+        for k in ("unique_id", "result_key"):
+            if version.get(k):
+                meta[k] = version[k]
+        return meta
+
+    # ── чтение: локальные байты, если они от того же file_id, иначе кеш результатов или скачиваем
+    async def snapshot(self, user_id: int) -> dict:
+        """
+        Идентификаторы текущих фото и маски ({"photo": meta, "mask": meta}) — для журнала остановки:
+        возобновлённая правка берёт те же картинки, даже если пользователь успел прислать новые.
+        """
+        snap = {}
+        for kind in ("photo", "mask"):
+            meta = await self._meta(user_id, kind)
+            if meta is not None:
+                snap[kind] = meta
+        return snap
+
+    async def get(self, user_id: int, kind: str, bot=None, meta: Optional[dict] = None) -> Optional[bytes]:
+        """Байты текущего фото/маски; meta — запись из snapshot() вместо текущей."""
+        if meta is None:
+            meta = await self._meta(user_id, kind)
+        if meta is None:
+            await self._forget(user_id, kind)
+            return None
+        file_id = meta["file_id"]
+        key = (user_id, kind)
+        slot = await self._alive(key)
+        if slot is not None and slot.file_id == file_id:
+            self._slots.move_to_end(key)
+            if slot.data is not None:
+                return slot.data
+            if slot.path:
+                try:
+                    return await asyncio.to_thread(self._read_spilled, slot.path)
+                except OSError:
+                    await self._forget(user_id, kind)
+        if meta.get("result_key"):
+            data = await self._original(meta["result_key"], bot)
+            if data is not None:
+                return data
+            log.warning("SessionStore: оригинал %s вытеснен, беру сжатую копию", meta["result_key"][:12])
+        if bot is None:
+            return None
+        # присланное пользователем лежит в кеше загрузок (mmap) — второй копии в RAM не держим
+        return await downloads.fetch(bot, file_id, meta.get("unique_id"))
+
+    @staticmethod
+    async def _original(result_key: str, bot=None):
+        """Результат правки без сжатия: из кеша результатов, иначе — PNG-документ, если его уже отправляли."""
+        entry = await result_cache.get(result_key)
+        if entry is None:
+            return None
+        data = await result_cache.read(entry)
+        if data:
+            return data
+        if entry.doc_file_id and bot is not None:
+            return await downloads.fetch(bot, entry.doc_file_id)
+        return None
+
+    # ── локальный кеш байтов (индекс правится сразу, файлы пишутся и удаляются в потоках)
+    async def _remember(self, user_id: int, kind: str, file_id: str, data: bytes) -> None:
+        await self._forget(user_id, kind)
+        slot = _Slot(file_id, data)
+        self._slots[(user_id, kind)] = slot
+        self._mem += slot.size
+        await self._enforce()
+
+    async def _move(self, user_id: int, src: str, dst: str) -> None:
+        old = self._slots.pop((user_id, dst), None)
+        slot = self._slots.pop((user_id, src), None)
+        if slot is not None:
+            self._slots[(user_id, dst)] = slot
+        if old is not None:
+            await self._release(old)
+
+    async def _forget(self, user_id: int, kind: str) -> None:
+        slot = self._slots.pop((user_id, kind), None)
+        if slot:
+            await self._release(slot)
+
+    @staticmethod
+    def _read_spilled(path: str) -> bytes:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
+
+    @staticmethod
+    def _write_spilled(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # ── бюджеты и TTL
+    async def _alive(self, key: Key) -> Optional[_Slot]:
+        slot = self._slots.get(key)
+        if slot is not None and self.ttl and time.time() - slot.created > self.ttl:
+            self._slots.pop(key, None)
+            await self._release(slot)
+            return None
+        return slot
+
+    async def _release(self, slot: _Slot) -> None:
+        if slot.data is not None:
+            self._mem -= slot.size
+            slot.data = None
+        if slot.path:
+            self._disk -= slot.size
+            path, slot.path = slot.path, None
+            await asyncio.to_thread(self._unlink, path)
+
+    async def _spill(self, key: Key, slot: _Slot) -> None:
+        path = os.path.join(self.root, f"{key[0]}_{key[1]}_{int(slot.created * 1000)}.bin")
+        data = slot.data
+        try:
+            await asyncio.to_thread(self._write_spilled, path, data)
+            written = True
+        except OSError as e:
+            log.warning("SessionStore: spill failed: %s", e)
+            written = False
+        if slot.data is not data:
+            # пока писали, слот освободили (_forget, TTL) — файл никому не нужен
+            if written:
+                await asyncio.to_thread(self._unlink, path)
+            return
+        if written:
+            slot.path = path
+            self._disk += slot.size
+        self._mem -= slot.size
+        slot.data = None
+
+    async def _enforce(self) -> None:
+        if self._enforcing:
+            return  # идёт другой проход — он и доведёт до бюджетов
+        self._enforcing = True
+        try:
+            now = time.time()
+            for key in [k for k, s in self._slots.items() if self.ttl and now - s.created > self.ttl]:
+                slot = self._slots.pop(key, None)
+                if slot is not None:
+                    await self._release(slot)
+            # RAM → диск (от давно неиспользованных)
+            while self._mem > self.mem_budget:
+                victim = next(((k, s) for k, s in self._slots.items() if s.data is not None), None)
+                if victim is None:
+                    break
+                await self._spill(*victim)
+            # сверх бюджета диска байты выбрасываем — в БД остаётся file_id, скачаем заново
+            while self._disk > self.disk_budget:
+                key = next((k for k, s in self._slots.items() if s.path), None)
+                if key is None:
+                    break
+                await self._release(self._slots.pop(key))
+        finally:
+            self._enforcing = False
+
+sessions = SessionStore()
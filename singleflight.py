@@ -0,0 +1,38 @@
+# singleflight.py
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых запросов, которые уже выполняются.
+    Первый вызов с ключом запускает задачу, остальные ждут её же результат.
+    Каждый ждущий защищён asyncio.shield: отмена одного не убивает общий вызов.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def inflight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, factory: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # если все ожидающие отменились — забираем исключение, чтобы не было warning'а
+        if not task.cancelled():
+            task.exception()
+
+
+inflight = SingleFlight()
@@ -0,0 +1,39 @@
+# tests/conftest.py
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Пути всех файловых хранилищ — во временный каталог до импорта config: тесты не трогают users.db и cache/
+_TMP = tempfile.mkdtemp(prefix="bot-tests-")
+for _name, _value in {
+    "DB_PATH": "users.db",
+    "WORK_DB_PATH": "work.db",
+    "CACHE_DIR": "cache/results",
+    "SESSION_DIR": "cache/sessions",
+    "DOWNLOAD_DIR": "cache/downloads",
+    "JOBS_JOURNAL": "jobs_journal.jsonl",
+}.items():
+    os.environ[_name] = os.path.join(_TMP, _value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def run(coro):
+    """Тесты синхронные: корутина — в свежем event loop (pytest-asyncio не нужен)."""
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Отдельная БД на тест: своё хранилище и пустые кеши балансов процесса."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(database, "_storage", database._Storage())
+    database._balance.clear()
+    database._balance_gen.clear()
+    database._paying.clear()
+    return database
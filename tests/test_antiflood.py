@@ -0,0 +1,104 @@
+# tests/test_antiflood.py
+import time
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+
+import antiflood
+import config
+from antiflood import AntiFlood
+from conftest import run
+
+
+class _Outbox:
+    def __init__(self):
+        self.sent = []
+
+    async def answer(self, message, text, **kwargs):
+        self.sent.append((message.from_user.id, text))
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = _Clock()
+    monkeypatch.setattr(time, "monotonic", c)
+    monkeypatch.setattr(config, "ADMIN_IDS", [])
+    return c
+
+
+@pytest.fixture
+def notices(monkeypatch):
+    box = _Outbox()
+    monkeypatch.setattr(antiflood, "outbox", box)
+    return box
+
+
+def _message(user_id, text=None, photo=None, caption=None):
+    data = {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": ""},
+    }
+    if text is not None:
+        data["text"] = text
+    if photo is not None:
+        data["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+        data["caption"] = caption
+    return types.Message(**data)
+
+
+def _passes(flood, message) -> bool:
+    try:
+        run(flood.on_pre_process_message(message, {}))
+    except CancelHandler:
+        return False
+    return True
+
+
+def test_each_operation_has_its_own_bucket(clock, notices):
+    flood = AntiFlood(limits="generate=60:2,edit=60:2,other=60:10")
+    assert [_passes(flood, _message(1, f"кот {i}")) for i in range(3)] == [True, True, False]
+    # генерации исчерпаны, но правка фото и справка — в своих bucket'ах
+    assert _passes(flood, _message(1, photo="p1", caption="очки"))
+    assert _passes(flood, _message(1, "/balance"))
+    # другой пользователь — свой bucket
+    assert _passes(flood, _message(2, "кот"))
+    # 60 в минуту — через секунду токен появился
+    clock.now += 1
+    assert _passes(flood, _message(1, "кот 3"))
+    assert notices.sent == [(1, "⏳ Слишком много запросов подряд. Попробуй через 1 с.")]
+
+
+def test_rate_notice_is_sent_once_per_interval(clock, notices):
+    flood = AntiFlood(limits="generate=6:1,other=60:10")
+    results = [_passes(flood, _message(1, f"кот {i}")) for i in range(4)]
+    assert results == [True, False, False, False]
+    assert len(notices.sent) == 1
+    # через FLOOD_NOTICE_INTERVAL токен накопился, а следующий отказ снова объясняется
+    clock.now += antiflood.FLOOD_NOTICE_INTERVAL
+    assert _passes(flood, _message(1, "ещё кот"))
+    assert not _passes(flood, _message(1, "и ещё кот"))
+    assert len(notices.sent) == 2
+
+
+def test_same_message_within_window_is_dropped_silently(clock, notices):
+    flood = AntiFlood(limits="generate=60:10,edit=60:10,other=60:10", dedup_window=3)
+    assert _passes(flood, _message(1, "кот"))
+    assert not _passes(flood, _message(1, "кот"))  # двойное нажатие «отправить»
+    assert _passes(flood, _message(2, "кот"))  # у другого пользователя — не повтор
+    # та же подпись к другому фото — новый запрос
+    assert _passes(flood, _message(1, photo="p1", caption="очки"))
+    assert _passes(flood, _message(1, photo="p2", caption="очки"))
+    clock.now += 3
+    assert _passes(flood, _message(1, photo="p2", caption="очки"))  # окно прошло
+    assert notices.sent == []
@@ -0,0 +1,114 @@
+# tests/test_coalescing.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import handlers
+from conftest import run
+from jobs import GenerationQueue
+
+
+class _Status:
+    def __init__(self):
+        self.text = "⏳"
+        self.shown = []
+
+    async def update(self, text):
+        self.shown.append(text)
+
+
+class _Preview:
+    def __init__(self):
+        self.frames = []
+
+    async def show(self, data):
+        self.frames.append(data)
+
+
+class _Cache:
+    def __init__(self):
+        self.put_calls = []
+
+    async def get(self, key):
+        return None
+
+    async def put(self, key, data):
+        self.put_calls.append(key)
+
+
+def _message(user_id):
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id))
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    q = GenerationQueue(workers=1, per_user_inflight=1)
+    monkeypatch.setattr(handlers, "gen_queue", q)
+    monkeypatch.setattr(handlers, "result_cache", _Cache())
+    monkeypatch.setattr(handlers, "is_paying_user", lambda user_id: asyncio.sleep(0, result=user_id == 2))
+    return q
+
+
+def test_followers_share_one_call_but_keep_own_status_and_priority(queue):
+    async def scenario():
+        await queue.start()
+        gate = asyncio.Event()
+        calls = 0
+
+        async def factory(on_partial):
+            nonlocal calls
+            calls += 1
+            await on_partial(b"draft")
+            return b"png"
+
+        # воркер занят, перед общей задачей — чужая бесплатная
+        busy = queue.submit(99, gate.wait)
+        queue.submit(98, lambda: asyncio.sleep(0))
+        waiters = [(_message(uid), _Status(), _Preview()) for uid in (1, 2)]
+        tasks = [
+            asyncio.create_task(handlers._cached_or_run(m, st, pv, "k", factory, is_admin=False))
+            for m, st, pv in waiters
+        ]
+        for _ in range(5):
+            await asyncio.sleep(0)
+        (job,) = [shared.job for shared in handlers._shared.values()]
+        # платящий (2) присоединился к бесплатной задаче (1) — она ушла в приоритетный уровень
+        promoted = job.priority
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        await busy.future
+        await queue.stop()
+        return calls, results, promoted, waiters
+
+    calls, results, promoted, waiters = run(scenario())
+    assert calls == 1
+    assert results == [(b"png", None)] * 2
+    assert promoted
+    for _, status, preview in waiters:
+        assert status.shown  # позицию в очереди видит каждый ждущий
+        assert preview.frames == [b"draft"]
+    assert handlers._shared == {}
+
+
+def test_regenerate_is_not_coalesced(queue):
+    async def scenario():
+        await queue.start()
+        calls = 0
+
+        async def factory(on_partial):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return b"png"
+
+        await asyncio.gather(*(
+            handlers._cached_or_run(_message(uid), _Status(), _Preview(), "k", factory, is_admin=False, use_cache=False)
+            for uid in (1, 2)
+        ))
+        await queue.stop()
+        return calls, handlers.result_cache.put_calls
+
+    calls, cached = run(scenario())
+    assert calls == 2
+    assert cached == []
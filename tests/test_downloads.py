@@ -0,0 +1,105 @@
+# tests/test_downloads.py
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import downloads as downloads_module
+from conftest import run
+from downloads import Downloads
+from imaging import ImageError
+
+
+class _Content:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, _size):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class _Response:
+    def __init__(self, chunks, content_length):
+        self.content = _Content(chunks)
+        self.content_length = content_length
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _Bot:
+    """Bot API: getFile и скачивание тела; считает обращения."""
+
+    proxy = proxy_auth = None
+
+    def __init__(self, body=b"", file_size=None, content_length=None, chunk=4):
+        self.body = body
+        self.file_size = file_size
+        self.content_length = content_length
+        self.chunk = chunk
+        self.get_file_calls = 0
+        self.transfers = 0
+
+    async def get_file(self, file_id):
+        self.get_file_calls += 1
+        return SimpleNamespace(file_size=self.file_size, file_unique_id="u-" + file_id, file_path="photos/" + file_id)
+
+    async def get_session(self):
+        return self
+
+    def get(self, url, **kwargs):
+        self.transfers += 1
+        chunks = [self.body[i:i + self.chunk] for i in range(0, len(self.body), self.chunk)]
+        return _Response(chunks, self.content_length)
+
+    def get_file_url(self, file_path):
+        return "https://api.telegram.test/file/" + file_path
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads_module, "DOWNLOAD_MAX_BYTES", 10)
+    return Downloads(root=str(tmp_path / "dl"))
+
+
+def test_size_from_update_rejects_before_get_file(store):
+    bot = _Bot(b"x" * 20)
+    with pytest.raises(ImageError):
+        run(store.fetch(bot, "f1", "u-f1", size=11))
+    assert bot.get_file_calls == 0 and bot.transfers == 0
+
+
+def test_size_from_get_file_rejects_before_transfer(store):
+    bot = _Bot(b"x" * 20, file_size=20)
+    with pytest.raises(ImageError):
+        run(store.fetch(bot, "f1"))
+    assert bot.get_file_calls == 1 and bot.transfers == 0
+
+
+def test_oversized_body_is_cut_off_and_leaves_nothing(store):
+    # Content-Length известен — отказ до чтения тела; неизвестен — обрыв на первом лишнем куске
+    for content_length in (20, None):
+        bot = _Bot(b"x" * 20, content_length=content_length)
+        with pytest.raises(ImageError):
+            run(store.fetch(bot, "f1"))
+        assert bot.transfers == 1
+        assert os.listdir(store.root) == []
+        assert store._total == 0
+
+
+def test_forwarded_copy_is_served_from_disk(store):
+    bot = _Bot(b"png-bytes")
+
+    async def scenario():
+        first = await store.fetch(bot, "f1")
+        data = first[:]
+        # пересылка той же картинки: другой file_id, тот же file_unique_id из апдейта
+        again = await store.fetch(bot, "f2", "u-f1", size=9)
+        return data, again[:]
+
+    assert run(scenario()) == (b"png-bytes", b"png-bytes")
+    assert bot.get_file_calls == 1 and bot.transfers == 1
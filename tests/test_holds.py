@@ -0,0 +1,101 @@
+# tests/test_holds.py
+import asyncio
+import sqlite3
+
+import pytest
+
+from conftest import run
+
+FREE = 3  # database.FREE_CREDITS_ON_FIRST_SEEN
+
+
+async def _ledger_balanced(db, user_id: int) -> bool:
+    """Сумма движений в ledger == баланс (резерв списывается сразу, commit пишет 0, release — возврат)."""
+    def q(c):
+        ledger = c.execute("SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE user_id = ?", (user_id,)).fetchone()[0]
+        credits = c.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return ledger == credits
+    return await db._storage.read(q)
+
+
+def test_reserve_commit_release(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        a = await db.reserve_credits(1)
+        b = await db.reserve_credits(1)
+        during = await db.get_credits(1)
+        assert await db.commit_hold(a)
+        assert await db.release_hold(b)
+        assert not await db.release_hold(b)  # повторный release — no-op
+        return during, await db.get_credits(1), await _ledger_balanced(db, 1)
+
+    during, after, balanced = run(scenario())
+    assert during == FREE - 2
+    assert after == FREE - 1
+    assert balanced
+
+
+def test_parallel_reserves_never_overdraw(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        holds = await asyncio.gather(*(db.reserve_credits(1) for _ in range(FREE + 2)))
+        return holds, await db.get_credits(1), await _ledger_balanced(db, 1)
+
+    holds, left, balanced = run(scenario())
+    assert sum(h is not None for h in holds) == FREE
+    assert left == 0
+    assert balanced
+
+
+def test_commit_with_fewer_results_refunds_the_rest(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db.add_uses(1, 10)
+        hold = await db.reserve_credits(1, 4)
+        await db.commit_hold(hold, used=1)
+        return await db.get_credits(1), await _ledger_balanced(db, 1)
+
+    assert run(scenario()) == (FREE + 10 - 1, True)
+
+
+def test_expired_hold_is_returned_then_charged_on_commit(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        hold = await db.reserve_credits(1, 2, ttl=-1)
+        assert await db.expire_holds() == 1
+        returned = await db.get_credits(1)
+        # генерация всё же удалась после истечения резерва — не бесплатно
+        assert await db.commit_hold(hold)
+        charged = await db.get_credits(1)
+        # повторный commit ничего не списывает
+        assert not await db.commit_hold(hold)
+        return returned, charged, await db.get_credits(1), await _ledger_balanced(db, 1)
+
+    assert run(scenario()) == (FREE, FREE - 2, FREE - 2, True)
+
+
+def test_late_charge_never_goes_negative(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        hold = await db.reserve_credits(1, 2, ttl=-1)
+        await db.expire_holds()
+        # пока резерв был «истёкшим», пользователь потратил почти всё
+        spent = await db.reserve_credits(1, FREE - 1)
+        await db.commit_hold(spent)
+        await db.commit_hold(hold)
+        return await db.get_credits(1), await _ledger_balanced(db, 1)
+
+    assert run(scenario()) == (0, True)
+
+
+def test_ledger_is_append_only(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db.add_uses(1, 1)
+        with pytest.raises(sqlite3.DatabaseError, match="append-only"):
+            await db._storage.write(lambda c: c.execute("UPDATE ledger SET delta = 100"))
+        with pytest.raises(sqlite3.DatabaseError, match="append-only"):
+            await db._storage.write(lambda c: c.execute("DELETE FROM ledger"))
+        return await _ledger_balanced(db, 1)
+
+    assert run(scenario())
@@ -0,0 +1,109 @@
+# tests/test_invoices.py
+import asyncio
+import datetime
+
+import pytest
+
+import payment
+from conftest import run
+
+FREE = 3
+
+
+class _Invoice:
+    def __init__(self, invoice_id: int, status: str, description: str = "", amount: str = "1"):
+        self.invoice_id = invoice_id
+        self.status = status
+        self.description = description
+        self.amount = amount
+        self.created_at = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeCryptoPay:
+    """getInvoices: по invoice_ids — текущие статусы, без них — постраничный обход по status (старый способ)."""
+
+    def __init__(self, statuses=None, history=()):
+        self.statuses = dict(statuses or {})
+        self.history = list(history)
+        self.scans = 0
+
+    async def get_invoices(self, invoice_ids=None, status=None, offset=0, count=None, **_):
+        await asyncio.sleep(0)
+        if invoice_ids is not None:
+            return [_Invoice(i, self.statuses.get(i, "active")) for i in invoice_ids]
+        self.scans += 1
+        found = [inv for inv in self.history if inv.status == status]
+        return found[offset:offset + count]
+
+
+@pytest.fixture
+def cryptopay(monkeypatch):
+    fake = FakeCryptoPay()
+    monkeypatch.setattr(payment, "_cryptopay", fake)
+    return fake
+
+
+def test_paid_invoice_is_credited_once(db, cryptopay):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db.save_invoice(10, user_id=1, amount=1.0, generations=10)
+        await db.save_invoice(11, user_id=1, amount=4.0, generations=50)
+        cryptopay.statuses = {10: "paid", 11: "expired"}
+        notified = []
+
+        async def on_paid(user_id, gens, left):
+            notified.append((user_id, gens, left))
+
+        first = await payment.refresh_invoices(await db.pending_invoice_ids(), on_paid)
+        # повторный опрос и запоздавший webhook по тому же счёту ничего не начисляют
+        second = await payment.refresh_invoices([10], on_paid)
+        late_webhook = await db.mark_invoice_paid(10)
+        return first, second, late_webhook, notified, await db.pending_invoice_ids(), await db.get_credits(1)
+
+    first, second, late_webhook, notified, pending, credits = run(scenario())
+    assert first == [(1, 10, FREE + 10)]
+    assert second == [] and late_webhook is None
+    assert notified == [(1, 10, FREE + 10)]
+    assert pending == []  # 11 истёк, 10 оплачен
+    assert credits == FREE + 10
+
+
+def test_pending_only_for_that_user(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db.save_invoice(1, user_id=1, amount=1.0, generations=10)
+        await db.save_invoice(2, user_id=2, amount=1.0, generations=10)
+        return await db.pending_invoice_ids(1), await db.pending_invoice_ids()
+
+    assert run(scenario()) == ([1], [1, 2])
+
+
+def test_legacy_invoices_are_imported_once(db, cryptopay, monkeypatch):
+    monkeypatch.setattr(payment, "LEGACY_SCAN_PAGE", 2)  # несколько страниц
+    cryptopay.history = [
+        _Invoice(1, "active", "7:10"),
+        _Invoice(2, "paid", "7:50"),
+        _Invoice(3, "paid", "8:10"),  # уже зачислен старым /check — есть в payments
+        _Invoice(4, "paid", "мусор"),
+        _Invoice(5, "active", "9:10"),
+    ]
+    cryptopay.statuses = {1: "active", 2: "paid", 5: "active"}
+
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db._storage.write(lambda c: c.execute(
+            "INSERT INTO payments (payment_id, user_id, amount, confirmed) VALUES ('3', 8, 1.0, 1)"
+        ))
+        # поллер и /check пришли одновременно — обход один
+        imported = await asyncio.gather(payment.import_legacy_invoices(), payment.import_legacy_invoices())
+        scans = cryptopay.scans
+        again = await payment.import_legacy_invoices()
+        credited = await payment.refresh_invoices(await db.pending_invoice_ids())
+        return imported, scans, again, cryptopay.scans, credited, await db.get_credits(8)
+
+    imported, scans, again, scans_after, credited, user8 = run(scenario())
+    assert imported == [3, 3]
+    assert scans == 4  # по две страницы на active (2 + 0) и paid (2 + 1)
+    assert again == 0 and scans_after == scans
+    assert credited == [(7, 50, FREE + 50)]
+    assert user8 == FREE  # второй раз за счёт 3 не начислили
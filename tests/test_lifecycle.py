@@ -0,0 +1,145 @@
+# tests/test_lifecycle.py
+import asyncio
+import json
+import time
+
+import pytest
+
+from conftest import run
+from lifecycle import Draining, Lifecycle
+
+
+def _journal(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_drain_waits_for_jobs_that_finish_in_time(tmp_path):
+    async def scenario():
+        lc = Lifecycle(path=str(tmp_path / "j.jsonl"), drain_timeout=5)
+        lc.set_ready()
+
+        async def job():
+            j = lc.begin({"op": "generate", "prompt": "кот"})
+            try:
+                await asyncio.sleep(0.01)
+            finally:
+                lc.end(j)
+
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        journaled = await lc.drain()
+        await task
+        return journaled, time.monotonic() - started, lc.state
+
+    journaled, took, state = run(scenario())
+    assert journaled == 0 and took < 1
+    assert state == "stopped"
+    assert not (tmp_path / "j.jsonl").exists()
+
+
+def test_drain_journals_unpaid_and_cancels_everything(tmp_path):
+    path = tmp_path / "j.jsonl"
+
+    async def scenario():
+        lc = Lifecycle(path=str(path), drain_timeout=0.05)
+        lc.set_ready()
+        cancelled = []
+
+        async def job(prompt, paid):
+            j = lc.begin({"op": "generate", "prompt": prompt, "user_id": 1, "chat_id": 1})
+            try:
+                if paid:
+                    lc.committed(j)  # commit_hold уже был — осталось отправить
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+            finally:
+                lc.end(j)
+
+        tasks = [asyncio.create_task(job(p, paid)) for p, paid in (("a", False), ("b", True), ("c", False))]
+        await asyncio.sleep(0)
+        journaled = await lc.drain()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return journaled, sorted(cancelled)
+
+    journaled, cancelled = run(scenario())
+    assert journaled == 2
+    # оплаченная «b» в журнал не попала — повтор списал бы второй раз
+    assert sorted(e["prompt"] for e in _journal(path)) == ["a", "c"]
+    assert cancelled == ["a", "b", "c"]
+
+
+def test_begin_refuses_once_drain_started(tmp_path):
+    async def scenario():
+        lc = Lifecycle(path=str(tmp_path / "j.jsonl"))
+        with pytest.raises(Draining):
+            lc.begin({"op": "generate", "prompt": "до готовности"})
+        lc.set_ready()
+        drained = asyncio.create_task(lc.drain())
+        await asyncio.sleep(0)
+        # резерв закончился уже после снимка drain — такую генерацию не начинаем
+        with pytest.raises(Draining):
+            lc.begin({"op": "generate", "prompt": "поздний"})
+        assert await drained == 0 and lc.inflight == 0
+
+    run(scenario())
+
+
+def test_resume_runs_fresh_entries_and_drops_stale(tmp_path):
+    path = tmp_path / "j.jsonl"
+    now = time.time()
+    with open(path, "w", encoding="utf-8") as f:
+        for prompt, ts in (("fresh", now - 10), ("stale", now - 10 * 24 * 3600)):
+            f.write(json.dumps({"op": "generate", "prompt": prompt, "ts": ts}) + "\n")
+        f.write("not json\n")
+
+    async def scenario():
+        lc = Lifecycle(path=str(path))
+        ran = []
+
+        async def runner(entry):
+            ran.append(entry["prompt"])
+
+        resumed = await lc.resume(runner)
+        await asyncio.sleep(0)
+        return resumed, ran
+
+    resumed, ran = run(scenario())
+    assert resumed == 1 and ran == ["fresh"]
+    assert not path.exists()  # журнал забран — второй старт не повторит
+
+
+def test_defer_during_drain_goes_to_journal(tmp_path):
+    path = tmp_path / "j.jsonl"
+
+    async def scenario():
+        lc = Lifecycle(path=str(path))
+        lc.set_ready()
+        await lc.drain()
+        assert lc.draining and not lc.ready
+        await lc.defer({"op": "edit", "prompt": "очки", "source": {"photo": {"file_id": "f1", "unique_id": "u1"}}})
+
+    run(scenario())
+    (entry,) = _journal(path)
+    assert entry["source"]["photo"]["unique_id"] == "u1"
+    assert entry["ts"] > 0
+
+
+def test_resumed_edit_uses_the_photo_it_was_requested_on(db):
+    from cache import result_cache
+    from sessions import sessions
+
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await sessions.put(1, "photo", file_id="orig", unique_id="u-orig", data=b"orig")
+        await result_cache.put("edit-key", b"lossless edit result")
+        await sessions.push_version(1, "jpeg-preview", None, "очки", result_key="edit-key")
+        source = await sessions.snapshot(1)  # то, что пишется в журнал вместе с /edit
+        # после рестарта пользователь уже прислал другое фото
+        await sessions.put(1, "photo", file_id="other", unique_id="u-other", data=b"other")
+        return await sessions.get(1, "photo", meta=source["photo"]), await sessions.get(1, "photo")
+
+    assert run(scenario()) == (b"lossless edit result", b"other")
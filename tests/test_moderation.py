@@ -0,0 +1,87 @@
+# tests/test_moderation.py
+import asyncio
+
+import moderation
+from cache import normalize_prompt
+from conftest import run
+from moderation import BlockList
+
+BLOCKED = "очень откровенная фотосессия девушки на пляже в бикини без одежды"
+NEAR = BLOCKED + " ночью"
+
+
+def _distance(a, b):
+    sh = [moderation.simhash(moderation._features(normalize_prompt(t))) for t in (a, b)]
+    return moderation._distance(*sh)
+
+
+def _with_blocklist(db, scenario):
+    """Сценарий с пустым BlockList; запись блоков в SQLite — фоновые задачи того же loop."""
+    async def main():
+        await db.init_db(maintenance=False)
+        blocklist = BlockList()
+        result = await scenario(blocklist)
+        await asyncio.sleep(0)
+        return result
+
+    return run(main())
+
+
+def test_near_duplicate_is_blocked_within_threshold(db, monkeypatch):
+    d = _distance(BLOCKED, NEAR)
+    assert d > 0
+
+    async def scenario(blocklist):
+        blocklist.remember(BLOCKED, ["sexual"])
+        monkeypatch.setattr(moderation, "MODERATION_NEAR_BITS", d)
+        within = blocklist.check(NEAR)
+        monkeypatch.setattr(moderation, "MODERATION_NEAR_BITS", d - 1)
+        beyond = blocklist.check(NEAR)
+        # регистр и пробелы нормализуются — это точное совпадение при любом пороге
+        exact = blocklist.check("  ОЧЕНЬ откровенная фотосессия девушки на пляже в бикини без одежды ")
+        return within, beyond, exact
+
+    within, beyond, exact = _with_blocklist(db, scenario)
+    assert within == (["sexual"], "near")
+    assert beyond is None
+    assert exact == (["sexual"], "exact")
+
+
+def test_unrelated_and_short_prompts_are_not_near(db):
+    async def scenario(blocklist):
+        blocklist.remember(BLOCKED, ["sexual"])
+        blocklist.remember("голая", ["sexual"])
+        return [blocklist.check(p) for p in ("пейзаж гор на закате с озером и лодкой", "голая", "голая девушка")]
+
+    unrelated, short_exact, short_near = _with_blocklist(db, scenario)
+    assert unrelated is None
+    # короткий промпт — только точное совпадение, simhash слишком грубый
+    assert short_exact == (["sexual"], "exact")
+    assert short_near is None
+
+
+def test_edit_block_applies_only_to_the_same_photo(db, monkeypatch):
+    monkeypatch.setattr(moderation, "MODERATION_NEAR_BITS", 64)  # любой текст — «почти тот же»
+
+    async def scenario(blocklist):
+        blocklist.remember(BLOCKED, ["sexual"], b"photo-1")
+        return [blocklist.check(p, image) for p, image in (
+            (BLOCKED, b"photo-1"), (NEAR, b"photo-1"), (BLOCKED, b"photo-2"), (BLOCKED, None),
+        )]
+
+    same, near, other_photo, no_photo = _with_blocklist(db, scenario)
+    assert same == (["sexual"], "exact")
+    assert near == (["sexual"], "near")
+    # блок правки мог быть из-за самой картинки: на другом фото и без фото тот же промпт пропускаем
+    assert other_photo is None and no_photo is None
+
+
+def test_clear_lifts_block_in_every_scope(db):
+    async def scenario(blocklist):
+        blocklist.remember(BLOCKED, ["sexual"])
+        blocklist.remember(BLOCKED, ["sexual"], b"photo-1")
+        await asyncio.sleep(0.05)  # фоновые записи в SQLite
+        cleared = await blocklist.clear(BLOCKED)
+        return cleared, blocklist.check(BLOCKED), blocklist.check(BLOCKED, b"photo-1")
+
+    assert _with_blocklist(db, scenario) == (2, None, None)
@@ -0,0 +1,113 @@
+# tests/test_providers.py
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import generator
+from conftest import run
+
+
+def test_cfg_falls_back_on_malformed_values(monkeypatch):
+    monkeypatch.setenv("TEST_GEN_INT", "4.5")
+    monkeypatch.setenv("TEST_GEN_FLOAT", "2")
+    monkeypatch.setenv("TEST_GEN_BAD", "много")
+    assert generator._cfg("TEST_GEN_INT", 4, int) == 4  # дробное для целой настройки — по умолчанию
+    assert generator._cfg("TEST_GEN_FLOAT", 1.0, float) == 2.0
+    assert generator._cfg("TEST_GEN_BAD", 30.0, float) == 30.0
+    assert generator._cfg("TEST_GEN_MISSING", 7, int) == 7
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class _Raw:
+    def __init__(self, result, headers=None):
+        self.headers = headers or {}
+        self._result = result
+
+    def parse(self):
+        return self._result
+
+
+def _error(cls, status, headers=None):
+    request = httpx.Request("POST", "https://api.openai.test/v1/images/generations")
+    return cls("boom", response=httpx.Response(status, headers=headers or {}, request=request), body=None)
+
+
+def _pool(*scripts):
+    """Пул из ключей-заглушек: каждый отвечает по своему сценарию (исключение или результат)."""
+    pool = generator.ProviderPool([(f"sk-test-key{i}", None, "https://api.openai.test/v1") for i in range(len(scripts))], None)
+    for provider, script in zip(pool.providers, scripts):
+        async def generate(_script=list(script), _provider=provider, **kwargs):
+            _provider.calls = getattr(_provider, "calls", 0) + 1
+            outcome = _script.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        provider.client = SimpleNamespace(images=SimpleNamespace(with_raw_response=SimpleNamespace(generate=generate)))
+    return pool
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = _Clock()
+    monkeypatch.setattr(generator.time, "monotonic", c)
+    monkeypatch.setattr(generator, "OPENAI_BACKOFF_BASE", 0.0)
+    return c
+
+
+def test_pick_prefers_key_with_most_remaining_quota(clock):
+    pool = _pool([], [], [])
+    low, high, unknown = pool.providers
+    low.observe({"x-ratelimit-remaining-requests": "2", "x-ratelimit-reset-requests": "30s"})
+    high.observe({"x-ratelimit-remaining-requests": "40", "x-ratelimit-reset-requests": "1m0s"})
+    assert pool.pick(set()) is unknown  # лимиты неизвестны — ключ считается свободным
+    assert pool.pick({unknown}) is high
+    clock.now += 31  # окно у low сбросилось — снова «свободен», а у high ещё нет
+    assert pool.pick({unknown}) is low
+
+
+def test_rate_limited_key_cools_down_and_call_moves_on(clock):
+    pool = _pool([_error(openai.RateLimitError, 429, {"retry-after": "7"})], [_Raw("png")])
+    first, second = pool.providers
+    second.remaining, second.reset_at = 1, clock.now + 60  # первым выбирается first
+
+    assert run(pool.call("generate", prompt="кот")) == "png"
+    assert first.blocked_until == clock.now + 7
+    assert not first.available(clock.now + 6) and first.available(clock.now + 7)
+
+
+def test_breaker_opens_then_half_open_probe_decides(clock, monkeypatch):
+    monkeypatch.setattr(generator, "OPENAI_BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(generator, "OPENAI_BREAKER_COOLDOWN", 30.0)
+    (p,) = _pool([]).providers
+    for _ in range(2):
+        p.failure()
+    assert p.available(clock.now)
+    p.failure()  # порог — ключ выключен на cooldown
+    assert not p.available(clock.now)
+    clock.now += 30
+    assert p.available(clock.now)  # half-open: одна пробная попытка
+    p.failure()  # проба не удалась — сразу снова открыт
+    assert not p.available(clock.now)
+    clock.now += 30
+    p.success()  # проба удалась — счётчик с нуля
+    p.failure()
+    assert p.available(clock.now)
+
+
+def test_all_keys_open_raises_unavailable(clock, monkeypatch):
+    monkeypatch.setattr(generator, "OPENAI_BACKOFF_MAX", 5.0)
+    pool = _pool([_error(openai.InternalServerError, 500)], [_error(openai.InternalServerError, 500)])
+    for p in pool.providers:
+        p.blocked_until = clock.now + 60  # дольше, чем готовы ждать
+    with pytest.raises(generator.ProviderUnavailable):
+        run(pool.call("generate", prompt="кот"))
+    assert all(getattr(p, "calls", 0) == 0 for p in pool.providers)
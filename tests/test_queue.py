@@ -0,0 +1,117 @@
+# tests/test_queue.py
+import asyncio
+
+import pytest
+
+from conftest import run
+from jobs import GenerationQueue, QueueFullError
+
+
+def _job(log, name, delay=0.0):
+    async def factory():
+        log.append(name)
+        await asyncio.sleep(delay)
+        return name
+    return factory
+
+
+def test_round_robin_between_users():
+    async def scenario():
+        q = GenerationQueue(workers=1, per_user_inflight=1, max_pending_per_user=5)
+        await q.start()
+        log = []
+        jobs = [q.submit(uid, _job(log, name)) for uid, name in
+                [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1")]]
+        await asyncio.gather(*(j.future for j in jobs))
+        await q.stop()
+        return log
+
+    # пользователь с тремя задачами не обгоняет остальных: по одной за круг
+    assert run(scenario()) == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_priority_tier_goes_first():
+    async def scenario():
+        q = GenerationQueue(workers=1)
+        await q.start()
+        log = []
+        jobs = [q.submit(1, _job(log, "free")), q.submit(2, _job(log, "paid"), priority=True)]
+        await asyncio.gather(*(j.future for j in jobs))
+        await q.stop()
+        return log
+
+    assert run(scenario()) == ["paid", "free"]
+
+
+def test_per_user_inflight_limit():
+    async def scenario():
+        q = GenerationQueue(workers=4, per_user_inflight=2, max_pending_per_user=10)
+        await q.start()
+        running, peak = 0, 0
+
+        async def factory():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        jobs = [q.submit(1, factory) for _ in range(6)]
+        await asyncio.gather(*(j.future for j in jobs))
+        await q.stop()
+        return peak
+
+    assert run(scenario()) == 2
+
+
+def test_pending_limits():
+    async def scenario():
+        q = GenerationQueue(workers=1, max_pending=3, max_pending_per_user=2)
+        await q.start()
+        blocker = asyncio.Event()
+
+        async def wait():
+            await blocker.wait()
+
+        q.submit(1, wait)
+        while not q.inflight:  # воркер взял первую задачу — она больше не в ожидании
+            await asyncio.sleep(0)
+        q.submit(1, wait)
+        q.submit(1, wait)
+        with pytest.raises(QueueFullError, match="user_queue_full"):
+            q.submit(1, wait)
+        q.submit(2, wait)
+        with pytest.raises(QueueFullError, match="queue_full"):
+            q.submit(3, wait)
+        blocker.set()
+        await q.stop()
+
+    run(scenario())
+
+
+def test_cancelled_waiter_is_skipped():
+    async def scenario():
+        q = GenerationQueue(workers=1)
+        await q.start()
+        log = []
+        first = q.submit(1, _job(log, "first", 0.01))
+        gone = q.submit(2, _job(log, "gone"))
+        last = q.submit(3, _job(log, "last"))
+        gone.future.cancel()
+        await asyncio.gather(first.future, last.future)
+        await q.stop()
+        return log
+
+    assert run(scenario()) == ["first", "last"]
+
+
+def test_submit_after_stop_fails_fast():
+    async def scenario():
+        q = GenerationQueue(workers=1)
+        await q.start()
+        await q.stop()
+        # воркеров нет — задача ждала бы вечно, а хендлер держал бы резерв кредитов
+        with pytest.raises(RuntimeError):
+            q.submit(1, _job([], "late"))
+
+    run(scenario())
@@ -0,0 +1,29 @@
+# tests/test_sessions.py
+import os
+
+from conftest import run
+from sessions import SessionStore
+
+
+def test_spill_to_disk_and_drop_over_disk_budget(db, tmp_path):
+    root = tmp_path / "sessions"
+    store = SessionStore(root=str(root), mem_budget=10, disk_budget=20, ttl=0)
+
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await store.put(1, "photo", file_id="a", data=b"a" * 8)
+        await store.put(2, "photo", file_id="b", data=b"b" * 8)
+        # RAM-бюджет 10 байт: первое фото ушло на диск и читается оттуда
+        spilled = sorted(os.listdir(root))
+        first = await store.get(1, "photo")
+        await store.put(3, "photo", file_id="c", data=b"c" * 8)
+        await store.put(4, "photo", file_id="d", data=b"d" * 8)
+        # на диске бюджет 20 байт — выброшено давно не читанное «2» (в БД file_id остался, скачаем заново)
+        return spilled, first, store.mem_bytes, sorted(os.listdir(root)), await store.get(2, "photo")
+
+    spilled, first, mem, left, gone = run(scenario())
+    assert len(spilled) == 1 and spilled[0].startswith("1_photo_")
+    assert first == b"a" * 8
+    assert mem <= 10
+    assert len(left) == 2 and not any(name.startswith("2_photo_") for name in left)
+    assert gone is None  # bot не передан — скачивать нечем
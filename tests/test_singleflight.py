@@ -0,0 +1,84 @@
+# tests/test_singleflight.py
+import asyncio
+
+import pytest
+
+from conftest import run
+from singleflight import SingleFlight
+
+
+def test_identical_calls_share_one_run():
+    async def scenario():
+        sf = SingleFlight()
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return b"png"
+
+        results = await asyncio.gather(*(sf.do("k", factory) for _ in range(5)))
+        return calls, results, len(sf)
+
+    calls, results, left = run(scenario())
+    assert calls == 1
+    assert results == [b"png"] * 5
+    assert left == 0
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call():
+    async def scenario():
+        sf = SingleFlight()
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(sf.do("k", factory))
+        second = asyncio.create_task(sf.do("k", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert run(scenario()) == "done"
+
+
+def test_error_reaches_every_waiter_and_key_is_freed():
+    async def scenario():
+        sf = SingleFlight()
+
+        async def boom():
+            await asyncio.sleep(0)
+            raise RuntimeError("openai down")
+
+        results = await asyncio.gather(sf.do("k", boom), sf.do("k", boom), return_exceptions=True)
+        # после ошибки ключ свободен — следующий вызов запускает новую попытку
+        again = await sf.do("k", lambda: asyncio.sleep(0, result="ok"))
+        return results, again
+
+    results, again = run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert again == "ok"
+
+
+def test_key_is_freed_when_every_waiter_cancelled():
+    async def scenario():
+        sf = SingleFlight()
+
+        async def boom():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("late")
+
+        waiter = asyncio.create_task(sf.do("k", boom))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.02)
+        return len(sf)
+
+    assert run(scenario()) == 0
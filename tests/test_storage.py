@@ -0,0 +1,62 @@
+# tests/test_storage.py
+import asyncio
+
+import pytest
+
+from conftest import run
+
+
+def test_failed_op_rolls_back_only_its_savepoint(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        await db._storage.write(lambda c: c.execute("CREATE TABLE t (v INTEGER)"))
+        batches = []
+        apply = db._storage._apply_batch
+        db._storage._apply_batch = lambda fns: batches.append(len(fns)) or apply(fns)
+
+        def good(v):
+            return lambda c: c.execute("INSERT INTO t (v) VALUES (?)", (v,)).rowcount
+
+        def bad(c):
+            c.execute("INSERT INTO t (v) VALUES (-1)")
+            raise ValueError("boom")
+
+        # все четыре уходят писателю до того, как он проснётся, — одним батчем, одной транзакцией
+        results = await asyncio.gather(
+            db._storage.write(good(1)), db._storage.write(bad), db._storage.write(good(2)), db._storage.write(good(3)),
+            return_exceptions=True,
+        )
+        rows = await db._storage.read(lambda c: [r[0] for r in c.execute("SELECT v FROM t ORDER BY v")])
+        await db.close_db()
+        return results, rows, batches
+
+    results, rows, batches = run(scenario())
+    assert batches[0] == 4
+    assert results[0] == 1 and results[2] == 1 and results[3] == 1
+    assert isinstance(results[1], ValueError)
+    assert rows == [1, 2, 3]
+
+
+def test_closed_storage_does_not_reopen(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        hold = await db.reserve_credits(1)
+        await db.close_db()
+        with pytest.raises(db.StorageClosed):
+            await db.add_uses(1, 5)
+        # поздний release из отменённого хендлера не падает: резерв вернётся по TTL
+        return await db.release_hold(hold)
+
+    assert run(scenario()) is False
+
+
+def test_maintenance_flag_controls_sweeper(db):
+    async def scenario():
+        await db.init_db(maintenance=False)
+        without = db._storage._sweeper_task is None
+        await db.init_db()
+        with_flag = db._storage._sweeper_task is not None
+        await db.close_db()
+        return without, with_flag
+
+    assert run(scenario()) == (True, True)
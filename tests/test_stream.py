@@ -0,0 +1,65 @@
+# tests/test_stream.py
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+import generator
+from conftest import run
+
+
+class _Broken(Exception):
+    pass
+
+
+class _Pool:
+    """images.generate: поток обрывается после `partials` событий, обычный вызов — успешен."""
+
+    def __init__(self, partials):
+        self.partials = partials
+        self.calls = []
+
+    async def call(self, method, stream=False, **kwargs):
+        self.calls.append("stream" if stream else "plain")
+        if not stream:
+            return SimpleNamespace(data=[SimpleNamespace(b64_json=base64.b64encode(b"plain").decode())])
+        return self._events()
+
+    async def _events(self):
+        for _ in range(self.partials):
+            yield SimpleNamespace(type="image_generation.partial_image", b64_json=base64.b64encode(b"draft").decode())
+        raise _Broken("connection reset")
+
+    def observe_latency(self, took):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(generator, "IMAGE_STREAM", 1)
+    monkeypatch.setattr(generator, "check_blocked", lambda prompt, image=None: None)
+
+    def make(partials):
+        p = _Pool(partials)
+        monkeypatch.setattr(generator, "_get_pool", lambda: p)
+        return p
+
+    return make
+
+
+async def _ignore(_data):
+    pass
+
+
+def test_stream_failing_before_any_event_falls_back(pool):
+    p = pool(0)
+    assert run(generator.generate_image_bytes("кот", on_partial=_ignore)) == b"plain"
+    assert p.calls == ["stream", "plain"]
+
+
+def test_stream_failing_after_partials_is_not_repeated(pool):
+    p = pool(1)
+    with pytest.raises(_Broken):
+        run(generator.generate_image_bytes("кот", on_partial=_ignore))
+    # черновик уже пришёл — генерация оплачена, второй (обычный) вызов списал бы ещё раз
+    assert p.calls == ["stream"]
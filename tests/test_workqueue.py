@@ -0,0 +1,105 @@
+# tests/test_workqueue.py
+import asyncio
+import json
+
+import pytest
+
+import workqueue
+from conftest import run
+from generator import ModerationError, ProviderUnavailable
+from moderation import BlockList
+
+
+@pytest.fixture
+def conn(tmp_path):
+    c = workqueue.connect(str(tmp_path / "work.db"))
+    yield c
+    c.close()
+
+
+def _put(conn, method="generate", args=None):
+    return workqueue.WorkClient._insert(conn, method, json.dumps(args or {"prompt": "кот"}), None, None)
+
+
+def _expire(conn, work_id):
+    """Воркер «завис»: аренда истекла."""
+    conn.execute("UPDATE work SET lease_until = 0 WHERE id = ?", (work_id,))
+
+
+def _row(conn, work_id):
+    return conn.execute("SELECT state, worker, attempts, error FROM work WHERE id = ?", (work_id,)).fetchone()
+
+
+def test_expired_lease_is_redelivered_and_old_worker_cannot_ack(conn):
+    work_id = _put(conn)
+    assert workqueue.lease(conn, "w1")[0] == work_id
+    assert workqueue.lease(conn, "w2") is None  # аренда w1 ещё действует
+    _expire(conn, work_id)
+    assert workqueue.lease(conn, "w2")[0] == work_id
+    # w1 очнулся: продлить и отчитаться уже нельзя — задача у w2
+    assert not workqueue.extend(conn, work_id, "w1")
+    workqueue.ack(conn, work_id, "w1", workqueue.pack([b"stale"]), 1.0)
+    assert _row(conn, work_id)[:3] == ("leased", "w2", 2)
+    workqueue.ack(conn, work_id, "w2", workqueue.pack([b"png"]), 1.0)
+    state, result = conn.execute("SELECT state, result FROM work WHERE id = ?", (work_id,)).fetchone()
+    assert state == "done" and workqueue.unpack(result) == [b"png"]
+
+
+def test_lost_work_fails_after_max_attempts(conn, monkeypatch):
+    monkeypatch.setattr(workqueue, "WORK_MAX_ATTEMPTS", 2)
+    work_id = _put(conn)
+    for worker in ("w1", "w2"):
+        assert workqueue.lease(conn, worker)[0] == work_id
+        _expire(conn, work_id)
+    assert workqueue.lease(conn, "w3") is None
+    state, _worker, attempts, error = _row(conn, work_id)
+    assert (state, attempts) == ("failed", 2)
+    assert json.loads(error)["message"] == "worker_lost"
+
+
+def test_release_hands_work_back_without_spending_an_attempt(conn):
+    work_id = _put(conn)
+    workqueue.lease(conn, "w1")
+    workqueue.release(conn, work_id, "w1")  # SIGTERM: воркер отдаёт задачу, не дожидаясь аренды
+    assert _row(conn, work_id)[:3] == ("queued", None, 0)
+    assert workqueue.lease(conn, "w2")[0] == work_id
+    assert _row(conn, work_id)[2] == 1
+
+
+def test_errors_survive_the_round_trip():
+    me = workqueue._error(workqueue.describe_error(ModerationError(["sexual"], raw="blocked")))
+    assert isinstance(me, ModerationError) and me.categories == ["sexual"]
+    assert isinstance(workqueue._error(workqueue.describe_error(ProviderUnavailable("429"))), ProviderUnavailable)
+    other = workqueue._error(workqueue.describe_error(ValueError("boom")))
+    assert isinstance(other, workqueue.WorkerError) and str(other) == "boom"
+
+
+def test_worker_moderation_block_reaches_frontend_prefilter(db, tmp_path, monkeypatch):
+    path = str(tmp_path / "work.db")
+    blocklist = BlockList()
+    monkeypatch.setattr(workqueue, "blocklist", blocklist)
+    monkeypatch.setattr(workqueue, "WORK_POLL_INTERVAL", 0.01)
+    prompt = "очень откровенная фотосессия на пляже"
+
+    async def scenario():
+        await db.init_db(maintenance=False)
+        client = workqueue.WorkClient(path)
+        monkeypatch.setattr(workqueue, "client", client)
+        worker = workqueue.connect(path)
+        try:
+            call = asyncio.create_task(workqueue.generate_image_bytes(prompt))
+            leased = None
+            while leased is None:
+                await asyncio.sleep(0.01)
+                leased = workqueue.lease(worker, "w1")
+            workqueue.fail(worker, leased[0], "w1", workqueue.describe_error(ModerationError(["sexual"])))
+            with pytest.raises(ModerationError):
+                await call
+        finally:
+            worker.close()
+            await client.close()
+        await asyncio.sleep(0)  # запись блока в SQLite — в фоне
+        return blocklist.check(prompt)
+
+    categories, match = run(scenario())
+    assert categories == ["sexual"] and match == "exact"
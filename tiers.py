@@ -0,0 +1,128 @@
+# tiers.py
+import json
+import logging
+import time
+from typing import Optional
+
+import config
+import database
+import generator
+from jobs import queue as gen_queue
+
+log = logging.getLogger(__name__)
+
+# Пороги авто-деградации бесплатных пользователей (0 — признак не учитывается)
+DEGRADE_QUEUE_DEPTH = int(getattr(config, "DEGRADE_QUEUE_DEPTH", 20))
+DEGRADE_LATENCY = float(getattr(config, "DEGRADE_LATENCY", 45))  # сек, сглаженное время вызова OpenAI
+DEGRADE_RECOVER = 0.7  # выходим из деградации, когда нагрузка упала ниже 70% порога
+DEGRADE_CHECK_INTERVAL = 2.0
+
+
+class Quality:
+    __slots__ = ("name", "title", "quality", "output_format", "compression", "cost")
+
+    def __init__(self, name: str, title: str, quality: str, output_format: str,
+                 compression: Optional[int], cost: int):
+        self.name = name
+        self.title = title
+        self.quality = quality
+        self.output_format = output_format
+        self.compression = compression
+        self.cost = cost
+
+
+# Стоимость — в генерациях; medium стоит столько же, сколько генерация до появления тарифов
+QUALITIES = {
+    "low": Quality("low", "⚡ Быстро", "low", "jpeg", 85, 1),
+    "medium": Quality("medium", "🖼 Стандарт", "medium", "png", None, 1),
+    "high": Quality("high", "💎 Максимум", "high", "png", None, 3),
+}
+SIZES = {
+    "1024x1024": ("⬛ Квадрат", 0),
+    "1536x1024": ("🖥 Альбом", 1),
+    "1024x1536": ("📱 Портрет", 1),
+}
+DEFAULT_QUALITY = getattr(config, "DEFAULT_QUALITY", "medium")
+DEFAULT_SIZE = "1024x1024"
+FALLBACK_QUALITY = "low"  # куда переводим бесплатных при перегрузке
+
+
+class Render:
+    """Итоговые параметры генерации для конкретного запроса."""
+    __slots__ = ("size", "quality", "degraded")
+
+    def __init__(self, size: str, quality: Quality, degraded: bool = False):
+        self.size = size
+        self.quality = quality
+        self.degraded = degraded
+
+    @property
+    def cost(self) -> int:
+        return self.quality.cost + SIZES.get(self.size, ("", 0))[1]
+
+    @property
+    def options(self) -> dict:
+        """Доп. параметры images.generate/edit (size передаётся отдельно)."""
+        opts = {"quality": self.quality.quality, "output_format": self.quality.output_format}
+        if self.quality.compression is not None:
+            opts["output_compression"] = self.quality.compression
+        return opts
+
+    @property
+    def cache_extra(self) -> dict:
+        return {"quality": self.quality.name}
+
+
+# ───── выбор пользователя (user_state "tier" — виден всем инстансам)
+async def get_choice(user_id: int) -> dict:
+    raw = await database.get_state(user_id, "tier")
+    choice = json.loads(raw) if raw else {}
+    if choice.get("quality") not in QUALITIES:
+        choice["quality"] = DEFAULT_QUALITY if DEFAULT_QUALITY in QUALITIES else "medium"
+    if choice.get("size") not in SIZES:
+        choice["size"] = DEFAULT_SIZE
+    return choice
+
+
+async def set_choice(user_id: int, quality: Optional[str] = None, size: Optional[str] = None) -> dict:
+    choice = await get_choice(user_id)
+    if quality in QUALITIES:
+        choice["quality"] = quality
+    if size in SIZES:
+        choice["size"] = size
+    await database.set_state(user_id, "tier", json.dumps(choice))
+    return choice
+
+
+# ───── политика нагрузки (с гистерезисом, чтобы режим не «дребезжал»)
+_degraded = False
+_checked_at = 0.0
+
+
+def overloaded() -> bool:
+    global _degraded, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < DEGRADE_CHECK_INTERVAL:
+        return _degraded
+    _checked_at = now
+    depth = gen_queue.depth
+    latency = generator.recent_latency() or 0.0
+    k = DEGRADE_RECOVER if _degraded else 1.0
+    hot = (DEGRADE_QUEUE_DEPTH and depth >= DEGRADE_QUEUE_DEPTH * k) or (
+        DEGRADE_LATENCY and latency >= DEGRADE_LATENCY * k
+    )
+    if bool(hot) != _degraded:
+        _degraded = bool(hot)
+        log.warning("Tiers: free-tier degradation %s (queue=%d, openai=%.1fs)",
+                    "ON" if _degraded else "OFF", depth, latency)
+    return _degraded
+
+
+async def resolve(user_id: int, is_admin: bool = False) -> Render:
+    """Параметры генерации: выбор пользователя, а при перегрузке бесплатным — быстрый режим."""
+    choice = await get_choice(user_id)
+    quality = QUALITIES[choice["quality"]]
+    size = choice["size"]
+    if quality.name != FALLBACK_QUALITY and overloaded() and not is_admin and not await database.is_paying_user(user_id):
+        return Render(DEFAULT_SIZE, QUALITIES[FALLBACK_QUALITY], degraded=True)
+    return Render(size, quality)
@@ -0,0 +1,186 @@
+# worker.py
+"""
+Процесс генерации для GEN_BACKEND=workers: берёт задачи из workqueue (SQLite), вызывает generator.py
+и пишет результат обратно. Запуск: python worker.py [--concurrency N]
+(или GEN_PROCESSES=N — main.py сам поднимет и будет перезапускать N таких процессов).
+
+SIGTERM/SIGINT: новые задачи не берутся, текущие дорабатываются до WORKER_DRAIN секунд,
+недоделанные сразу возвращаются в очередь — их подхватит другой воркер.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import config
+import database
+import generator
+import workqueue
+
+log = logging.getLogger("worker")
+
+WORKER_CONCURRENCY = int(getattr(config, "WORKER_CONCURRENCY", 4))
+WORKER_DRAIN = float(getattr(config, "WORKER_DRAIN", 30))
+IDLE_POLL_MIN = 0.05
+IDLE_POLL_MAX = 1.0
+
+
+class Worker:
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="workqueue")
+        self._conn = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._running: dict = {}  # work_id → task
+
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, self._conn, *args)
+
+    # ── выполнение одной задачи
+    async def _execute(self, work_id: int, method: str, args: dict, image, mask) -> bytes:
+        async def on_partial(data: bytes) -> None:
+            await self._db(workqueue.post_partial, work_id, self.name, data)
+
+        partial = on_partial if args.pop("stream", False) else None
+        if method == "generate":
+            png = await generator.generate_image_bytes(on_partial=partial, **args)
+            return workqueue.pack([png] if png else [])
+        if method == "generate_n":
+            return workqueue.pack(await generator.generate_images(**args))
+        if method == "edit":
+            png = await generator.edit_image_bytes(image, mask_bytes=mask, on_partial=partial, **args)
+            return workqueue.pack([png] if png else [])
+        raise ValueError(f"unknown method: {method}")
+
+    async def _heartbeat(self, work_id: int, task: asyncio.Task) -> None:
+        while not task.done():
+            await asyncio.sleep(workqueue.WORK_LEASE / 3)
+            if not await self._db(workqueue.extend, work_id, self.name):
+                # фронтенд отменил задачу (пользователь ушёл) или её отдали другому
+                log.info("Work %d is no longer ours, cancelling", work_id)
+                task.cancel()
+                return
+
+    async def _handle(self, row) -> None:
+        work_id, method, args, image, mask = row
+        started = time.perf_counter()
+        task = asyncio.create_task(self._execute(work_id, method, json.loads(args), image, mask))
+        self._running[work_id] = task
+        beat = asyncio.create_task(self._heartbeat(work_id, task))
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if self._stopping.is_set():
+                await self._db(workqueue.release, work_id, self.name)
+            return
+        except Exception as e:
+            if not isinstance(e, (generator.ModerationError, generator.ProviderUnavailable)):
+                log.warning("Work %d (%s) failed: %s", work_id, method, e)
+            await self._db(workqueue.fail, work_id, self.name, workqueue.describe_error(e))
+        else:
+            await self._db(workqueue.ack, work_id, self.name, result, time.perf_counter() - started)
+        finally:
+            beat.cancel()
+            self._running.pop(work_id, None)
+
+    # ── цикл одного слота
+    async def _slot(self) -> None:
+        idle = IDLE_POLL_MIN
+        while not self._stopping.is_set():
+            try:
+                row = await self._db(workqueue.lease, self.name)
+            except Exception:
+                log.exception("lease failed")
+                row = None
+            if row is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=idle)
+                except asyncio.TimeoutError:
+                    pass
+                idle = min(IDLE_POLL_MAX, idle * 2)
+                continue
+            idle = IDLE_POLL_MIN
+            await self._handle(row)
+
+    async def run(self) -> None:
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._stopping.set)
+        self._conn = await loop.run_in_executor(self._pool, workqueue.connect, workqueue.WORK_DB_PATH)
+        # обслуживание БД (резервы, сводки) и пред-фильтр модерации — забота процесса бота
+        await database.init_db(maintenance=False)
+        generator.init_client()
+        log.info("Worker %s: %d slots, queue %s", self.name, self.concurrency, workqueue.WORK_DB_PATH)
+
+        slots = [asyncio.create_task(self._slot()) for _ in range(self.concurrency)]
+        await self._stopping.wait()
+        log.info("Worker %s: draining %d jobs", self.name, len(self._running))
+        done, pending = await asyncio.wait(slots, timeout=WORKER_DRAIN)
+        for task in list(self._running.values()):
+            task.cancel()  # _handle вернёт задачу в очередь
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        await generator.close_client()
+        await database.close_db()
+        await loop.run_in_executor(self._pool, self._conn.close)
+        self._pool.shutdown(wait=True)
+
+
+# ───── запуск воркеров из main.py (GEN_PROCESSES)
+class Supervisor:
+    """Держит N процессов worker.py и перезапускает упавшие (с паузой, чтобы не крутиться впустую)."""
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._tasks: list = []
+        self._procs: dict = {}
+        self._stopping = False
+
+    async def _keep(self, idx: int) -> None:
+        backoff = 1.0
+        script = os.path.abspath(__file__)
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, script)
+            self._procs[idx] = proc
+            started = time.monotonic()
+            code = await proc.wait()
+            if self._stopping:
+                return
+            log.warning("Worker process %d exited with %s, restarting", idx, code)
+            backoff = 1.0 if time.monotonic() - started > 60 else min(30.0, backoff * 2)
+            await asyncio.sleep(backoff)
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._keep(i)) for i in range(self.processes)]
+        log.info("Supervisor: %d worker processes", self.processes)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for proc in self._procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+        await asyncio.gather(*(p.wait() for p in self._procs.values()), return_exceptions=True)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Процесс генерации (GEN_BACKEND=workers)")
+    ap.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="задач одновременно")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    asyncio.run(Worker(args.concurrency).run())
+
+
+if __name__ == "__main__":
+    main()
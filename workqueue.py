@@ -0,0 +1,359 @@
+# workqueue.py
+"""
+Долговременная локальная очередь генераций между фронтендом (main.py) и процессами worker.py.
+
+SQLite-файл WORK_DB_PATH (WAL) — общий для фронтенда и воркеров на одной машине:
+- фронтенд кладёт задачу (метод, параметры, картинка/маска) и ждёт результат;
+- воркер берёт задачу в аренду (lease) на WORK_LEASE секунд и продлевает её, пока работает;
+- ack — результат в строку задачи, фронтенд забирает его и удаляет строку;
+- воркер упал или завис — аренда истекает, задачу берёт другой (до WORK_MAX_ATTEMPTS раз);
+- промежуточные картинки (черновики) воркер пишет в ту же строку, фронтенд показывает их.
+
+Со стороны хендлеров — те же функции, что в generator.py (generate_image_bytes и т.д.).
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import config
+import generator
+from generator import ModerationError, ProviderUnavailable, OnPartial
+from metrics import stage_seconds
+from moderation import blocklist
+
+log = logging.getLogger(__name__)
+
+WORK_DB_PATH = getattr(config, "WORK_DB_PATH", "work.db")
+WORK_LEASE = float(getattr(config, "WORK_LEASE", 60))
+WORK_MAX_ATTEMPTS = int(getattr(config, "WORK_MAX_ATTEMPTS", 3))
+WORK_POLL_INTERVAL = float(getattr(config, "WORK_POLL_INTERVAL", 0.1))
+WORK_RETENTION = 3600.0  # сек; результаты, которые никто не забрал (фронтенд перезапускался)
+SWEEP_INTERVAL = 60.0
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS work (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT NOT NULL,
+        args TEXT NOT NULL,
+        image BLOB,
+        mask BLOB,
+        state TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_until REAL,
+        partial BLOB,
+        partial_seq INTEGER NOT NULL DEFAULT 0,
+        result BLOB,
+        error TEXT,
+        took REAL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_work_state ON work(state, id)",
+]
+
+
+class WorkerError(Exception):
+    """Задача не выполнена воркером (не модерация и не перегрузка OpenAI)."""
+
+
+def pack(images: List[bytes]) -> bytes:
+    """Несколько картинок в одном BLOB: [длина (4 байта)][байты]..."""
+    return b"".join(struct.pack(">I", len(b)) + b for b in images)
+
+
+def unpack(blob: bytes) -> List[bytes]:
+    out, pos = [], 0
+    while pos < len(blob):
+        (n,) = struct.unpack_from(">I", blob, pos)
+        out.append(blob[pos + 4:pos + 4 + n])
+        pos += 4 + n
+    return out
+
+
+def connect(path: str = WORK_DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    for stmt in _SCHEMA:
+        conn.execute(stmt)
+    return conn
+
+
+# ───── сторона воркера (синхронные операции, вызываются из потока)
+def lease(conn: sqlite3.Connection, worker: str) -> Optional[Tuple]:
+    """Берёт самую старую свободную задачу (или задачу с истёкшей арендой). (id, method, args, image, mask)."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # исчерпавшие попытки больше не раздаём — фронтенд получит ошибку
+        conn.execute(
+            "UPDATE work SET state = 'failed', error = ?, updated_at = ?"
+            " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+            (json.dumps({"kind": "error", "message": "worker_lost"}), now, now, WORK_MAX_ATTEMPTS),
+        )
+        row = conn.execute(
+            "UPDATE work SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+            " WHERE id = (SELECT id FROM work WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?)"
+            "             ORDER BY id LIMIT 1)"
+            " RETURNING id, method, args, image, mask, attempts",
+            (worker, now + WORK_LEASE, now, now),
+        ).fetchone()
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if row and row[5] > 1:
+        log.warning("Work %d redelivered to %s (attempt %d)", row[0], worker, row[5])
+    return row[:5] if row else None
+
+
+def extend(conn: sqlite3.Connection, work_id: int, worker: str) -> bool:
+    """Продлевает аренду. False — задача уже не наша (отменена или отдана другому)."""
+    now = time.time()
+    cur = conn.execute(
+        "UPDATE work SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+        (now + WORK_LEASE, now, work_id, worker),
+    )
+    return cur.rowcount > 0
+
+
+def post_partial(conn: sqlite3.Connection, work_id: int, worker: str, data: bytes) -> None:
+    conn.execute(
+        "UPDATE work SET partial = ?, partial_seq = partial_seq + 1 WHERE id = ? AND worker = ? AND state = 'leased'",
+        (data, work_id, worker),
+    )
+
+
+def ack(conn: sqlite3.Connection, work_id: int, worker: str, result: bytes, took: float) -> None:
+    conn.execute(
+        "UPDATE work SET state = 'done', result = ?, took = ?, partial = NULL, updated_at = ?"
+        " WHERE id = ? AND worker = ? AND state = 'leased'",
+        (result, took, time.time(), work_id, worker),
+    )
+
+
+def fail(conn: sqlite3.Connection, work_id: int, worker: str, error: dict) -> None:
+    conn.execute(
+        "UPDATE work SET state = 'failed', error = ?, partial = NULL, updated_at = ?"
+        " WHERE id = ? AND worker = ? AND state = 'leased'",
+        (json.dumps(error, ensure_ascii=False), time.time(), work_id, worker),
+    )
+
+
+def release(conn: sqlite3.Connection, work_id: int, worker: str) -> None:
+    """Воркер останавливается — задача сразу возвращается в очередь, попытка не засчитывается."""
+    conn.execute(
+        "UPDATE work SET state = 'queued', worker = NULL, lease_until = NULL, attempts = attempts - 1, updated_at = ?"
+        " WHERE id = ? AND worker = ? AND state = 'leased'",
+        (time.time(), work_id, worker),
+    )
+
+
+# ───── сторона фронтенда
+class _Waiter:
+    __slots__ = ("future", "on_partial", "seq")
+
+    def __init__(self, future: asyncio.Future, on_partial: Optional[OnPartial]):
+        self.future = future
+        self.on_partial = on_partial
+        self.seq = 0
+
+
+class WorkClient:
+    """
+    Постановка задач и ожидание результатов. Один поток с одним соединением:
+    все ожидающие опрашиваются одним запросом раз в WORK_POLL_INTERVAL.
+    """
+
+    def __init__(self, path: str = WORK_DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._waiting: Dict[int, _Waiter] = {}
+        self._poller: Optional[asyncio.Task] = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    async def _run(self, fn, *args):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(1, thread_name_prefix="workqueue")
+        if self._conn is None:
+            self._conn = await asyncio.get_running_loop().run_in_executor(self._pool, connect, self.path)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, self._conn, *args)
+
+    @staticmethod
+    def _insert(conn, method: str, args: str, image: Optional[bytes], mask: Optional[bytes]) -> int:
+        now = time.time()
+        return conn.execute(
+            "INSERT INTO work (method, args, image, mask, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (method, args, image, mask, now, now),
+        ).lastrowid
+
+    async def call(self, method: str, args: dict, image: Optional[bytes] = None, mask: Optional[bytes] = None,
+                   on_partial: Optional[OnPartial] = None) -> List[bytes]:
+        work_id = await self._run(self._insert, method, json.dumps(args, ensure_ascii=False), image, mask)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), on_partial)
+        self._waiting[work_id] = waiter
+        self._ensure_poller()
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            # пользователь ушёл — воркер увидит отмену при продлении аренды
+            await asyncio.shield(self._run(lambda c: c.execute(
+                "UPDATE work SET state = 'cancelled', updated_at = ? WHERE id = ? AND state IN ('queued', 'leased')",
+                (time.time(), work_id),
+            )))
+            raise
+        finally:
+            self._waiting.pop(work_id, None)
+
+    def _ensure_poller(self) -> None:
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_forever())
+
+    @staticmethod
+    def _fetch(conn, waiting: Dict[int, int]) -> List[Tuple]:
+        """Готовые задачи — целиком (и удаляются), у прочих — только новый черновик, если он есть."""
+        out = []
+        ids = list(waiting)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for work_id, state, seq in conn.execute(
+                f"SELECT id, state, partial_seq FROM work WHERE id IN ({marks})", chunk
+            ).fetchall():
+                if state in ("done", "failed", "cancelled"):
+                    row = conn.execute("SELECT result, error, took FROM work WHERE id = ?", (work_id,)).fetchone()
+                    conn.execute("DELETE FROM work WHERE id = ?", (work_id,))
+                    out.append((work_id, state, row[0], row[1], row[2]))
+                elif seq > waiting[work_id]:
+                    row = conn.execute("SELECT partial, partial_seq FROM work WHERE id = ?", (work_id,)).fetchone()
+                    if row and row[0]:
+                        out.append((work_id, "partial", row[0], None, row[1]))
+        return out
+
+    @staticmethod
+    def _sweep(conn) -> int:
+        return conn.execute(
+            "DELETE FROM work WHERE state IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+            (time.time() - WORK_RETENTION,),
+        ).rowcount
+
+    async def _poll_forever(self) -> None:
+        swept_at = time.monotonic()
+        while self._waiting:
+            try:
+                rows = await self._run(self._fetch, {k: w.seq for k, w in self._waiting.items()})
+            except Exception:
+                log.exception("WorkClient: poll failed")
+                rows = []
+            for work_id, state, blob, error, extra in rows:
+                waiter = self._waiting.get(work_id)
+                if waiter is None or waiter.future.done():
+                    continue
+                if state == "partial":
+                    waiter.seq = extra
+                    if waiter.on_partial is not None:
+                        asyncio.create_task(waiter.on_partial(blob))
+                elif state == "done":
+                    if extra:
+                        generator.observe_latency(extra)
+                    waiter.future.set_result(unpack(blob) if blob else [])
+                else:
+                    waiter.future.set_exception(_error(json.loads(error) if error else {"kind": "cancelled"}))
+            if time.monotonic() - swept_at > SWEEP_INTERVAL:
+                swept_at = time.monotonic()
+                await self._run(self._sweep)
+            await asyncio.sleep(WORK_POLL_INTERVAL)
+
+    async def close(self) -> None:
+        if self._poller:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+        if self._pool is not None:
+            if self._conn is not None:
+                await asyncio.get_running_loop().run_in_executor(self._pool, self._conn.close)
+                self._conn = None
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+def _error(err: dict) -> Exception:
+    kind = err.get("kind")
+    if kind == "moderation":
+        return ModerationError(categories=err.get("categories") or [], raw=err.get("message", ""))
+    if kind == "unavailable":
+        return ProviderUnavailable(err.get("message", ""))
+    return WorkerError(err.get("message") or kind or "worker error")
+
+
+async def _call(method: str, args: dict, prompt: str, image: Optional[bytes] = None, **kwargs) -> List[bytes]:
+    """
+    client.call + блок модерации из строки результата — в пред-фильтр процесса бота:
+    воркер запомнил его только у себя, а check_blocked проверяет память этого процесса.
+    """
+    try:
+        return await client.call(method, args, image=image, **kwargs)
+    except ModerationError as me:
+        blocklist.remember(prompt, me.categories, image)
+        raise
+
+
+def describe_error(e: Exception) -> dict:
+    """Исключение воркера → JSON для фронтенда (обратное к _error)."""
+    if isinstance(e, ModerationError):
+        return {"kind": "moderation", "categories": e.categories, "message": e.raw}
+    if isinstance(e, ProviderUnavailable):
+        return {"kind": "unavailable", "message": str(e)}
+    return {"kind": "error", "message": str(e) or type(e).__name__}
+
+
+client = WorkClient()
+
+
+# ───── те же функции, что в generator.py, но через воркеры
+async def generate_image_bytes(
+    prompt: str, size: str = "1024x1024", on_partial: Optional[OnPartial] = None, **options
+) -> Optional[bytes]:
+    with stage_seconds.time("generate", "worker"):
+        images = await _call("generate", dict(options, prompt=prompt, size=size, stream=on_partial is not None),
+                             prompt, on_partial=on_partial)
+    return images[0] if images else None
+
+
+async def generate_images(
+    prompt: str, size: str = "1024x1024", n: int = 1, op: str = "variants", **options
+) -> List[bytes]:
+    with stage_seconds.time(op, "worker"):
+        return await _call("generate_n", dict(options, prompt=prompt, size=size, n=n, op=op), prompt)
+
+
+async def edit_image_bytes(
+    image_bytes: bytes,
+    prompt: str,
+    size: str = "1024x1024",
+    mask_bytes: Optional[bytes] = None,
+    on_partial: Optional[OnPartial] = None,
+    **options,
+) -> Optional[bytes]:
+    with stage_seconds.time("edit", "worker"):
+        images = await _call("edit", dict(options, prompt=prompt, size=size, stream=on_partial is not None),
+                             prompt, image=image_bytes, mask=mask_bytes, on_partial=on_partial)
+    return images[0] if images else None
+
+
+def enabled() -> bool:
+    return getattr(config, "GEN_BACKEND", "local") == "workers"
+